@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+
+#
+# benchmark_rntn.py
+# Benchmarks of the RNTN stack: tree parsing, feed dict construction, training and numpy inference
+# throughput and webapp request latency, on synthetic treebanks.
+# Results are written to reports/benchmarks as json to compare them between commits.
+#
+
+import click
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+from unittest import mock
+import numpy as np
+import tensorflow as tf
+from src.benchmarks.synthetic import synthetic_treebank, synthetic_vocabulary
+from src.features.tree import Tree
+from src.models import rntn_inference
+from src.models.data_manager import DataManager
+from src.models.rntn import RNTN
+
+abs_path = os.path.abspath(os.path.dirname(__file__))
+def_results_path = os.path.join(abs_path, '../../reports/benchmarks/')
+
+# Number of trees in SST train
+SST_TRAIN_SIZE = 8544
+
+# Trained model used by the webapp
+DEF_MODEL_NAME = 'RNTN_30_tanh_35_5_None_50_0.001_0.01_9645'
+
+
+#
+# Helpers
+#
+
+def _latency_stats(durations):
+    """ Mean and percentiles of durations in seconds, in milliseconds. """
+    durations_ms = 1000. * np.asarray(durations)
+    return {
+        'mean_ms': float(np.mean(durations_ms)),
+        'p50_ms': float(np.percentile(durations_ms, 50)),
+        'p90_ms': float(np.percentile(durations_ms, 90)),
+        'p99_ms': float(np.percentile(durations_ms, 99))
+    }
+
+
+def _best_time(func, repeats):
+    """ Shortest duration in seconds of repeats calls of func. """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def _batches(items, batch_size):
+    """ Splits items into consecutive batches. """
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def _synthetic_rntn(vocabulary_size, embedding_size=35, tensor_rank=None):
+    """ RNTN with the synthetic vocabulary in memory, so that no trained model is needed. """
+    r = RNTN(model_name='benchmark', embedding_size=embedding_size, tensor_rank=tensor_rank)
+    r.vocabulary_ = {word: i for i, word in enumerate(synthetic_vocabulary(vocabulary_size))}
+    r.V_ = len(r.vocabulary_)
+    return r
+
+
+def _synthetic_weights(embedding_size, vocabulary_size, label_size=5, tensor_rank=None, seed=42):
+    """ Random weights in the format of rntn_inference.load_weights. """
+    rng = np.random.RandomState(seed)
+    d = embedding_size
+
+    def random_weight(*shape):
+        return (0.1 * rng.randn(*shape)).astype(np.float32)
+
+    weights = {
+        'L': random_weight(d, vocabulary_size),
+        'W': random_weight(d, 2 * d),
+        'b': random_weight(d),
+        'U': random_weight(d, label_size),
+        'bs': random_weight(label_size)
+    }
+    if tensor_rank is None:
+        weights['T'] = random_weight(2 * d, 2 * d * d)
+    else:
+        weights['T_P'] = random_weight(2 * d, tensor_rank * d)
+        weights['T_Q'] = random_weight(2 * d, tensor_rank * d)
+    return weights
+
+
+def _quantize_weights(weights, embedding_size):
+    """ Int8 version of weights, as written by rntn_inference.export_quantized. """
+    d = embedding_size
+    quantized = dict(weights)
+    quantized['L'], quantized['L_scale'] = rntn_inference.quantize(weights['L'], axis=1)
+    for name in ['T', 'T_P', 'T_Q']:
+        if name in weights:
+            q, scale = rntn_inference.quantize(weights[name].reshape(2 * d, -1, d), axis=2)
+            quantized[name] = q.reshape(weights[name].shape)
+            quantized[name + '_scale'] = scale
+    return quantized
+
+
+def _stub_parser(sentence):
+    """ Right branching tree over the words of a sentence, in place of the CoreNLP parser. """
+    words = sentence.split()
+    tree_txt = '(2 {0})'.format(words[-1])
+    for word in reversed(words[:-1]):
+        tree_txt = '(2 (2 {0}) {1})'.format(word, tree_txt)
+    return tree_txt
+
+
+def _git_commit():
+    """ Short hash of the current commit or None outside of a git checkout. """
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=abs_path,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return result.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#
+# Benchmarks
+#
+
+def benchmark_tree_parsing(tree_strings, repeats=3):
+    """ Throughput of parsing PTB tree strings into trees.
+
+    :param tree_strings:
+        Tree strings to parse.
+    :param repeats:
+        Number of passes, the fastest is reported.
+    :return:
+        A dict with trees/sec and nodes/sec.
+    """
+    num_nodes = sum(tree_string.count('(') for tree_string in tree_strings)
+    duration = _best_time(lambda: [Tree(tree_string) for tree_string in tree_strings], repeats)
+    return {
+        'num_trees': len(tree_strings),
+        'trees_per_sec': len(tree_strings) / duration,
+        'nodes_per_sec': num_nodes / duration
+    }
+
+
+def benchmark_feed_dict(trees, vocabulary_size, batch_size=30, repeats=3):
+    """ Throughput of flattening trees and building feed dicts.
+
+    :param trees:
+        Parsed trees.
+    :param vocabulary_size:
+        Size of the synthetic vocabulary of the trees.
+    :param batch_size:
+        Trees per feed dict, as in RNTN.fit.
+    :param repeats:
+        Number of passes, the fastest is reported.
+    :return:
+        A dict with trees/sec of RNTN._tree_feed_data and of RNTN._build_feed_dict.
+    """
+    r = _synthetic_rntn(vocabulary_size)
+    batches = _batches(trees, batch_size)
+
+    tree_duration = _best_time(lambda: [r._tree_feed_data(tree, 0) for tree in trees], repeats)
+
+    with tf.Graph().as_default():
+        r._build_model_placeholders()
+        feed_duration = _best_time(lambda: [r._build_feed_dict(batch) for batch in batches], repeats)
+
+    return {
+        'num_trees': len(trees),
+        'batch_size': batch_size,
+        'tree_feed_data_trees_per_sec': len(trees) / tree_duration,
+        'build_feed_dict_trees_per_sec': len(trees) / feed_duration
+    }
+
+
+def benchmark_training(trees, vocabulary_size, embedding_sizes=(25, 35, 50), batch_size=30, tensor_rank=None,
+                       repeats=5):
+    """ Forward and backward throughput of the training graph.
+
+    Builds the batch graph, cross entropy loss and Adagrad optimizer of RNTN.fit once per embedding size and
+    times runs of the forward pass alone and of a full training step over the same batch.
+
+    :param trees:
+        Parsed trees, the first batch_size are used.
+    :param vocabulary_size:
+        Size of the synthetic vocabulary of the trees.
+    :param embedding_sizes:
+        Embedding sizes to benchmark.
+    :param batch_size:
+        Trees per batch.
+    :param tensor_rank:
+        Rank of the tensor slices, full rank if None.
+    :param repeats:
+        Number of timed runs, the median is reported.
+    :return:
+        A dict keyed by embedding size with forward, backward and training step nodes/sec.
+    """
+    results = {}
+    batch = trees[:batch_size]
+
+    for embedding_size in embedding_sizes:
+        r = _synthetic_rntn(vocabulary_size, embedding_size, tensor_rank)
+
+        with tf.Graph().as_default(), tf.Session() as session:
+            r._build_model_placeholders()
+            r._build_model_graph_var(embedding_size, r.V_, r.label_size, tensor_rank)
+            feed_dict = r._build_feed_dict(batch)
+
+            labels = tf.get_default_graph().get_tensor_by_name('Inputs/label:0')
+            n = len(feed_dict[labels])
+
+            logits = r._build_batch_graph(r.get_word, r._get_compose_func())
+            weights = tf.ones_like(labels, dtype=tf.float32)
+            loss = tf.add(r._mean_cross_entropy_loss(labels, logits, weights), r._regularization_loss())
+            train_op = tf.train.AdagradOptimizer(r.training_rate).minimize(loss)
+            session.run(tf.global_variables_initializer())
+
+            # Warm up
+            session.run(train_op, feed_dict=feed_dict)
+
+            forward = []
+            step = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                session.run(logits, feed_dict=feed_dict)
+                forward.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                session.run(train_op, feed_dict=feed_dict)
+                step.append(time.perf_counter() - start)
+
+        forward_time = float(np.median(forward))
+        step_time = float(np.median(step))
+        results[embedding_size] = {
+            'num_nodes': n,
+            'forward_nodes_per_sec': n / forward_time,
+            'backward_nodes_per_sec': n / max(step_time - forward_time, 1e-9),
+            'step_nodes_per_sec': n / step_time
+        }
+        logging.info('Training benchmark with embedding size {0}: {1}'.format(embedding_size, results[embedding_size]))
+
+    return results
+
+
+def benchmark_inference(trees, vocabulary_size, embedding_size=35, batch_sizes=(1, 30), tensor_rank=None,
+                        quantized=False):
+    """ Latency of numpy inference for single and batched reviews.
+
+    Every review is flattened with RNTN._tree_feed_data and predicted with rntn_inference.predict_proba_tree,
+    as in RNTN.predict_proba_full_tree_notf, with random weights of the given shape.
+
+    :param trees:
+        Parsed trees, one per review.
+    :param vocabulary_size:
+        Size of the synthetic vocabulary of the trees.
+    :param embedding_size:
+        Word embedding size.
+    :param batch_sizes:
+        Numbers of reviews per request.
+    :param tensor_rank:
+        Rank of the tensor slices, full rank if None.
+    :param quantized:
+        Uses int8 word embeddings and tensor.
+    :return:
+        A dict keyed by batch size with latency percentiles per request and reviews/sec.
+    """
+    r = _synthetic_rntn(vocabulary_size, embedding_size, tensor_rank)
+    weights = _synthetic_weights(embedding_size, vocabulary_size, r.label_size, tensor_rank)
+    if quantized:
+        weights = _quantize_weights(weights, embedding_size)
+
+    def predict(batch):
+        for tree in batch:
+            rntn_inference.predict_proba_tree(weights, r._tree_feed_data(tree, 0), r.compose_func)
+
+    results = {}
+    for batch_size in batch_sizes:
+        durations = []
+        for batch in _batches(trees, batch_size):
+            start = time.perf_counter()
+            predict(batch)
+            durations.append(time.perf_counter() - start)
+
+        results[batch_size] = _latency_stats(durations)
+        results[batch_size]['reviews_per_sec'] = len(trees) / sum(durations)
+
+    return results
+
+
+def benchmark_webapp(texts, model_name=DEF_MODEL_NAME):
+    """ Latency of sentiment requests to the webapp.
+
+    The CoreNLP parser is replaced by a right branching tree over the words of the review, so that the
+    latency covers the request handling, model loading and prediction of the webapp only.
+
+    :param texts:
+        Review texts to post.
+    :param model_name:
+        Trained model used for predictions (should be present in models folder)
+    :return:
+        A dict with latency percentiles per request.
+    """
+    from src.models import predict_model
+    from src.webapp import webapp
+
+    def predict(x):
+        return predict_model.predict_model(x, model_name=model_name)
+
+    durations = []
+    with mock.patch.object(predict_model, 'convert_text_tree', _stub_parser), \
+            mock.patch.object(webapp, 'predict_model', predict):
+        client = webapp.create_app().test_client()
+        for text in texts:
+            start = time.perf_counter()
+            response = client.post('/', data={'text': text})
+            durations.append(time.perf_counter() - start)
+            assert response.status_code == 200
+
+    return _latency_stats(durations)
+
+
+#
+# Runner
+#
+
+def run_benchmarks(quick=False, benchmarks=None, tensor_rank=None, sst_train_path=None):
+    """ Runs the benchmarks on synthetic treebanks.
+
+    :param quick:
+        Uses smaller treebanks and fewer repeats, for a smoke run.
+    :param benchmarks:
+        Names of the benchmarks to run, all if None.
+    :param tensor_rank:
+        Rank of the tensor slices for the training and inference benchmarks, full rank if None.
+    :param sst_train_path:
+        SST train file to also benchmark tree parsing on, the default treebank location if None.
+        Skipped if the file does not exist.
+    :return:
+        A dict with the metadata of the run and the results of each benchmark.
+    """
+    num_trees = 500 if quick else SST_TRAIN_SIZE
+    vocabulary_size = 5000
+    repeats = 1 if quick else 3
+
+    tree_strings = synthetic_treebank(num_trees, vocabulary_size)
+    trees = np.asarray([Tree(tree_string) for tree_string in tree_strings])
+
+    def selected(name):
+        return benchmarks is None or name in benchmarks
+
+    results = {
+        'metadata': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'quick': quick,
+            'num_trees': num_trees,
+            'vocabulary_size': vocabulary_size,
+            'tensor_rank': tensor_rank
+        }
+    }
+
+    if selected('tree_parsing'):
+        results['tree_parsing'] = {'synthetic': benchmark_tree_parsing(tree_strings, repeats)}
+
+        if sst_train_path is None:
+            sst_train_path = DataManager._make_file_name(DataManager._def_trees_path, 'train')
+        if os.path.exists(sst_train_path):
+            with open(sst_train_path, 'r') as f:
+                sst_strings = [line.strip() for line in f]
+            results['tree_parsing']['sst_train'] = benchmark_tree_parsing(sst_strings, repeats)
+
+    if selected('feed_dict'):
+        results['feed_dict'] = benchmark_feed_dict(trees, vocabulary_size, repeats=repeats)
+
+    if selected('training'):
+        results['training'] = benchmark_training(trees, vocabulary_size, tensor_rank=tensor_rank,
+                                                 repeats=2 if quick else 5)
+
+    if selected('inference'):
+        inference_trees = trees[:100 if quick else 1000]
+        results['inference'] = {
+            'float': benchmark_inference(inference_trees, vocabulary_size, tensor_rank=tensor_rank),
+            'int8': benchmark_inference(inference_trees, vocabulary_size, tensor_rank=tensor_rank, quantized=True)
+        }
+
+    if selected('webapp'):
+        texts = [tree.text() for tree in trees[:20 if quick else 200]]
+        results['webapp'] = benchmark_webapp(texts)
+
+    return results
+
+
+def save_results(results, path=None):
+    """ Writes benchmark results as json.
+
+    :param results:
+        Results of run_benchmarks.
+    :param path:
+        File path, reports/benchmarks/rntn-<commit>-<timestamp>.json if None.
+    :return:
+        The file path.
+    """
+    if path is None:
+        os.makedirs(def_results_path, exist_ok=True)
+        path = '{0}/rntn-{1}-{2}.json'.format(def_results_path, results['metadata']['commit'],
+                                              datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info('Benchmark results written to {0}'.format(path))
+
+    return path
+
+
+def compare_results(old_results, new_results):
+    """ Compares the metrics of two benchmark runs.
+
+    :param old_results:
+        Results of the baseline run.
+    :param new_results:
+        Results of the new run.
+    :return:
+        A list of (metric, old value, new value, new / old) for the metrics present in both runs.
+        Metrics ending in _ms are latencies (lower is better), the others throughputs (higher is better).
+    """
+    def flatten(results, prefix=''):
+        metrics = {}
+        for key, value in results.items():
+            name = '{0}{1}'.format(prefix, key)
+            if isinstance(value, dict):
+                metrics.update(flatten(value, name + '.'))
+            elif isinstance(value, float):
+                metrics[name] = value
+        return metrics
+
+    old_metrics = flatten({key: value for key, value in old_results.items() if key != 'metadata'})
+    new_metrics = flatten({key: value for key, value in new_results.items() if key != 'metadata'})
+
+    return [(name, old_metrics[name], new_metrics[name], new_metrics[name] / old_metrics[name])
+            for name in sorted(old_metrics) if name in new_metrics and old_metrics[name] != 0]
+
+
+@click.group()
+def main():
+    """ RNTN benchmarks. """
+    pass
+
+
+@main.command()
+@click.option('--quick', is_flag=True, help='Smaller treebanks and fewer repeats.')
+@click.option('--benchmark', 'benchmarks', multiple=True,
+              type=click.Choice(['tree_parsing', 'feed_dict', 'training', 'inference', 'webapp']),
+              help='Benchmark to run, can be repeated. All if not given.')
+@click.option('--tensor-rank', default=None, type=int, help='Rank of the tensor slices.')
+@click.option('--output', default=None, help='Results file.')
+def run(quick, benchmarks, tensor_rank, output):
+    """ Runs the benchmarks and writes the results. """
+    results = run_benchmarks(quick, benchmarks or None, tensor_rank)
+    print(json.dumps(results, indent=2))
+    print(save_results(results, output))
+
+
+@main.command()
+@click.argument('old_path')
+@click.argument('new_path')
+def compare(old_path, new_path):
+    """ Compares two results files. """
+    with open(old_path) as f:
+        old_results = json.load(f)
+    with open(new_path) as f:
+        new_results = json.load(f)
+
+    for name, old_value, new_value, ratio in compare_results(old_results, new_results):
+        print('{0:<60} {1:>12.3f} {2:>12.3f} {3:>7.2f}x'.format(name, old_value, new_value, ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+#
+# synthetic.py
+# Synthetic treebanks in the PTB format of the Stanford Sentiment Treebank.
+# Used by the benchmarks so that they run without the real data.
+#
+
+import numpy as np
+
+
+def synthetic_vocabulary(vocabulary_size):
+    """ Words of a synthetic vocabulary.
+
+    :param vocabulary_size:
+        Number of words.
+    :return:
+        A list of words w0, w1, ...
+    """
+    return ['w{0}'.format(i) for i in range(vocabulary_size)]
+
+
+def synthetic_tree_string(rng, words, min_words=2, max_words=40):
+    """ Builds a random binary tree over random words.
+
+    Words are drawn with Zipf distributed frequencies and adjacent nodes are merged at random positions until
+    a single root is left, so tree depths vary like those of parsed sentences.
+
+    :param rng:
+        numpy RandomState.
+    :param words:
+        Vocabulary to draw words from.
+    :param min_words:
+        Minimum number of words in the tree.
+    :param max_words:
+        Maximum number of words in the tree.
+    :return:
+        Tree string such as (2 (3 (3 w12) (2 w0)) (1 w4)).
+    """
+    num_words = rng.randint(min_words, max_words + 1)
+    word_ids = np.minimum(rng.zipf(1.3, num_words) - 1, len(words) - 1)
+    nodes = ['({0} {1})'.format(rng.randint(0, 5), words[word_id]) for word_id in word_ids]
+
+    while len(nodes) > 1:
+        i = rng.randint(0, len(nodes) - 1)
+        nodes[i:i + 2] = ['({0} {1} {2})'.format(rng.randint(0, 5), nodes[i], nodes[i + 1])]
+
+    return nodes[0]
+
+
+def synthetic_treebank(num_trees, vocabulary_size=5000, min_words=2, max_words=40, seed=42):
+    """ Builds a synthetic treebank.
+
+    The defaults give sentences of 21 words on average, close to the 19 words of SST sentences.
+
+    :param num_trees:
+        Number of trees.
+    :param vocabulary_size:
+        Number of distinct words.
+    :param min_words:
+        Minimum number of words per tree.
+    :param max_words:
+        Maximum number of words per tree.
+    :param seed:
+        Random seed, the same seed gives the same treebank.
+    :return:
+        A list of tree strings.
+    """
+    rng = np.random.RandomState(seed)
+    words = synthetic_vocabulary(vocabulary_size)
+    return [synthetic_tree_string(rng, words, min_words, max_words) for _ in range(num_trees)]
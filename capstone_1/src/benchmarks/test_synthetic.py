@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+#
+# Tests for synthetic treebanks used by the benchmarks.
+#
+
+from src.benchmarks import synthetic
+from src.features.tree import Tree
+
+
+class TestSynthetic(object):
+
+    def test_synthetic_treebank(self):
+        tree_strings = synthetic.synthetic_treebank(20, vocabulary_size=50, min_words=2, max_words=10)
+        assert len(tree_strings) == 20
+
+        for tree_string in tree_strings:
+            t = Tree(tree_string)
+            assert str(t) == tree_string
+            words = t.text().split(' ')
+            assert 2 <= len(words) <= 10
+            assert all(word in synthetic.synthetic_vocabulary(50) for word in words)
+
+    def test_synthetic_treebank_seed(self):
+        assert synthetic.synthetic_treebank(5, seed=1) == synthetic.synthetic_treebank(5, seed=1)
+        assert synthetic.synthetic_treebank(5, seed=1) != synthetic.synthetic_treebank(5, seed=2)
@@ -6,21 +6,25 @@
 # java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer -port 9000 -timeout 15000
 #
 
+import click
 import json
 import logging
 import numpy as np
 from nltk.parse.corenlp import CoreNLPParser, Tree as nltk_tree
+from src.models.profiler import Profiler
 from src.models.rntn import RNTN
 from src.features.tree import Tree as features_tree
 
 
-def predict_model(x, model_name='RNTN_30_tanh_35_5_None_50_0.001_0.01_9645'):
+def predict_model(x, model_name='RNTN_30_tanh_35_5_None_50_0.001_0.01_9645', profiler=None):
     """ Predict model based on input value.
 
     :param x:
         A single review text string. Can be multiple sentences.
     :param model_name:
         Trained model name (should be present in models folder)
+    :param profiler:
+        Optional profiler.Profiler recording the phases of the prediction, see RNTN.predict_proba.
     :return:
         Sentiment label for the text.
     """
@@ -37,7 +41,7 @@ def predict_model(x, model_name='RNTN_30_tanh_35_5_None_50_0.001_0.01_9645'):
 
     # Get predictions
     r = RNTN(model_name=model_name, num_epochs=2)
-    y_pred = r.predict_proba_full_tree_notf(trees)
+    y_pred = r.predict_proba_full_tree_notf(trees, profiler=profiler)
     y = np.argmax(y_pred[-1])
     logging.info('probabilities: {0}'.format(y_pred))
 
@@ -130,3 +134,25 @@ def _update_tree_txt(tree_txt, node_probs):
         idx += 1
 
     return json.dumps(nodes[-1].to_json())
+
+
+@click.command()
+@click.argument('text')
+@click.option('--model-name', default='RNTN_30_tanh_35_5_None_50_0.001_0.01_9645', help='Trained model name.')
+@click.option('--profile', default=None, help='Writes a profile of the prediction to this json file.')
+@click.option('--chrome-trace', is_flag=True, help='Writes the profile as a Chrome trace (chrome://tracing).')
+def main(text, model_name, profile, chrome_trace):
+    """ Predicts the sentiment of a review text. """
+    profiler = Profiler() if profile is not None else None
+
+    y, tree_txt = predict_model(text, model_name=model_name, profiler=profiler)
+    print(y)
+    print(tree_txt)
+
+    if profiler is not None:
+        profiler.save(profile, chrome_trace=chrome_trace)
+        logging.info('Prediction profile written to {0}'.format(profile))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+#
+# profiler.py
+# Phase timings and counters for model training and prediction.
+# Exported as a json summary or a Chrome trace (chrome://tracing).
+#
+
+from collections import Counter, OrderedDict
+import json
+import os
+import threading
+import time
+
+
+class Profiler(object):
+    """ Records the duration of named phases and counters.
+
+    Phases may be nested. Rates of the counters are computed over the total duration of the rate phase,
+    so that the counters of a training run give nodes/sec and trees/sec of its steps.
+    """
+
+    enabled = True
+
+    def __init__(self, rate_phase='step'):
+
+        # Phase used as the time base of the counter rates
+        self.rate_phase = rate_phase
+
+        # Recorded phases as (name, start, duration, thread id)
+        self.events = []
+
+        # Counters by name
+        self.counters = Counter()
+
+        self._origin = time.perf_counter()
+
+    def phase(self, name):
+        """ Context manager recording the duration of a phase.
+
+        :param name:
+            Phase name.
+        :return:
+            A context manager.
+        """
+        return _Phase(self, name)
+
+    def add_phase(self, name, start, duration):
+        """ Records a phase measured outside of phase().
+
+        :param name:
+            Phase name.
+        :param start:
+            Start time in time.perf_counter() seconds.
+        :param duration:
+            Duration in seconds.
+        :return:
+            None.
+        """
+        self.events.append((name, start, duration, threading.get_ident()))
+
+    def count(self, name, value=1):
+        """ Adds value to a counter. """
+        self.counters[name] += value
+
+    def summary(self):
+        """ Summary of the recorded phases and counters.
+
+        :return:
+            A dict with the number of calls, total, mean and max duration of each phase, the counters and
+            the rate of each counter per second of the rate phase.
+        """
+        phases = OrderedDict()
+        for name, _, duration, _ in self.events:
+            phase = phases.setdefault(name, {'count': 0, 'total_sec': 0., 'max_ms': 0.})
+            phase['count'] += 1
+            phase['total_sec'] += duration
+            phase['max_ms'] = max(phase['max_ms'], 1000. * duration)
+
+        for phase in phases.values():
+            phase['mean_ms'] = 1000. * phase['total_sec'] / phase['count']
+
+        rates = OrderedDict()
+        rate_time = phases[self.rate_phase]['total_sec'] if self.rate_phase in phases else 0.
+        if rate_time > 0:
+            for name, value in self.counters.items():
+                rates['{0}_per_sec'.format(name)] = value / rate_time
+
+        return {
+            'phases': phases,
+            'counters': dict(self.counters),
+            'rates': rates
+        }
+
+    def chrome_trace(self):
+        """ Recorded phases in the Chrome trace event format.
+
+        :return:
+            A dict that can be written as json and loaded in chrome://tracing.
+        """
+        pid = os.getpid()
+        trace_events = [
+            {
+                'name': name,
+                'ph': 'X',
+                'ts': 1e6 * (start - self._origin),
+                'dur': 1e6 * duration,
+                'pid': pid,
+                'tid': tid
+            }
+            for name, start, duration, tid in self.events]
+
+        return {
+            'traceEvents': trace_events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'counters': dict(self.counters)}
+        }
+
+    def save(self, path, chrome_trace=False):
+        """ Writes the summary, or the Chrome trace, as json.
+
+        :param path:
+            File path.
+        :param chrome_trace:
+            Writes the Chrome trace instead of the summary.
+        :return:
+            None.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace() if chrome_trace else self.summary(), f, indent=2)
+
+
+class NullProfiler(object):
+    """ Profiler that records nothing. Used when profiling is disabled. """
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def add_phase(self, name, start, duration):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+class _Phase(object):
+    """ Context manager of Profiler.phase. """
+
+    __slots__ = ['profiler', 'name', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_phase(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class _NullPhase(object):
+    """ Context manager of NullProfiler.phase. """
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_phase = _NullPhase()
+
+# Shared disabled profiler
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+#
+# quantize_model.py
+# Exports int8 weights of a trained RNTN model and compares them with the float weights
+# on the dev set of the Stanford Sentiment Treebank.
+#
+
+import click
+import json
+import logging
+import numpy as np
+import os
+import time
+from src.models import rntn_inference
+from src.models.data_manager import DataManager
+from src.models.rntn import RNTN
+
+abs_path = os.path.abspath(os.path.dirname(__file__))
+def_reports_path = os.path.join(abs_path, '../../reports/')
+
+
+def quantize_model(model_name, embedding_size=35, compose_func='tanh', tensor_rank=None, max_trees=None):
+    """ Exports int8 weights for a model and reports their accuracy against the float weights.
+
+    :param model_name:
+        Trained model name (should be present in models folder)
+    :param embedding_size:
+        Word embedding size of the model.
+    :param compose_func:
+        Composition function of the model.
+    :param tensor_rank:
+        Rank of each slice of the tensor of the model, full rank if None.
+    :param max_trees:
+        Number of dev trees to evaluate, all if None.
+    :return:
+        A dict with the accuracy, agreement, size and latency of float and int8 inference.
+    """
+    r = RNTN(model_name=model_name, embedding_size=embedding_size, compose_func=compose_func,
+             tensor_rank=tensor_rank)
+    save_dir = r._get_save_dir()
+
+    sizes = rntn_inference.export_quantized(save_dir, embedding_size, tensor_rank)
+    logging.info('Exported int8 weights of model {0}: {1}'.format(model_name, sizes))
+
+    trees = DataManager().x_dev[:max_trees]
+    tree_dicts = [r._tree_feed_data(tree, 0) for tree in trees]
+    labels = np.concatenate([tree_dict['label'] for tree_dict in tree_dicts])
+    is_root = np.concatenate([tree_dict['is_root'] for tree_dict in tree_dicts])
+
+    report = {
+        'model_name': model_name,
+        'num_trees': len(trees),
+        'num_nodes': len(labels)
+    }
+    probabilities = {}
+
+    for name, quantized in [('float', False), ('int8', True)]:
+        weights = rntn_inference.load_weights(save_dir, quantized=quantized, tensor_rank=tensor_rank)
+
+        start = time.perf_counter()
+        y_prob = np.concatenate([rntn_inference.predict_proba_tree(weights, tree_dict, compose_func)
+                                 for tree_dict in tree_dicts])
+        elapsed = time.perf_counter() - start
+
+        y_pred = np.argmax(y_prob, axis=1)
+        probabilities[name] = y_prob
+        report[name] = {
+            'root_accuracy': float(np.mean(y_pred[is_root] == labels[is_root])),
+            'all_nodes_accuracy': float(np.mean(y_pred == labels)),
+            'weights_bytes': rntn_inference.weights_nbytes(weights),
+            'ms_per_tree': 1000. * elapsed / len(trees)
+        }
+
+    float_pred = np.argmax(probabilities['float'], axis=1)
+    int8_pred = np.argmax(probabilities['int8'], axis=1)
+    report['root_agreement'] = float(np.mean(float_pred[is_root] == int8_pred[is_root]))
+    report['all_nodes_agreement'] = float(np.mean(float_pred == int8_pred))
+    report['max_probability_difference'] = float(np.max(np.abs(probabilities['float'] - probabilities['int8'])))
+
+    report_path = '{0}/{1}-int8.json'.format(def_reports_path, model_name)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info('Quantization report of model {0} written to {1}'.format(model_name, report_path))
+
+    return report
+
+
+@click.command()
+@click.option('--model-name', default='RNTN_30_tanh_35_5_None_50_0.001_0.01_9645', help='Trained model name.')
+@click.option('--embedding-size', default=35, help='Word embedding size of the model.')
+@click.option('--compose-func', default='tanh', help='Composition function of the model.')
+@click.option('--tensor-rank', default=None, type=int, help='Rank of each slice of the tensor of the model.')
+@click.option('--max-trees', default=None, type=int, help='Number of dev trees to evaluate.')
+def main(model_name, embedding_size, compose_func, tensor_rank, max_trees):
+    """ Exports int8 weights of a trained RNTN and prints the accuracy report. """
+    print(json.dumps(quantize_model(model_name, embedding_size, compose_func, tensor_rank, max_trees), indent=2))
+
+
+if __name__ == '__main__':
+    main()
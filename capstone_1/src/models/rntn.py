@@ -15,12 +15,15 @@ import logging
 import os
 import numpy as np
 import pandas as pd
+import time
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.metrics import make_scorer, log_loss, classification_report, confusion_matrix
 from sklearn.preprocessing import OneHotEncoder
 # from sklearn.utils.multiclass import check_classification_targets
 # from sklearn.utils.validation import check_X_y, check_is_fitted, check_array
 from src.models.data_manager import DataManager
+from src.models import rntn_inference
+from src.models.profiler import NULL_PROFILER
 import tensorflow as tf
 
 #
@@ -45,6 +48,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
                  training_rate=0.001,
                  regularization_rate=0.01,
                  label_size=5,
+                 tensor_rank=None,
                  model_name=None
                  ):
 
@@ -73,12 +77,15 @@ class RNTN(BaseEstimator, ClassifierMixin):
         # Label size
         self.label_size = label_size
 
+        # Rank of each slice of the tensor T in the Composition layer. Full rank T if None.
+        self.tensor_rank = tensor_rank
+
         # Model Name
         self.model_name = model_name
 
         logging.info('Model RNTN initialization complete.')
 
-    def fit(self, x, y=None):
+    def fit(self, x, y=None, profiler=None):
         """Fits model to training samples.
         Called by GridSearchCV to train estimators.
 
@@ -105,6 +112,9 @@ class RNTN(BaseEstimator, ClassifierMixin):
             b: bias term for the node of shape [d, 1]
             T: Tensor of dimension [2*d, 2*d, d]. Each T[:,:,i] slice generates a scalar, which is one component of
                 the final word vector of dimension d.
+                With tensor_rank r, each slice is factorized as T[:,:,i] = T_P[:,:,i] * T_Q[:,:,i]' where T_P and
+                T_Q are of dimension [2*d, r, d], so zt[i] = (X' * T_P[:,:,i]) * (T_Q[:,:,i]' * X). This reduces the
+                parameters and cost of the tensor term from 4*d^3 to 4*r*d^2.
             f: Non-linear function specifying the compositionality of the classifier. Relu in this case.
             zs: Standard RNN term input to non-linear function f of shape [d, 1]
             zt: Neural tensor term input to non-linear function f of shape [d, 1]
@@ -117,12 +127,19 @@ class RNTN(BaseEstimator, ClassifierMixin):
             Parsed Trees (training samples) in a 2D ndarray of dim (num_samples, 1).
         :param y:
             Labels provided for supervised training.
+        :param profiler:
+            Optional profiler.Profiler recording the phases of every training step (load_model, feed_build,
+            graph_build, forward, backward, checkpoint), the dev_eval of every epoch and the trees and nodes
+            trained. Nothing is recorded if None.
         :return:
             self (expected by BaseEstimator interface)
         """
 
         logging.info('Model RNTN fit() called on {0} training samples.'.format(x.shape[0]))
 
+        if profiler is None:
+            profiler = NULL_PROFILER
+
         # Create y if necessary
         if y is None:
             x_t = x[:, 0]
@@ -176,58 +193,72 @@ class RNTN(BaseEstimator, ClassifierMixin):
                 x_batch_t = x_batch[:, 0]
 
                 # Initialize a session to run tensorflow operations on a new graph.
-                with tf.Graph().as_default(), tf.Session() as session:
+                with profiler.phase('step'), tf.Graph().as_default(), tf.Session() as session:
 
                     # Create or Load model
                     reset = (epoch == 0 and start_idx == 0)
-                    self._load_model(session, reset)
+                    with profiler.phase('load_model'):
+                        self._load_model(session, reset)
 
                     # Build feed dict
-                    feed_dict = self._build_feed_dict(x_batch_t)
+                    with profiler.phase('feed_build'):
+                        feed_dict = self._build_feed_dict(x_batch_t)
 
                     # Get labels
                     labels = tf.get_default_graph().get_tensor_by_name('Inputs/label:0')
-                    logging.info('Labels distribution: {0}'.format(Counter(labels.eval(feed_dict))))
+                    logging.info('Labels distribution: {0}'.format(Counter(feed_dict[labels])))
 
                     # Get length of the tensor array
-                    n = tf.squeeze(tf.shape(labels)).eval(feed_dict)
+                    n = len(feed_dict[labels])
                     logging.info('Feed Dict has {0} labels'.format(n))
 
-                    # Build batch graph
-                    logits = self._build_batch_graph(self.get_word, self._get_compose_func())
+                    with profiler.phase('graph_build'):
+                        # Build batch graph
+                        logits = self._build_batch_graph(self.get_word, self._get_compose_func())
 
-                    # Weights found by manual exploration of all nodes in the graph
-                    # weights = tf.get_default_graph().get_tensor_by_name('Inputs/weight:0')
-                    weights = tf.ones_like(labels, dtype=tf.float32)
+                        # Weights found by manual exploration of all nodes in the graph
+                        # weights = tf.get_default_graph().get_tensor_by_name('Inputs/weight:0')
+                        weights = tf.ones_like(labels, dtype=tf.float32)
 
-                    # Balanced Loss tensor
-                    # weighted_loss_tensor = self._max_margin_loss(labels, logits, weights, feed_dict)
-                    weighted_loss_tensor = self._balanced_cross_entropy_loss(labels, logits, weights, feed_dict)
-
-                    weighted_epoch_loss = weighted_loss_tensor.eval(feed_dict)
-                    logging.info('Training Loss = {0}'.format(weighted_epoch_loss))
-                    total_loss += weighted_epoch_loss
+                        # Balanced Loss tensor
+                        # weighted_loss_tensor = self._max_margin_loss(labels, logits, weights)
+                        weighted_loss_tensor = self._balanced_cross_entropy_loss(labels, logits, weights, feed_dict)
 
-                    # Update training loss with the weighted loss
-                    self._record_training_loss(weighted_loss_tensor, feed_dict, start_idx == 0)
+                        # Update training loss with the weighted loss
+                        total_loss_record = self._record_training_loss(weighted_loss_tensor, start_idx == 0)
 
-                    # Update training accuracy
-                    self._record_training_accuracy(labels, logits, n, feed_dict, start_idx == 0)
+                        # Update training accuracy
+                        accuracy_record = self._record_training_accuracy(labels, logits, n, start_idx == 0)
 
-                    # Build optimizer graph
-                    # Create optimizer
-                    all_variables = set(tf.all_variables())
-                    optimization_tensor = tf.train.AdagradOptimizer(curr_training_rate).minimize(weighted_loss_tensor)
-                    # I honestly don't know how else to initialize adagrad in TensorFlow.
-                    session.run(tf.initialize_variables(set(tf.all_variables()) - all_variables))
+                        # Build optimizer graph
+                        # Create optimizer
+                        all_variables = set(tf.all_variables())
+                        optimization_tensor = tf.train.AdagradOptimizer(curr_training_rate) \
+                            .minimize(weighted_loss_tensor)
+                        # I honestly don't know how else to initialize adagrad in TensorFlow.
+                        session.run(tf.initialize_variables(set(tf.all_variables()) - all_variables))
 
                     # Train
-                    # Invoke the graph for optimizer this feed dict.
-                    session.run([optimization_tensor], feed_dict=feed_dict)
+                    # Invoke the graph for optimizer and training metrics on this feed dict in a single run.
+                    _, weighted_epoch_loss, total_loss_val, (cum_sum_logits_val, accuracy_val) = \
+                        self._run_training_step(
+                            session,
+                            [optimization_tensor, weighted_loss_tensor, total_loss_record, accuracy_record],
+                            feed_dict,
+                            profiler)
+                    logging.info('Training Loss = {0}'.format(weighted_epoch_loss))
+                    logging.info('Updated total training loss: {0}'.format(total_loss_val))
+                    logging.info('Updated total sum logits: {0}'.format(cum_sum_logits_val))
+                    logging.info('Updated total training accuracy: {0}'.format(accuracy_val))
+                    total_loss += weighted_epoch_loss
 
                     # Save model after full run
                     # Fit will always overwrite any model
-                    self._save_model(session)
+                    with profiler.phase('checkpoint'):
+                        self._save_model(session)
+
+                    profiler.count('trees', len(x_batch_t))
+                    profiler.count('nodes', n)
 
                 start_idx += len(x_batch_t)
                 logging.info('Processed {0} trees. '.format(start_idx))
@@ -235,7 +266,8 @@ class RNTN(BaseEstimator, ClassifierMixin):
             logging.info('Total Training Loss: {0} for epoch {1}'.format(total_loss, epoch))
 
             # Log variables to tensorboard
-            dev_loss = self._record_epoch_metrics(epoch)
+            with profiler.phase('dev_eval'):
+                dev_loss = self._record_epoch_metrics(epoch)
 
             if epoch > 0:
                 # Change learning rate
@@ -250,15 +282,19 @@ class RNTN(BaseEstimator, ClassifierMixin):
             prev_dev_loss = dev_loss
 
         logging.info('Model {0} Training Complete.'.format(self.model_name))
+        if profiler.enabled:
+            logging.info('Model {0} training profile: {1}'.format(self.model_name, profiler.summary()))
 
         # Return self to conform to interface spec.
         return self
 
-    def predict(self, x):
+    def predict(self, x, profiler=None):
         """ Predicts class labels for each element in x.
 
         :param x:
             An array where each element is a tree.
+        :param profiler:
+            Optional profiler.Profiler, see predict_proba.
         :return:
             Predicted class label for the tree.
         """
@@ -272,7 +308,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
 
         logging.info('Model RNTN predict() called on {0} testing samples.'.format(len(x)))
 
-        y_class_prob = self.predict_proba(x)
+        y_class_prob = self.predict_proba(x, profiler)
 
         # Get maximum arg val for the class probabilities.
         y_pred = np.argmax(y_class_prob, axis=-1)
@@ -280,12 +316,15 @@ class RNTN(BaseEstimator, ClassifierMixin):
         logging.info('Model RNTN predict() completed.')
         return y_pred
 
-    def predict_proba(self, x):
+    def predict_proba(self, x, profiler=None):
         """ Computes softmax log probabilities for given x.
         Scikit-learn will call this while using self.loss.
 
         :param x:
             An 2d ndarray where each element is a tree.
+        :param profiler:
+            Optional profiler.Profiler recording the phases of the prediction (load_model, feed_build,
+            graph_build, forward) and the trees and nodes predicted. Nothing is recorded if None.
         :return:
             Softmax probabilities of each class.
         """
@@ -296,14 +335,19 @@ class RNTN(BaseEstimator, ClassifierMixin):
         # Load vocabulary
         self._load_vocabulary()
 
+        if profiler is None:
+            profiler = NULL_PROFILER
+
         # Initialize a session to run tensorflow operations on a new graph.
-        with tf.Graph().as_default(), tf.Session() as session:
+        with profiler.phase('step'), tf.Graph().as_default(), tf.Session() as session:
 
             # Load model
-            self._load_model(session)
+            with profiler.phase('load_model'):
+                self._load_model(session)
 
             # Build feed dict
-            feed_dict = self._build_feed_dict(x)
+            with profiler.phase('feed_build'):
+                feed_dict = self._build_feed_dict(x)
 
             # Build logit functions
             # Get labels
@@ -311,18 +355,23 @@ class RNTN(BaseEstimator, ClassifierMixin):
             is_root = tf.get_default_graph().get_tensor_by_name('Inputs/is_root:0')
 
             # Get length of the tensor array
-            n = tf.squeeze(tf.shape(labels)).eval(feed_dict)
+            n = len(feed_dict[labels])
             logging.info('Feed Dict has {0} labels'.format(n))
 
-            # Build batch graph
-            logits = self._build_batch_graph(self.get_word, self._get_compose_func())
-            root_logits = tf.gather(logits, tf.where(is_root))
+            with profiler.phase('graph_build'):
+                # Build batch graph
+                logits = self._build_batch_graph(self.get_word, self._get_compose_func())
+                root_logits = tf.gather(logits, tf.where(is_root))
 
-            # Get softmax probabilities for the tensors.
-            y = tf.squeeze(tf.nn.softmax(root_logits))
+                # Get softmax probabilities for the tensors.
+                y = tf.squeeze(tf.nn.softmax(root_logits))
 
             # Evaluate arg vals
-            y_prob = y.eval(feed_dict)
+            with profiler.phase('forward'):
+                y_prob = session.run(y, feed_dict=feed_dict)
+
+            profiler.count('trees', len(x))
+            profiler.count('nodes', n)
 
         logging.info('Model RNTN predict_proba() returned.')
         return y_prob
@@ -393,7 +442,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
         return False, num_bad_epochs
 
     @staticmethod
-    def _build_model_graph_var(embedding_size, vocabulary_size, label_size):
+    def _build_model_graph_var(embedding_size, vocabulary_size, label_size, tensor_rank=None):
         """ Builds Computational Graph for model state in Tensorflow.
 
         Defines and initializes the following:
@@ -402,6 +451,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
             W: Weights to be computed by the model of shape [d, 2*d] for Composition step.
             T: Tensor of dimension [2*d, 2*d, d]. Each T[:,:,i] slice generates a scalar, which is one component of
                 the final word vector of dimension d.
+                Replaced by the factors T_P and T_Q of dimension [2*d, r, d] if tensor_rank r is given.
             b: bias term for the node of shape [d, 1]
             U: Weights to be computed by model for Projection Step of shape [d, label_size] where label_size
                 is the number of classes.
@@ -419,6 +469,8 @@ class RNTN(BaseEstimator, ClassifierMixin):
             Vocabulary size
         :param label_size:
             Label size
+        :param tensor_rank:
+            Rank of each slice of T, full rank if None.
         :return:
             None.
         """
@@ -443,9 +495,18 @@ class RNTN(BaseEstimator, ClassifierMixin):
                                 shape=[embedding_size, 1],
                                 trainable=True)
 
-            _ = tf.get_variable(name='T',
-                                shape=[2 * embedding_size, 2 * embedding_size, embedding_size],
-                                trainable=True)
+            if tensor_rank is None:
+                _ = tf.get_variable(name='T',
+                                    shape=[2 * embedding_size, 2 * embedding_size, embedding_size],
+                                    trainable=True)
+            else:
+                _ = tf.get_variable(name='T_P',
+                                    shape=[2 * embedding_size, tensor_rank, embedding_size],
+                                    trainable=True)
+
+                _ = tf.get_variable(name='T_Q',
+                                    shape=[2 * embedding_size, tensor_rank, embedding_size],
+                                    trainable=True)
 
         # Build Weights and bias term for Projection Layer
         with tf.variable_scope('Projection', reuse=tf.AUTO_REUSE):
@@ -550,8 +611,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
         return word_col
 
     # Function to build composition function for a single non leaf node
-    @staticmethod
-    def compose_func_helper(x):
+    def compose_func_helper(self, x):
         """ Composes graph for intermediate nodes.
 
         :param x:
@@ -563,15 +623,27 @@ class RNTN(BaseEstimator, ClassifierMixin):
         with tf.variable_scope('Composition', reuse=True):
             w = tf.get_variable('W')
             b = tf.get_variable('b')
-            t = tf.get_variable('T')
 
         # zs = W * X + b
         zs = tf.add(tf.matmul(w, x), b)
 
-        # zt = X' * T * X
-        m1 = tf.tensordot(t, x, [[1], [0]])
-        m2 = tf.tensordot(x, m1, [[0], [0]])
-        zt = tf.expand_dims(tf.squeeze(m2), axis=1)
+        if self.tensor_rank is None:
+            with tf.variable_scope('Composition', reuse=True):
+                t = tf.get_variable('T')
+
+            # zt = X' * T * X
+            m1 = tf.tensordot(t, x, [[1], [0]])
+            m2 = tf.tensordot(x, m1, [[0], [0]])
+            zt = tf.expand_dims(tf.squeeze(m2), axis=1)
+        else:
+            with tf.variable_scope('Composition', reuse=True):
+                t_p = tf.get_variable('T_P')
+                t_q = tf.get_variable('T_Q')
+
+            # zt = sum over rank of (X' * T_P) * (T_Q' * X)
+            p = tf.tensordot(t_p, x, [[0], [0]])
+            q = tf.tensordot(t_q, x, [[0], [0]])
+            zt = tf.reduce_sum(tf.multiply(p, q), axis=0)
 
         # a = zs + zt
         a = tf.add(zs, zt)
@@ -701,7 +773,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
         """
         return lambda x: tf.multiply(tf.nn.l2_loss(x), regularization_rate)
 
-    def _max_margin_loss(self, labels, logits, weights, feed_dict):
+    def _max_margin_loss(self, labels, logits, weights):
         """ Builds loss function graph.
 
         Computes the max margin loss for sentiment prediction values.
@@ -719,7 +791,6 @@ class RNTN(BaseEstimator, ClassifierMixin):
         probabilities = tf.squeeze(tf.nn.softmax(logits))
         indices = tf.stack([tf.range(tf.shape(labels)[0], dtype=labels.dtype), labels], axis=1)
         pos_score = tf.gather_nd(probabilities, indices)
-        logging.info('Pos Score: {0}'.format(tf.reduce_sum(pos_score).eval(feed_dict)))
 
         bad_labels_1 = tf.random_uniform(tf.shape(labels), 0, self.label_size, dtype=tf.int32)
         indices = tf.stack([tf.range(tf.shape(bad_labels_1)[0], dtype=bad_labels_1.dtype), bad_labels_1], axis=1)
@@ -730,22 +801,19 @@ class RNTN(BaseEstimator, ClassifierMixin):
         neg_score_2 = tf.gather_nd(probabilities, indices)
 
         neg_score = tf.add(neg_score_1, neg_score_2)
-        logging.info('Neg Score: {0}'.format(tf.reduce_sum(neg_score).eval(feed_dict)))
 
         # Max Margin loss
         total_score = tf.multiply(tf.add(1., tf.subtract(neg_score, pos_score)), weights)
         max_margin_loss = tf.reduce_sum(tf.maximum(0., total_score))
-        logging.info('Max Margin Loss: {0}'.format(tf.reduce_sum(max_margin_loss).eval(feed_dict)))
         mean_loss = tf.divide(max_margin_loss, tf.reduce_sum(weights))
 
         regularization_loss = self._regularization_loss()
-        logging.info('Regularization Loss: {0}'.format(regularization_loss.eval(feed_dict)))
 
         # Return Total Loss
         total_loss = tf.add(mean_loss, regularization_loss)
         return total_loss
 
-    def _build_loss_graph(self, labels, logits, weights, feed_dict):
+    def _build_loss_graph(self, labels, logits, weights):
         """ Builds loss function graph for cross-validation.
 
         :param labels:
@@ -765,7 +833,6 @@ class RNTN(BaseEstimator, ClassifierMixin):
         # logits_chosen = tf.gather(logits, idx)
 
         mean_loss = self._mean_cross_entropy_loss(labels, logits, weights)
-        logging.info('Mean Cross Entropy Loss: {0}'.format(mean_loss.eval(feed_dict)))
 
         # regularization_loss = self._regularization_loss()
         # logging.info('Regularization Loss: {0}'.format(regularization_loss.eval(feed_dict)))
@@ -785,7 +852,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
                                                         reduction=tf.losses.Reduction.NONE)
 
         # Random under sampling
-        y = labels.eval(feed_dict)
+        y = np.asarray(feed_dict[labels])
         x = np.asarray(list(range(len(y)))).reshape(-1, 1)
         ros = RandomOverSampler(random_state=42)
         x_keep, _ = ros.fit_resample(x, y)
@@ -793,10 +860,8 @@ class RNTN(BaseEstimator, ClassifierMixin):
         cross_entropy_keep = tf.gather(cross_entropy, x_keep.reshape(-1))
 
         cross_entropy_loss = tf.divide(tf.reduce_sum(cross_entropy_keep), len(x_keep))
-        logging.info('Cross Entropy Loss: {0}'.format(cross_entropy_loss.eval(feed_dict)))
 
         regularization_loss = self._regularization_loss()
-        logging.info('Regularization Loss: {0}'.format(regularization_loss.eval(feed_dict)))
 
         # Return Total Loss
         total_loss = tf.add(cross_entropy_loss, regularization_loss)
@@ -822,14 +887,14 @@ class RNTN(BaseEstimator, ClassifierMixin):
 
         with tf.variable_scope('Composition', reuse=True):
             w = tf.get_variable('W')
-            t = tf.get_variable('T')
+            t = [tf.get_variable(name) for name in self._get_tensor_names()]
 
         with tf.variable_scope('Projection', reuse=True):
             u = tf.get_variable('U')
 
         regularization_func = self._regularization_l2_func(self.regularization_rate)
         regularization_embedding_loss = regularization_func(embeddings)
-        regularization_composition_loss = tf.add(regularization_func(w), regularization_func(t))
+        regularization_composition_loss = tf.add_n([regularization_func(w)] + [regularization_func(t_i) for t_i in t])
         regularization_projection_loss = regularization_func(u)
         regularization_loss = tf.add(regularization_embedding_loss,
                                      tf.add(regularization_composition_loss, regularization_projection_loss))
@@ -1151,7 +1216,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
         self._build_model_placeholders()
 
         # Build model graph
-        self._build_model_graph_var(self.embedding_size, self.V_, self.label_size)
+        self._build_model_graph_var(self.embedding_size, self.V_, self.label_size, self.tensor_rank)
 
         # Build logging variables
         self._build_model_logging_var()
@@ -1195,12 +1260,15 @@ class RNTN(BaseEstimator, ClassifierMixin):
         e = tf.get_default_graph().get_tensor_by_name('Embeddings/L:0')
         w = tf.get_default_graph().get_tensor_by_name('Composition/W:0')
         b = tf.get_default_graph().get_tensor_by_name('Composition/b:0')
-        t = tf.get_default_graph().get_tensor_by_name('Composition/T:0')
         u = tf.get_default_graph().get_tensor_by_name('Projection/U:0')
         bs = tf.get_default_graph().get_tensor_by_name('Projection/bs:0')
-        t_s = tf.reshape(t, [self.embedding_size*2, self.embedding_size*2*self.embedding_size])
 
-        e_v, w_v, b_v, t_v, u_v, bs_v = session.run([e, w, b, t_s, u, bs])
+        # Tensor (or its factors) reshaped to [2d, 2d*d] (or [2d, r*d])
+        t_names = self._get_tensor_names()
+        t_s = [tf.reshape(tf.get_default_graph().get_tensor_by_name('Composition/{0}:0'.format(name)),
+                          [self.embedding_size*2, -1]) for name in t_names]
+
+        e_v, w_v, b_v, u_v, bs_v, t_v = session.run([e, w, b, u, bs, t_s])
 
         save_dir_path = self._get_save_dir()
         np.save('{0}/L.npy'.format(save_dir_path), e_v)
@@ -1208,13 +1276,24 @@ class RNTN(BaseEstimator, ClassifierMixin):
         np.save('{0}/b.npy'.format(save_dir_path), b_v)
         np.save('{0}/U.npy'.format(save_dir_path), u_v)
         np.save('{0}/bs.npy'.format(save_dir_path), bs_v)
-        np.save('{0}/T.npy'.format(save_dir_path), t_v)
+        for name, value in zip(t_names, t_v):
+            np.save('{0}/{1}.npy'.format(save_dir_path, name), value)
+
+    def _get_tensor_names(self):
+        """ Names of the tensor variables of the Composition layer.
+
+        :return:
+            ['T'] for a full rank tensor or ['T_P', 'T_Q'] for a factorized tensor.
+        """
+        return rntn_inference.get_tensor_names(self.tensor_rank)
 
-    def predict_proba_full_tree(self, x):
+    def predict_proba_full_tree(self, x, profiler=None):
         """ Computes the prediction for each node in the tree.
 
         :param x:
             An 2d ndarray where each element is a tree.
+        :param profiler:
+            Optional profiler.Profiler, see predict_proba.
         :return y_prob:
             Softmax probabilities of each class for each tree node.
         """
@@ -1225,40 +1304,54 @@ class RNTN(BaseEstimator, ClassifierMixin):
         # Load vocabulary
         self._load_vocabulary()
 
+        if profiler is None:
+            profiler = NULL_PROFILER
+
         # Initialize a session to run tensorflow operations on a new graph.
-        with tf.Graph().as_default(), tf.Session() as session:
+        with profiler.phase('step'), tf.Graph().as_default(), tf.Session() as session:
 
             # Load model
-            self._load_model(session)
+            with profiler.phase('load_model'):
+                self._load_model(session)
 
             # Build feed dict
-            feed_dict = self._build_feed_dict(x)
+            with profiler.phase('feed_build'):
+                feed_dict = self._build_feed_dict(x)
 
             # Build logit functions
             # Get labels
             labels = tf.get_default_graph().get_tensor_by_name('Inputs/label:0')
 
             # Get length of the tensor array
-            n = tf.squeeze(tf.shape(labels)).eval(feed_dict)
+            n = len(feed_dict[labels])
             logging.info('Feed Dict has {0} labels'.format(n))
 
-            # Build batch graph
-            logits = self._build_batch_graph(self.get_word, self._get_compose_func())
+            with profiler.phase('graph_build'):
+                # Build batch graph
+                logits = self._build_batch_graph(self.get_word, self._get_compose_func())
 
-            # Get softmax probabilities for the tensors.
-            y = tf.squeeze(tf.nn.softmax(logits))
+                # Get softmax probabilities for the tensors.
+                y = tf.squeeze(tf.nn.softmax(logits))
 
             # Evaluate values
-            y_prob = y.eval(feed_dict)
+            with profiler.phase('forward'):
+                y_prob = session.run(y, feed_dict=feed_dict)
+
+            profiler.count('trees', len(x))
+            profiler.count('nodes', n)
 
         logging.info('Model RNTN predict_full_tree() returned.')
         return y_prob
 
-    def predict_proba_full_tree_notf(self, x):
+    def predict_proba_full_tree_notf(self, x, quantized=False, profiler=None):
         """ Computes the prediction for each node in the tree without using tensorflow.
 
         :param x:
             An 2d ndarray where each element is a tree.
+        :param quantized:
+            Uses the int8 word embeddings and tensor written by rntn_inference.export_quantized.
+        :param profiler:
+            Optional profiler.Profiler, see predict_proba.
         :return y_prob:
             Softmax probabilities of each class for each tree node.
         """
@@ -1266,56 +1359,30 @@ class RNTN(BaseEstimator, ClassifierMixin):
         logging.info('Model RNTN predict_full_tree_notf() called on {0} testing samples.'.format(x.shape[0]))
         x = x[:, 0]
 
-        # Load vocabulary
-        self._load_vocabulary()
+        if profiler is None:
+            profiler = NULL_PROFILER
 
-        # Get save dir
-        save_dir = self._get_save_dir()
-        e = np.load('{0}/L.npy'.format(save_dir))
-        w = np.load('{0}/W.npy'.format(save_dir))
-        b = np.load('{0}/b.npy'.format(save_dir))
-        u = np.load('{0}/U.npy'.format(save_dir))
-        bs = np.load('{0}/bs.npy'.format(save_dir))
+        with profiler.phase('step'):
+            # Load vocabulary and exported weights
+            with profiler.phase('load_model'):
+                self._load_vocabulary()
+                weights = rntn_inference.load_weights(self._get_save_dir(), quantized=quantized,
+                                                      tensor_rank=self.tensor_rank)
 
-        t_s = np.load('{0}/T.npy'.format(save_dir))
-        t = t_s.reshape(self.embedding_size*2, self.embedding_size*2, self.embedding_size)
+            y_prob = []
 
-        y_prob = []
+            for tree in range(len(x)):
+                # Build tree dict
+                with profiler.phase('feed_build'):
+                    tree_dict = self._tree_feed_data(x[tree], 0)
 
-        for tree in range(len(x)):
-            # Build tree dict
-            tree_dict = self._tree_feed_data(x[tree], 0)
+                # Get softmax probabilities
+                with profiler.phase('forward'):
+                    y_prob.extend(rntn_inference.predict_proba_tree(weights, tree_dict, self.compose_func))
 
-            # Get word vectors
-            word_vecs = np.zeros([self.embedding_size, len(tree_dict['label'])])
+                profiler.count('nodes', len(tree_dict['label']))
 
-            def get_word_vec(idx):
-                if tree_dict['is_leaf'][idx]:
-                    # return word embedding
-                    word_vecs[:, idx] = e[:, tree_dict['word_index'][idx]]
-                else:
-                    # compose
-                    left_v = word_vecs[:, tree_dict['left_child'][idx]]
-                    right_v = word_vecs[:, tree_dict['right_child'][idx]]
-                    x_c = np.concatenate([left_v, right_v])
-                    zs = np.matmul(w, x_c) + b.reshape(-1)
-                    zd = np.zeros([self.embedding_size])
-                    for i in range(self.embedding_size):
-                        t_i = t[:, :, i]
-                        zd[i] = np.matmul(np.matmul(np.transpose(x_c), t_i), x_c)
-                    a = zs + zd
-                    word_vecs[:, idx] = np.tanh(a)
-
-            # Get logits
-            logits = np.zeros([len(tree_dict['label']), self.label_size])
-            for node in range(len(tree_dict['label'])):
-                get_word_vec(node)
-                projection = np.matmul(np.transpose(u), word_vecs[:, node]) + bs.reshape(-1)
-                logits[node, :] = np.transpose(projection)
-
-            # Get softmax and then predictions
-            y_prob_tree = [np.exp(logit) / sum(np.exp(logit)) for logit in logits]
-            y_prob.extend(y_prob_tree)
+            profiler.count('trees', len(x))
 
         logging.info('Model RNTN predict_proba_full_tree_notf() returned.')
         return y_prob
@@ -1355,17 +1422,38 @@ class RNTN(BaseEstimator, ClassifierMixin):
         return y_pred
 
     @staticmethod
-    def _record_training_loss(loss, feed_dict, reset=False):
+    def _record_training_loss(loss, reset=False):
+        """ Builds the update of the total training loss of the epoch.
+
+        :param loss:
+            Loss tensor of the batch.
+        :param reset:
+            Restarts the total at the first batch of an epoch.
+        :return:
+            Tensor evaluating to the updated total loss.
+        """
         train_epoch_loss_val = tf.get_default_graph().get_tensor_by_name('Logging/train_epoch_loss_val:0')
         if reset:
             # Reset total loss for start of every epoch
-            train_epoch_loss_val = tf.assign(train_epoch_loss_val, loss)
-        else:
-            # Update total loss
-            train_epoch_loss_val = tf.assign_add(train_epoch_loss_val, loss)
-        logging.info('Updated total training loss: {0}'.format(train_epoch_loss_val.eval(feed_dict)))
+            return tf.assign(train_epoch_loss_val, loss)
+
+        # Update total loss
+        return tf.assign_add(train_epoch_loss_val, loss)
 
-    def _record_training_accuracy(self, labels, logits, n, feed_dict, reset=False):
+    def _record_training_accuracy(self, labels, logits, n, reset=False):
+        """ Builds the update of the training accuracy of the epoch.
+
+        :param labels:
+            Ground truth labels.
+        :param logits:
+            Logits (unscaled probabilities) for every node.
+        :param n:
+            Number of nodes in the batch.
+        :param reset:
+            Restarts the accuracy at the first batch of an epoch.
+        :return:
+            A tuple of tensors evaluating to the updated number of nodes and accuracy.
+        """
         train_epoch_cum_sum_logits = tf.get_default_graph() \
             .get_tensor_by_name('Logging/train_epoch_cum_sum_logits:0')
         train_epoch_accuracy_val = tf.get_default_graph() \
@@ -1383,20 +1471,65 @@ class RNTN(BaseEstimator, ClassifierMixin):
             train_epoch_accuracy_val = tf.assign(train_epoch_accuracy_val, accuracy)
         else:
             # Update total accuracy
-            past_y_n = train_epoch_cum_sum_logits.eval(feed_dict)
-            past_y_pred_sum = tf.multiply(train_epoch_accuracy_val,
-                                          tf.constant(past_y_n, dtype=tf.float32))
+            past_y_n = tf.cast(train_epoch_cum_sum_logits, tf.float32)
+            past_y_pred_sum = tf.multiply(train_epoch_accuracy_val, past_y_n)
             total_y_pred_sum = tf.add(past_y_pred_sum, curr_y_pred_sum)
-            train_epoch_cum_sum_logits = tf.assign_add(train_epoch_cum_sum_logits,
-                                                       tf.constant(n, dtype=tf.int32))
             cumulative_accuracy = tf.divide(total_y_pred_sum,
-                                            tf.constant(past_y_n + n, dtype=tf.float32))
-            train_epoch_accuracy_val = tf.assign(train_epoch_accuracy_val, cumulative_accuracy)
+                                            tf.add(past_y_n, tf.constant(n, dtype=tf.float32)))
+
+            # Read the past values before updating them
+            with tf.control_dependencies([cumulative_accuracy]):
+                train_epoch_cum_sum_logits = tf.assign_add(train_epoch_cum_sum_logits,
+                                                           tf.constant(n, dtype=tf.int32))
+                train_epoch_accuracy_val = tf.assign(train_epoch_accuracy_val, cumulative_accuracy)
+
+        return train_epoch_cum_sum_logits, train_epoch_accuracy_val
+
+    @staticmethod
+    def _run_training_step(session, fetches, feed_dict, profiler):
+        """ Runs a training step.
+
+        With an enabled profiler, the op timings of the run are traced and the duration of the run is recorded
+        as a forward and a backward phase, split by the time spent in gradient and optimizer ops. Tracing adds
+        some overhead to the run, so the phases of profiled runs are slightly longer than unprofiled ones.
+
+        :param session:
+            Valid session object.
+        :param fetches:
+            Fetches of the run, including the optimizer.
+        :param feed_dict:
+            Feed dict of the batch.
+        :param profiler:
+            profiler.Profiler or NULL_PROFILER.
+        :return:
+            Values of the fetches.
+        """
+        if not profiler.enabled:
+            return session.run(fetches, feed_dict=feed_dict)
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE)
+        run_metadata = tf.RunMetadata()
+
+        start = time.perf_counter()
+        values = session.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        duration = time.perf_counter() - start
+
+        # Op time spent in the forward pass and in the backward pass and update
+        forward_micros = 0
+        backward_micros = 0
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                if node_stats.node_name.startswith(('gradients', 'Adagrad')):
+                    backward_micros += node_stats.all_end_rel_micros
+                else:
+                    forward_micros += node_stats.all_end_rel_micros
 
-        logging.info('Updated total sum logits: {0}'.format(
-            train_epoch_cum_sum_logits.eval(feed_dict)))
-        logging.info('Updated total training accuracy: {0}'.format(
-            train_epoch_accuracy_val.eval(feed_dict)))
+        op_micros = forward_micros + backward_micros
+        forward = duration * forward_micros / op_micros if op_micros > 0 else duration
+        profiler.add_phase('forward', start, forward)
+        profiler.add_phase('backward', start + forward, duration - forward)
+
+        return values
 
     def _record_epoch_metrics(self, epoch):
         """ Evaluate current epoch metrics.
@@ -1424,7 +1557,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
             labels = tf.get_default_graph().get_tensor_by_name('Inputs/label:0')
 
             # Get length of the tensor array
-            n = tf.squeeze(tf.shape(labels)).eval(feed_dict)
+            n = len(feed_dict[labels])
             logging.info('Feed Dict has {0} labels'.format(n))
 
             # Build batch graph
@@ -1441,13 +1574,11 @@ class RNTN(BaseEstimator, ClassifierMixin):
             weights = tf.ones_like(labels, dtype=tf.float32)
 
             # Build loss graph
-            loss_tensor = self._build_loss_graph(labels, logits, weights, feed_dict)
+            loss_tensor = self._build_loss_graph(labels, logits, weights)
 
             # Update loss
             dev_epoch_loss_val = tf.get_default_graph().get_tensor_by_name('Logging/dev_epoch_loss_val:0')
             dev_epoch_loss_val = tf.assign(dev_epoch_loss_val, loss_tensor)
-            rec_loss_val = dev_epoch_loss_val.eval(feed_dict)
-            logging.info('Cross Validation Loss after optimization = {0}'.format(rec_loss_val))
 
             # Get predictions for the tensors.
             y_pred = self._predict_from_logits(logits)
@@ -1457,8 +1588,12 @@ class RNTN(BaseEstimator, ClassifierMixin):
 
             dev_epoch_accuracy_val = tf.get_default_graph().get_tensor_by_name('Logging/dev_epoch_accuracy_val:0')
             dev_epoch_accuracy_val = tf.assign(dev_epoch_accuracy_val, accuracy)
-            logging.info('Cross Validation Accuracy after optimization = {0}'.format(
-                dev_epoch_accuracy_val.eval(feed_dict)))
+
+            # Evaluate loss, accuracy and predictions in a single run
+            rec_loss_val, rec_accuracy_val, y_pred_val = session.run(
+                [dev_epoch_loss_val, dev_epoch_accuracy_val, y_pred], feed_dict=feed_dict)
+            logging.info('Cross Validation Loss after optimization = {0}'.format(rec_loss_val))
+            logging.info('Cross Validation Accuracy after optimization = {0}'.format(rec_accuracy_val))
 
             # Record Summary operation
             merge = tf.summary.merge_all()
@@ -1473,8 +1608,7 @@ class RNTN(BaseEstimator, ClassifierMixin):
             training_writer.add_summary(summary, epoch)
 
             # Record metrics to log
-            y_pred_val = y_pred.eval(feed_dict)
-            y_true = labels_int.eval(feed_dict)
+            y_true = np.asarray(feed_dict[labels])
             logging.info(classification_report(y_true, y_pred_val))
             logging.info(confusion_matrix(y_true, y_pred_val))
 
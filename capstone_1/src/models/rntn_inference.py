@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+#
+# rntn_inference.py
+# Inference with exported RNTN weights using numpy only.
+# Supports full rank and low rank tensors, as float or per slice int8 quantized weights.
+#
+
+import numpy as np
+
+# Largest magnitude of a symmetric int8 value
+INT8_MAX = 127
+
+# Exported weight files besides the tensor of the Composition layer
+WEIGHT_NAMES = ['L', 'W', 'b', 'U', 'bs']
+
+
+def get_tensor_names(tensor_rank=None):
+    """ Names of the exported tensor of the Composition layer.
+
+    :param tensor_rank:
+        Rank of each slice of the tensor, full rank if None.
+    :return:
+        ['T'] for a full rank tensor or ['T_P', 'T_Q'] for the factors of a low rank tensor.
+    """
+    if tensor_rank is None:
+        return ['T']
+    return ['T_P', 'T_Q']
+
+
+def quantize(x, axis):
+    """ Symmetric int8 quantization with one scale per slice along an axis.
+
+    :param x:
+        Float array to quantize.
+    :param axis:
+        Axis holding the slices. Each slice x.take(i, axis) is scaled by its own max absolute value.
+    :return:
+        A tuple (q, scale) where q is an int8 array of the shape of x and scale is a float32 array of
+        length x.shape[axis], such that x is approximated by q * scale along axis.
+    """
+    reduce_axes = tuple(i for i in range(x.ndim) if i != axis)
+    scale = np.max(np.abs(x), axis=reduce_axes, keepdims=True) / INT8_MAX
+
+    # All zero slices stay zero
+    scale[scale == 0] = 1.
+
+    q = np.clip(np.round(x / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return q, scale.reshape(-1).astype(np.float32)
+
+
+def dequantize(q, scale, axis):
+    """ Reverses quantize.
+
+    :param q:
+        Int8 array.
+    :param scale:
+        Scale of each slice along axis.
+    :param axis:
+        Axis holding the slices.
+    :return:
+        Float32 array of the shape of q.
+    """
+    shape = [1] * q.ndim
+    shape[axis] = -1
+    return q.astype(np.float32) * scale.reshape(shape)
+
+
+def export_quantized(save_dir, embedding_size, tensor_rank=None):
+    """ Writes int8 versions of the exported word embeddings L and tensor T next to the float weights.
+
+    L [d, V] gets one scale per word, T gets one scale per slice T[:, :, k] that computes component k of the
+    tensor term. T keeps the [2d, 2d * d] layout of T.npy. The factors T_P and T_Q of a low rank tensor are
+    quantized the same way, with one scale per slice T_P[:, :, k] and T_Q[:, :, k].
+
+    :param save_dir:
+        Directory of the exported float weights.
+    :param embedding_size:
+        Word embedding size d of the model.
+    :param tensor_rank:
+        Rank of each slice of the tensor, full rank if None.
+    :return:
+        A dict with the number of bytes of the float and quantized arrays.
+    """
+    d = embedding_size
+    sizes = {'float_bytes': 0, 'int8_bytes': 0}
+
+    for name in ['L'] + get_tensor_names(tensor_rank):
+        x = np.load('{0}/{1}.npy'.format(save_dir, name))
+        if name == 'L':
+            x_q, x_scale = quantize(x, axis=1)
+        else:
+            x_q, x_scale = quantize(x.reshape(2 * d, -1, d), axis=2)
+            x_q = x_q.reshape(x.shape)
+
+        np.save('{0}/{1}_int8.npy'.format(save_dir, name), x_q)
+        np.save('{0}/{1}_scale.npy'.format(save_dir, name), x_scale)
+
+        sizes['float_bytes'] += x.nbytes
+        sizes['int8_bytes'] += x_q.nbytes + x_scale.nbytes
+
+    return sizes
+
+
+def load_weights(save_dir, quantized=False, tensor_rank=None):
+    """ Loads exported weights.
+
+    :param save_dir:
+        Directory of the exported weights.
+    :param quantized:
+        Loads the int8 L and T written by export_quantized with their scales instead of the float ones.
+    :param tensor_rank:
+        Rank of each slice of the tensor, full rank if None.
+    :return:
+        A dict of weights keyed by name. Quantized weights come with an additional <name>_scale entry.
+    """
+    tensor_names = get_tensor_names(tensor_rank)
+
+    weights = {}
+    for name in WEIGHT_NAMES + tensor_names:
+        if quantized and name in ['L'] + tensor_names:
+            weights[name] = np.load('{0}/{1}_int8.npy'.format(save_dir, name))
+            weights[name + '_scale'] = np.load('{0}/{1}_scale.npy'.format(save_dir, name))
+        else:
+            weights[name] = np.load('{0}/{1}.npy'.format(save_dir, name))
+
+    weights['b'] = weights['b'].reshape(-1)
+    weights['bs'] = weights['bs'].reshape(-1)
+    return weights
+
+
+def weights_nbytes(weights):
+    """ Total size of the weights in bytes. """
+    return sum(value.nbytes for value in weights.values())
+
+
+def word_vector(weights, word_index):
+    """ Embedding of a word.
+
+    :param weights:
+        Weights returned by load_weights.
+    :param word_index:
+        Vocabulary index of the word.
+    :return:
+        Float32 vector of size d.
+    """
+    e = weights['L'][:, word_index]
+    if 'L_scale' in weights:
+        return e.astype(np.float32) * weights['L_scale'][word_index]
+    return e
+
+
+def tensor_term(weights, x):
+    """ Neural tensor term zt[k] = x' * T[:, :, k] * x for all k.
+
+    Computed as two matrix-vector products over T in its [2d, 2d * d] layout instead of one product per slice.
+    For a low rank tensor, zt[k] is the sum over the rank of (x' * T_P[:, :, k]) * (T_Q[:, :, k]' * x), from one
+    matrix-vector product with each factor in its [2d, r * d] layout. With int8 weights, the per slice scales
+    are applied to the d results only.
+
+    :param weights:
+        Weights returned by load_weights.
+    :param x:
+        Concatenated vector of both children of size 2d.
+    :return:
+        Vector of size d.
+    """
+    if 'T' in weights:
+        m = np.dot(x, weights['T']).reshape(len(x), -1)
+        zt = np.dot(x, m)
+        if 'T_scale' in weights:
+            zt *= weights['T_scale']
+    else:
+        p = np.dot(x, weights['T_P'])
+        q = np.dot(x, weights['T_Q'])
+        zt = np.sum((p * q).reshape(-1, len(x) // 2), axis=0)
+        if 'T_P_scale' in weights:
+            zt *= weights['T_P_scale'] * weights['T_Q_scale']
+    return zt
+
+
+def predict_proba_tree(weights, tree_dict, compose_func='tanh'):
+    """ Computes the softmax probabilities of all nodes of a tree.
+
+    :param weights:
+        Weights returned by load_weights.
+    :param tree_dict:
+        Flattened tree as returned by RNTN._tree_feed_data with a start index of 0.
+    :param compose_func:
+        Composition function of the model, tanh or relu.
+    :return:
+        An array of shape [nodes, label_size] in the post-order of tree_dict.
+    """
+    if compose_func == 'relu':
+        activation = lambda a: np.maximum(a, 0.)
+    elif compose_func == 'tanh':
+        activation = np.tanh
+    else:
+        raise ValueError("Unknown Composition Function: {0}".format(compose_func))
+
+    n = len(tree_dict['is_leaf'])
+    d = weights['W'].shape[0]
+    word_vecs = np.zeros([n, d], dtype=np.float32)
+
+    for idx in range(n):
+        if tree_dict['is_leaf'][idx]:
+            word_vecs[idx] = word_vector(weights, tree_dict['word_index'][idx])
+        else:
+            x = np.concatenate([word_vecs[tree_dict['left_child'][idx]], word_vecs[tree_dict['right_child'][idx]]])
+            a = np.dot(weights['W'], x) + weights['b'] + tensor_term(weights, x)
+            word_vecs[idx] = activation(a)
+
+    # Projection and softmax of all nodes at once
+    logits = np.dot(word_vecs, weights['U']) + weights['bs']
+    exp_logits = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return exp_logits / np.sum(exp_logits, axis=1, keepdims=True)
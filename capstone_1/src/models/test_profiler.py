@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+#
+# Tests for the profiler used in training and prediction.
+#
+
+import json
+from click.testing import CliRunner
+from src.models import train_model
+from src.models.profiler import Profiler, NULL_PROFILER
+
+
+class TestProfiler(object):
+
+    def test_summary(self):
+        p = Profiler()
+        for _ in range(3):
+            with p.phase('step'):
+                with p.phase('forward'):
+                    pass
+            p.count('nodes', 10)
+            p.count('trees')
+
+        summary = p.summary()
+        assert summary['phases']['step']['count'] == 3
+        assert summary['phases']['forward']['count'] == 3
+        assert summary['counters'] == {'nodes': 30, 'trees': 3}
+        assert summary['rates']['nodes_per_sec'] > summary['rates']['trees_per_sec'] > 0
+
+    def test_chrome_trace(self, tmpdir):
+        p = Profiler()
+        with p.phase('step'):
+            pass
+        p.add_phase('backward', 0., 0.5)
+
+        path = str(tmpdir.join('trace.json'))
+        p.save(path, chrome_trace=True)
+        with open(path) as f:
+            trace = json.load(f)
+        assert [event['name'] for event in trace['traceEvents']] == ['step', 'backward']
+        assert trace['traceEvents'][1]['dur'] == 5e5
+
+    def test_null_profiler(self):
+        with NULL_PROFILER.phase('step'):
+            NULL_PROFILER.count('nodes', 10)
+        assert not NULL_PROFILER.enabled
+
+    def test_train_profile_option(self, tmpdir, monkeypatch):
+        def train_rntn(model_name=None, num_samples=None, params=None, profiler=None):
+            with profiler.phase('step'):
+                profiler.count('trees', 4)
+
+        monkeypatch.setattr(train_model, 'train_rntn', train_rntn)
+
+        path = str(tmpdir.join('profile.json'))
+        result = CliRunner().invoke(train_model.main, ['--profile', path])
+        assert result.exit_code == 0
+        with open(path) as f:
+            assert json.load(f)['counters'] == {'trees': 4}
+
+        result = CliRunner().invoke(train_model.main, ['--profile', path, '--chrome-trace'])
+        assert result.exit_code == 0
+        with open(path) as f:
+            assert [event['name'] for event in json.load(f)['traceEvents']] == ['step']
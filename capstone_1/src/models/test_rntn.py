@@ -10,6 +10,7 @@ import random
 # from sklearn.utils.estimator_checks import check_estimator
 from src.features.tree import Tree
 from src.models.rntn import RNTN
+from src.models import rntn_inference
 from src.models.data_manager import DataManager
 import tensorflow as tf
 
@@ -183,3 +184,35 @@ class TestRNTN(object):
         exp_w = [12.184571329399514, 1.0, 5.018175209014904, 18.01347017318794, 1.0, 7.283038776048536, 1.0]
         cmp_w = [math.isclose(w[i], exp_w[i]) for i in range(len(w))]
         assert all(cmp_w)
+
+    def test_quantize(self):
+        t = np.random.randn(8, 8, 4).astype(np.float32)
+        q, scale = rntn_inference.quantize(t, axis=2)
+        assert q.dtype == np.int8
+        assert scale.shape == (4,)
+        t_d = rntn_inference.dequantize(q, scale, axis=2)
+        assert np.all(np.abs(t - t_d) <= scale / 2 + 1e-6)
+
+    def test_tensor_term(self):
+        d = 4
+        t = np.random.randn(2 * d, 2 * d, d).astype(np.float32)
+        x = np.random.randn(2 * d).astype(np.float32)
+        zd = np.array([np.matmul(np.matmul(x, t[:, :, i]), x) for i in range(d)])
+
+        weights = {'T': t.reshape(2 * d, 2 * d * d)}
+        assert np.allclose(rntn_inference.tensor_term(weights, x), zd, atol=1e-4)
+
+        q, scale = rntn_inference.quantize(t, axis=2)
+        weights = {'T': q.reshape(2 * d, 2 * d * d), 'T_scale': scale}
+        assert np.allclose(rntn_inference.tensor_term(weights, x), zd, rtol=0.1, atol=0.1)
+
+    def test_tensor_term_low_rank(self):
+        d = 4
+        r = 2
+        t_p = np.random.randn(2 * d, r, d).astype(np.float32)
+        t_q = np.random.randn(2 * d, r, d).astype(np.float32)
+        x = np.random.randn(2 * d).astype(np.float32)
+        zd = np.array([np.matmul(np.matmul(x, np.matmul(t_p[:, :, i], t_q[:, :, i].T)), x) for i in range(d)])
+
+        weights = {'T_P': t_p.reshape(2 * d, r * d), 'T_Q': t_q.reshape(2 * d, r * d)}
+        assert np.allclose(rntn_inference.tensor_term(weights, x), zd, atol=1e-4)
@@ -4,11 +4,13 @@
 # Functionality to train all models in this project.
 #
 
+import click
 import logging
 import numpy as np
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import PredefinedSplit, GridSearchCV
 from src.models.data_manager import DataManager
+from src.models.profiler import Profiler
 from src.models.rntn import RNTN
 
 #
@@ -18,8 +20,11 @@ from src.models.rntn import RNTN
 #
 
 
-def train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev):
-    """Train a given model with the training/cross validation data provided."""
+def train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev, **fit_params):
+    """Train a given model with the training/cross validation data provided.
+
+    Keyword arguments are passed to the fit of every candidate model.
+    """
 
     # Prepare data for training
     validation_set_indexes = [-1] * len(x_train) + [0] * len(x_dev)
@@ -30,7 +35,7 @@ def train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev):
 
     x = np.asarray(x_train + x_dev).reshape(-1, 1)
     y = y_train + y_dev
-    model.fit(x, y)
+    model.fit(x, y, **fit_params)
 
     return model
 
@@ -39,8 +44,12 @@ def train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev):
 #
 
 
-def train_rntn(model_name=None, num_samples=None, params=None):
-    """Function that trains all models and saves the trained models."""
+def train_rntn(model_name=None, num_samples=None, params=None, profiler=None):
+    """Function that trains all models and saves the trained models.
+
+    :param profiler:
+        Optional profiler.Profiler recording the training steps of every candidate model, see RNTN.fit.
+    """
     data_manager = DataManager()
 
     clf = RNTN(model_name=model_name)
@@ -69,7 +78,7 @@ def train_rntn(model_name=None, num_samples=None, params=None):
         x_test = np.asarray(data_manager.x_test[0:int(num_samples*0.2)]).reshape(-1, 1)
         y_test = np.asarray([x_test[i, 0].root.label for i in range(len(x_test))])
 
-    cv = train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev)
+    cv = train_model(clf, params, score_func, x_train, y_train, x_dev, y_dev, profiler=profiler)
     logging.info('Training results: {0}'.format(cv.cv_results_))
 
     logging.info('Best Model Name: {0}'.format(cv.best_estimator_.model_name))
@@ -81,6 +90,23 @@ def train_rntn(model_name=None, num_samples=None, params=None):
     logging.info("Model Loss (Best Model): {0}".format(model_loss))
     logging.info("Model Accuracy (Best Model): {0}".format(accuracy_score(y_test, y_pred)))
 
+
+@click.command()
+@click.option('--model-name', default=None, help='Name of the saved model.')
+@click.option('--num-samples', default=None, type=int, help='Number of training trees, all if not given.')
+@click.option('--profile', default=None, help='Writes a profile of the training steps to this json file.')
+@click.option('--chrome-trace', is_flag=True, help='Writes the profile as a Chrome trace (chrome://tracing).')
+def main(model_name, num_samples, profile, chrome_trace):
+    """ Trains the RNTN. """
+    profiler = Profiler() if profile is not None else None
+
+    train_rntn(model_name=model_name, num_samples=num_samples, profiler=profiler)
+
+    if profiler is not None:
+        profiler.save(profile, chrome_trace=chrome_trace)
+        logging.info('Training profile written to {0}'.format(profile))
+
+
 # Call train on run
 if __name__ == '__main__':
-    train_rntn()
+    main()
@@ -0,0 +1,578 @@
+
+import click
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import tensorflow as tf
+from src.benchmarks.synthetic import synthetic_cornell_corpus
+from src.models.agent import PolicyAgent
+from src.models.data_manager import DataManager
+from src.models.policy_model import PolicyGradientModel
+from src.models.self_play import play_games
+from src.models.seqtoseq_graph import SeqToSeqGraph
+from src.models.seqtoseq_model import SeqToSeqModel
+
+#
+# Seq2seq and RL benchmarks
+# Preprocessing, batching, training and beam decoding throughput, agent play latency and self-play turn cost,
+# on a synthetic Cornell corpus. Results are written to reports/benchmarks as json to compare them between commits.
+#
+
+abs_path = os.path.abspath(os.path.dirname(__file__))
+def_results_path = os.path.join(abs_path, '../../reports/benchmarks/')
+
+# Number of conversations in the Cornell Movie-Dialogs Corpus
+CORNELL_CONVERSATIONS = 83097
+
+# Seq2seq checkpoint with the default model parameters, written for the decoding, agent and self-play benchmarks
+BENCHMARK_MODEL_NAME = 'benchmark-seq2seq'
+
+# Small model of the training benchmark
+SMALL_MODEL_PARAMS = {
+    'batch_size': 64,
+    'rnn_size': 128,
+    'num_layers': 1,
+    'encoding_embedding_size': 128,
+    'decoding_embedding_size': 128
+}
+
+
+#
+# Helpers
+#
+
+def _latency_stats(durations):
+    """Mean and percentiles of durations in seconds, in milliseconds."""
+    durations_ms = 1000. * np.asarray(durations)
+    return {
+        'mean_ms': float(np.mean(durations_ms)),
+        'p50_ms': float(np.percentile(durations_ms, 50)),
+        'p90_ms': float(np.percentile(durations_ms, 90)),
+        'p99_ms': float(np.percentile(durations_ms, 99))
+    }
+
+
+def _best_time(func, repeats):
+    """Shortest duration in seconds of repeats calls of func."""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+@contextmanager
+def _data_paths(cornell_path, processed_path):
+    """Points DataManager to other corpus and processed folders, the defaults are restored on exit.
+
+    DataManager reads its data again each time it is instantiated, so instances created inside the context
+    hold the data of these folders.
+    """
+    default_paths = DataManager._def_cornell_path, DataManager._def_processed_path
+    DataManager._def_cornell_path, DataManager._def_processed_path = cornell_path, processed_path
+    try:
+        yield
+    finally:
+        DataManager._def_cornell_path, DataManager._def_processed_path = default_paths
+
+
+def _save_checkpoint(data_manager, model_name):
+    """Saves a randomly initialized seq2seq model with the default parameters.
+
+    The training graph is saved, with its optimizer slots, so that the checkpoint can be restored by the agents
+    and by the policy learner.
+    """
+    model = SeqToSeqModel(model_name=model_name)
+    with tf.Graph().as_default(), tf.Session() as session:
+        SeqToSeqGraph(model, data_manager).train()
+        session.run(tf.global_variables_initializer())
+        model._save_model(session)
+
+
+def _git_commit():
+    """Short hash of the current commit or None outside of a git checkout."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=abs_path,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return result.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#
+# Benchmarks
+#
+
+def benchmark_data_manager(processed_path, repeats=3):
+    """Time to preprocess the Cornell corpus and to load the preprocessed data.
+
+    :param processed_path:
+        Processed folder of DataManager, emptied before each preprocessing run.
+    :param repeats:
+        Number of runs, the fastest is reported.
+    :return:
+        A dict with the preprocessing and loading time and question/answer pairs per second.
+    """
+    preprocess_durations = []
+    for _ in range(repeats):
+        for file_name in os.listdir(processed_path):
+            os.remove(os.path.join(processed_path, file_name))
+
+        start = time.perf_counter()
+        data_manager = DataManager()
+        preprocess_durations.append(time.perf_counter() - start)
+
+    preprocess_time = min(preprocess_durations)
+    load_time = _best_time(DataManager, repeats)
+    num_pairs = len(data_manager.sorted_questions)
+
+    return {
+        'num_pairs': num_pairs,
+        'vocabulary_size': len(data_manager.questions_vocab_to_int),
+        'preprocess_sec': preprocess_time,
+        'preprocess_pairs_per_sec': num_pairs / preprocess_time,
+        'load_sec': load_time,
+        'load_pairs_per_sec': num_pairs / load_time
+    }
+
+
+def benchmark_batching(data_manager, batch_size=128, repeats=3):
+    """Throughput of padding and batching the question/answer pairs.
+
+    :param data_manager:
+        DataManager holding the pairs.
+    :param batch_size:
+        Pairs per batch.
+    :param repeats:
+        Number of passes, the fastest is reported.
+    :return:
+        A dict with pairs/sec of batch_data, and of pad_data and batch_padded_data over a shuffled index as in
+        SeqToSeqModel.train_padded.
+    """
+    model = SeqToSeqModel(batch_size=batch_size)
+    questions, answers = data_manager.sorted_questions, data_manager.sorted_answers
+    questions_vocab_to_int = data_manager.questions_vocab_to_int
+    answers_vocab_to_int = data_manager.answers_vocab_to_int
+
+    def batch_data():
+        for _ in model.batch_data(questions, answers, batch_size, questions_vocab_to_int, answers_vocab_to_int):
+            pass
+
+    def pad_data():
+        return model.pad_data(questions, answers, questions_vocab_to_int, answers_vocab_to_int)
+
+    padded_data = pad_data()
+    index = model._shuffle_training_data(len(questions))
+
+    def batch_padded_data():
+        for _ in model.batch_padded_data(padded_data, batch_size, index):
+            pass
+
+    return {
+        'num_pairs': len(questions),
+        'batch_size': batch_size,
+        'batch_data_pairs_per_sec': len(questions) / _best_time(batch_data, repeats),
+        'pad_data_pairs_per_sec': len(questions) / _best_time(pad_data, repeats),
+        'batch_padded_data_pairs_per_sec': len(questions) / _best_time(batch_padded_data, repeats)
+    }
+
+
+def benchmark_training(data_manager, cell_types=('basic', 'block'), num_steps=50, model_params=None):
+    """Training steps per second of a small seq2seq model.
+
+    Builds the training graph of SeqToSeqGraph once per cell type and times optimizer steps over shuffled
+    batches, the first step is a warm up.
+
+    :param data_manager:
+        DataManager holding the pairs.
+    :param cell_types:
+        LSTM implementations to benchmark.
+    :param num_steps:
+        Number of timed steps.
+    :param model_params:
+        SeqToSeqModel parameters, SMALL_MODEL_PARAMS if None.
+    :return:
+        A dict keyed by cell type with steps/sec, non-pad answer tokens/sec and step latency percentiles.
+    """
+    model_params = SMALL_MODEL_PARAMS if model_params is None else model_params
+
+    results = {}
+    for cell_type in cell_types:
+        model = SeqToSeqModel(cell_type=cell_type, **model_params)
+        padded_data = model.pad_data(data_manager.sorted_questions, data_manager.sorted_answers,
+                                     data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int)
+        index = model._shuffle_training_data(len(padded_data[0]))
+        batches = list(model.batch_padded_data(padded_data, model.batch_size, index))[:num_steps + 1]
+
+        with tf.Graph().as_default(), tf.Session() as session:
+            model_graph = SeqToSeqGraph(model, data_manager)
+            input_data, targets, lr, input_sequence_length, output_sequence_length = model_graph.inputs()
+            rewards = model_graph.rewards
+            cost, train_op = model_graph.train()
+            session.run(tf.global_variables_initializer())
+
+            durations = []
+            for questions_batch, answers_batch, q_sequence_length_batch, a_sequence_length_batch, rewards_batch \
+                    in batches:
+                feed_dict = {
+                    input_data: questions_batch,
+                    targets: answers_batch,
+                    lr: model.learning_rate,
+                    input_sequence_length: q_sequence_length_batch,
+                    output_sequence_length: a_sequence_length_batch,
+                    rewards: rewards_batch
+                }
+
+                start = time.perf_counter()
+                session.run([train_op, cost], feed_dict=feed_dict)
+                durations.append(time.perf_counter() - start)
+
+        # Drop the warm up step
+        durations = durations[1:]
+        num_tokens = sum(int(np.sum(batch[3])) for batch in batches[1:])
+        total_time = sum(durations)
+
+        results[cell_type] = _latency_stats(durations)
+        results[cell_type].update({
+            'num_steps': len(durations),
+            'steps_per_sec': len(durations) / total_time,
+            'pairs_per_sec': len(durations) * model.batch_size / total_time,
+            'tokens_per_sec': num_tokens / total_time
+        })
+        logging.info('Training benchmark with {0} cells: {1}'.format(cell_type, results[cell_type]))
+
+    return results
+
+
+def benchmark_beam_decode(data_manager, questions, model_name=BENCHMARK_MODEL_NAME, batch_sizes=(1, 32)):
+    """Latency of beam decoding for single questions and batches of questions.
+
+    The checkpoint is randomly initialized, so beams rarely end before max_sequence_length and the latencies are
+    those of the longest responses.
+
+    :param data_manager:
+        DataManager of the model.
+    :param questions:
+        Questions as tokens.
+    :param model_name:
+        Saved seq2seq model with the default parameters.
+    :param batch_sizes:
+        Numbers of questions per decoder run.
+    :return:
+        A dict keyed by batch size with latency percentiles per run and questions/sec.
+    """
+    model = SeqToSeqModel(model_name=model_name)
+
+    results = {}
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as session:
+        model_graph = SeqToSeqGraph(model, data_manager, graph=graph)
+        beam_output = model_graph.beam()
+        model_graph.restore(session)
+
+        # Warm up
+        model.predict_beam_responses_batch(session, beam_output, questions[:1], data_manager)
+
+        for batch_size in batch_sizes:
+            durations = []
+            for start_i in range(0, len(questions), batch_size):
+                start = time.perf_counter()
+                model.predict_beam_responses_batch(
+                    session, beam_output, questions[start_i:start_i + batch_size], data_manager)
+                durations.append(time.perf_counter() - start)
+
+            results[batch_size] = _latency_stats(durations)
+            results[batch_size]['questions_per_sec'] = len(questions) / sum(durations)
+
+    return results
+
+
+def benchmark_agent_play(states, model_name=BENCHMARK_MODEL_NAME):
+    """Latency of PolicyAgent.play and throughput of PolicyAgent.play_batch.
+
+    Each play decodes the request, backtracks the beams and computes the rewards of every response prefix.
+
+    :param states:
+        List of (last_response, request) tuples.
+    :param model_name:
+        Saved seq2seq model with the default parameters.
+    :return:
+        A dict with latency percentiles of play, states/sec of play_batch and the encoder cache hit rate.
+    """
+    agent = PolicyAgent(seq2seq_model_name=model_name, agent_name='benchmark')
+    try:
+        # Warm up
+        agent.play(states[0])
+        agent.encoder_cache.clear()
+        hits, misses = agent.encoder_cache.hits, agent.encoder_cache.misses
+
+        durations = []
+        for state in states:
+            start = time.perf_counter()
+            agent.play(state)
+            durations.append(time.perf_counter() - start)
+
+        hits, misses = agent.encoder_cache.hits - hits, agent.encoder_cache.misses - misses
+        hit_rate = hits / (hits + misses) if hits + misses > 0 else 0.
+
+        agent.encoder_cache.clear()
+        start = time.perf_counter()
+        agent.play_batch(states)
+        batch_time = time.perf_counter() - start
+
+    finally:
+        agent.close()
+
+    results = _latency_stats(durations)
+    results.update({
+        'num_states': len(states),
+        'play_states_per_sec': len(states) / sum(durations),
+        'play_batch_states_per_sec': len(states) / batch_time,
+        'encoder_cache_hit_rate': hit_rate
+    })
+    return results
+
+
+def benchmark_self_play(model_name=BENCHMARK_MODEL_NAME, turns=(2,), num_agents=2):
+    """Cost of a self-play epoch of PolicyGradientModel: the games of the starting prompts and the policy update.
+
+    Every response of the beam is played on, so the number of moves grows with beam_width ** (turns * agents).
+    The policy update checkpoints the learner in the background, the checkpoint is waited for outside of the
+    timings.
+
+    :param model_name:
+        Saved seq2seq model with the default parameters.
+    :param turns:
+        Numbers of turns per agent to benchmark.
+    :param num_agents:
+        Number of agents.
+    :return:
+        A dict keyed by number of turns with the play, training and total time and moves/sec.
+    """
+    model = PolicyGradientModel(seq2seq_model_name=model_name, model_name='benchmark-rl')
+
+    results = {}
+    try:
+        # Build the agent pool and the learner graph outside of the timings
+        agents = model._get_agents(num_agents)
+        learner = model._get_learner()
+
+        for num_turns in turns:
+            model.trajectory_buffer.clear()
+
+            start = time.perf_counter()
+            play_games(agents, model.starting_prompts, num_turns, trajectories=model.trajectory_buffer)
+            play_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            model.train(model.trajectory_buffer, None)
+            train_time = time.perf_counter() - start
+            learner.wait()
+
+            num_moves = len(model.trajectory_buffer)
+            results[num_turns] = {
+                'num_games': len(model.starting_prompts),
+                'num_moves': num_moves,
+                'play_sec': play_time,
+                'train_sec': train_time,
+                'epoch_sec': play_time + train_time,
+                'play_moves_per_sec': num_moves / play_time,
+                'train_moves_per_sec': num_moves / train_time
+            }
+            logging.info('Self-play benchmark with {0} turns: {1}'.format(num_turns, results[num_turns]))
+
+    finally:
+        model._close_agents()
+        if model.learner is not None:
+            model.learner.close()
+
+    return results
+
+
+#
+# Runner
+#
+
+def run_benchmarks(quick=False, benchmarks=None):
+    """Runs the benchmarks on a synthetic Cornell corpus.
+
+    The corpus and its preprocessed data are written to temporary folders. The decoding, agent and self-play
+    benchmarks use a randomly initialized checkpoint in the models folder, removed at the end of the run.
+
+    :param quick:
+        Uses a smaller corpus, fewer steps and fewer turns, for a smoke run.
+    :param benchmarks:
+        Names of the benchmarks to run, all if None.
+    :return:
+        A dict with the metadata of the run and the results of each benchmark.
+    """
+    num_conversations = 5000 if quick else CORNELL_CONVERSATIONS
+    repeats = 1 if quick else 3
+    num_requests = 20 if quick else 200
+
+    def selected(name):
+        return benchmarks is None or name in benchmarks
+
+    np.random.seed(42)
+    results = {
+        'metadata': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'quick': quick,
+            'num_conversations': num_conversations,
+            'small_model_params': SMALL_MODEL_PARAMS
+        }
+    }
+
+    with tempfile.TemporaryDirectory() as cornell_path, tempfile.TemporaryDirectory() as processed_path, \
+            _data_paths(cornell_path, processed_path):
+
+        results['metadata']['num_lines'], _ = synthetic_cornell_corpus(cornell_path, num_conversations)
+
+        if selected('data_manager'):
+            results['data_manager'] = benchmark_data_manager(processed_path, repeats)
+
+        data_manager = DataManager()
+        results['metadata']['num_pairs'] = len(data_manager.sorted_questions)
+        results['metadata']['vocabulary_size'] = len(data_manager.questions_vocab_to_int)
+
+        if selected('batching'):
+            results['batching'] = benchmark_batching(data_manager, repeats=repeats)
+
+        if selected('training'):
+            results['training'] = benchmark_training(data_manager, num_steps=10 if quick else 50)
+
+        # Questions in random order, the pairs are sorted by question length
+        questions = [data_manager.sorted_questions[i]
+                     for i in np.random.permutation(len(data_manager.sorted_questions))[:num_requests + 1]]
+
+        decoding = [name for name in ['beam_decode', 'agent_play', 'self_play'] if selected(name)]
+        if len(decoding) > 0:
+            _save_checkpoint(data_manager, BENCHMARK_MODEL_NAME)
+
+        try:
+            if selected('beam_decode'):
+                results['beam_decode'] = benchmark_beam_decode(data_manager, questions[:num_requests])
+
+            if selected('agent_play'):
+                results['agent_play'] = benchmark_agent_play(list(zip(questions[:-1], questions[1:])))
+
+            if selected('self_play'):
+                results['self_play'] = benchmark_self_play(turns=(1,) if quick else (2,))
+
+        finally:
+            if len(decoding) > 0:
+                shutil.rmtree(SeqToSeqModel(model_name=BENCHMARK_MODEL_NAME)._get_save_dir(), ignore_errors=True)
+
+    return results
+
+
+def save_results(results, path=None):
+    """Writes benchmark results as json.
+
+    :param results:
+        Results of run_benchmarks.
+    :param path:
+        File path, reports/benchmarks/seqtoseq-<commit>-<timestamp>.json if None.
+    :return:
+        The file path.
+    """
+    if path is None:
+        os.makedirs(def_results_path, exist_ok=True)
+        path = '{0}/seqtoseq-{1}-{2}.json'.format(def_results_path, results['metadata']['commit'],
+                                                  datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info('Benchmark results written to {0}'.format(path))
+
+    return path
+
+
+def compare_results(old_results, new_results):
+    """Compares the metrics of two benchmark runs.
+
+    :param old_results:
+        Results of the baseline run.
+    :param new_results:
+        Results of the new run.
+    :return:
+        A list of (metric, old value, new value, new / old) for the metrics present in both runs.
+        See is_duration for which ratios are improvements.
+    """
+    def flatten(results, prefix=''):
+        metrics = {}
+        for key, value in results.items():
+            name = '{0}{1}'.format(prefix, key)
+            if isinstance(value, dict):
+                metrics.update(flatten(value, name + '.'))
+            elif isinstance(value, float):
+                metrics[name] = value
+        return metrics
+
+    old_metrics = flatten({key: value for key, value in old_results.items() if key != 'metadata'})
+    new_metrics = flatten({key: value for key, value in new_results.items() if key != 'metadata'})
+
+    return [(name, old_metrics[name], new_metrics[name], new_metrics[name] / old_metrics[name])
+            for name in sorted(old_metrics) if name in new_metrics and old_metrics[name] != 0]
+
+
+def is_duration(name):
+    """Whether a metric is a duration (lower is better) rather than a throughput (higher is better).
+
+    Durations end in _ms or _sec, such as p90_ms or play_sec. Throughputs end in _per_sec, such as
+    tokens_per_sec, or are rates such as encoder_cache_hit_rate.
+    """
+    return name.endswith('_ms') or (name.endswith('_sec') and not name.endswith('_per_sec'))
+
+
+@click.group()
+def main():
+    """Seq2seq and RL benchmarks."""
+    pass
+
+
+@main.command()
+@click.option('--quick', is_flag=True, help='Smaller corpus, fewer steps and fewer turns.')
+@click.option('--benchmark', 'benchmarks', multiple=True,
+              type=click.Choice(['data_manager', 'batching', 'training', 'beam_decode', 'agent_play', 'self_play']),
+              help='Benchmark to run, can be repeated. All if not given.')
+@click.option('--output', default=None, help='Results file.')
+def run(quick, benchmarks, output):
+    """Runs the benchmarks and writes the results."""
+    results = run_benchmarks(quick, benchmarks or None)
+    print(json.dumps(results, indent=2))
+    print(save_results(results, output))
+
+
+@main.command()
+@click.argument('old_path')
+@click.argument('new_path')
+def compare(old_path, new_path):
+    """Compares two results files."""
+    with open(old_path) as f:
+        old_results = json.load(f)
+    with open(new_path) as f:
+        new_results = json.load(f)
+
+    for name, old_value, new_value, ratio in compare_results(old_results, new_results):
+        improved = ratio < 1. if is_duration(name) else ratio > 1.
+        print('{0:<60} {1:>12.3f} {2:>12.3f} {3:>7.2f}x {4}'.format(
+            name, old_value, new_value, ratio, 'better' if improved else 'worse' if ratio != 1. else ''))
+
+
+if __name__ == '__main__':
+    main()
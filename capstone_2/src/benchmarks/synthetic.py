@@ -0,0 +1,97 @@
+
+import os
+import numpy as np
+
+#
+# Synthetic Cornell corpus
+# Movie lines and conversations in the format of the Cornell Movie-Dialogs Corpus,
+# used by the benchmarks so that they run without downloading the real data
+#
+
+# Field separator of the Cornell files
+SEPARATOR = ' +++$+++ '
+
+# Words of the starting prompts, dull responses and a few contractions, so that they are part of the
+# vocabulary built by DataManager
+COMMON_WORDS = [
+    'I', 'you', 'the', 'a', 'to', 'is', 'it', 'what', 'do', 'not', 'know', 'that', 'am', 'sure', 'think',
+    'sorry', 'mean', 'how', 'about', 'dinner', 'Saturday', 'night', 'there', 'fight', 'going', 'on', 'in',
+    'quad', 'we', 'this', 'project', "don't", "can't", "it's", "i'm", "you're"
+]
+
+
+def synthetic_vocabulary(vocabulary_size):
+    """Words of a synthetic vocabulary, the common words followed by w0, w1, ..."""
+    num_words = max(vocabulary_size - len(COMMON_WORDS), 0)
+    return COMMON_WORDS[:vocabulary_size] + ['w{0}'.format(i) for i in range(num_words)]
+
+
+def synthetic_line(rng, words, min_words=1, max_words=21):
+    """Builds a random movie line.
+
+    Words are drawn with Zipf distributed frequencies. Lines are capitalized and end with a punctuation mark,
+    which DataManager cleans like the punctuation of the real lines.
+
+    :param rng:
+        numpy RandomState.
+    :param words:
+        Vocabulary to draw words from.
+    :param min_words:
+        Minimum number of words in the line.
+    :param max_words:
+        Maximum number of words in the line.
+    :return:
+        Line text such as 'What do w12 the.'
+    """
+    num_words = rng.randint(min_words, max_words + 1)
+    word_ids = np.minimum(rng.zipf(1.3, num_words) - 1, len(words) - 1)
+    text = ' '.join(words[word_id] for word_id in word_ids)
+    return text[0].upper() + text[1:] + rng.choice(['.', '?', '!'])
+
+
+def synthetic_cornell_corpus(corpus_path, num_conversations=83097, vocabulary_size=5000, min_lines=2,
+                             max_lines=6, seed=42):
+    """Writes movie_lines.txt and movie_conversations.txt in the Cornell format.
+
+    The defaults give about as many conversations, lines per conversation and words per line as the
+    Cornell Movie-Dialogs Corpus (83097 conversations of 3.7 lines of 11 words).
+
+    :param corpus_path:
+        Directory to write the files to, such as DataManager._def_cornell_path.
+    :param num_conversations:
+        Number of conversations.
+    :param vocabulary_size:
+        Number of distinct words.
+    :param min_lines:
+        Minimum number of lines per conversation.
+    :param max_lines:
+        Maximum number of lines per conversation.
+    :param seed:
+        Random seed, the same seed gives the same corpus.
+    :return:
+        A tuple (num_lines, num_conversations).
+    """
+    rng = np.random.RandomState(seed)
+    words = synthetic_vocabulary(vocabulary_size)
+
+    # Cornell line ids start at L1, L0 is the conversation end marker of DataManager
+    line_id = 1
+
+    with open(os.path.join(corpus_path, 'movie_lines.txt'), 'w', encoding='utf-8') as lines_file, \
+            open(os.path.join(corpus_path, 'movie_conversations.txt'), 'w', encoding='utf-8') as convs_file:
+
+        for conv_i in range(num_conversations):
+            movie = 'm{0}'.format(conv_i // 100)
+            characters = ['u{0}'.format(2 * conv_i), 'u{0}'.format(2 * conv_i + 1)]
+
+            line_ids = []
+            for i in range(rng.randint(min_lines, max_lines + 1)):
+                line_ids.append('L{0}'.format(line_id))
+                lines_file.write(SEPARATOR.join([
+                    line_ids[-1], characters[i % 2], movie, characters[i % 2].upper(), synthetic_line(rng, words)
+                ]) + '\n')
+                line_id += 1
+
+            convs_file.write(SEPARATOR.join(characters + [movie, str(line_ids)]) + '\n')
+
+    return line_id - 1, num_conversations
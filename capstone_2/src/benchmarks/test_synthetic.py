@@ -0,0 +1,44 @@
+#
+# Tests for the synthetic Cornell corpus used by the benchmarks.
+#
+
+import ast
+from src.benchmarks import synthetic
+
+
+class TestSynthetic(object):
+
+    def test_synthetic_cornell_corpus(self, tmpdir):
+        num_lines, num_conversations = synthetic.synthetic_cornell_corpus(
+            str(tmpdir), num_conversations=20, vocabulary_size=50, min_lines=2, max_lines=4)
+        assert num_conversations == 20
+
+        lines = tmpdir.join('movie_lines.txt').read().split('\n')
+        convs = tmpdir.join('movie_conversations.txt').read().split('\n')
+
+        # Both files end with a new line, as the real corpus
+        assert lines[-1] == '' and convs[-1] == ''
+        assert len(lines) - 1 == num_lines
+        assert len(convs) - 1 == num_conversations
+
+        line_ids = set()
+        for line in lines[:-1]:
+            fields = line.split(synthetic.SEPARATOR)
+            assert len(fields) == 5
+            assert 1 <= len(fields[4].split()) <= 21
+            line_ids.add(fields[0])
+
+        for conv in convs[:-1]:
+            conv_line_ids = ast.literal_eval(conv.split(synthetic.SEPARATOR)[-1])
+            assert 2 <= len(conv_line_ids) <= 4
+            assert line_ids.issuperset(conv_line_ids)
+
+    def test_synthetic_cornell_corpus_seed(self, tmpdir):
+        files = []
+        for name, seed in [('a', 1), ('b', 1), ('c', 2)]:
+            path = tmpdir.mkdir(name)
+            synthetic.synthetic_cornell_corpus(str(path), num_conversations=5, seed=seed)
+            files.append(path.join('movie_lines.txt').read())
+
+        assert files[0] == files[1]
+        assert files[0] != files[2]
@@ -3,7 +3,11 @@ import logging
 import os
 import numpy as np
 import tensorflow as tf
+from collections import OrderedDict
+from src.models.beam_search import beam_responses
 from src.models.data_manager import DataManager
+from src.models.encoder_cache import EncoderCache
+from src.models.seqtoseq_graph import SeqToSeqGraph
 from src.models.seqtoseq_model import SeqToSeqModel
 
 
@@ -12,7 +16,18 @@ class PolicyAgent:
 
     def __init__(self,
                  seq2seq_model_name='test-policy',
+                 encoder_cache_size=64,
                  agent_name=None):
+        """
+        :param seq2seq_model_name:
+            Saved seq2seq model played by the agent.
+        :param encoder_cache_size:
+            Number of last responses whose encoder representations are cached. Each entry holds
+            2 * max_sequence_length * rnn_size float32 values, about 86KB with the default model, so the default
+            size keeps about 5.5MB per agent. Response prefixes are not cached.
+        :param agent_name:
+            Name used in log messages.
+        """
 
         # Model parameters
         self.seq2seq_model_name = seq2seq_model_name
@@ -23,6 +38,11 @@ class PolicyAgent:
 
         # Dull responses
         self.dull_responses = self.data_manager.get_cornell_dull_responses()
+        self.dull_response_mask = self._get_dull_response_mask()
+
+        # Cache of the encoded last responses of the information flow reward. The beams of a request all become
+        # states with that request as their last response, so it is encoded once for all of them.
+        self.encoder_cache = EncoderCache(max_size=encoder_cache_size)
 
         # Initialize a default graph and session
         self.graph = tf.Graph()
@@ -32,192 +52,213 @@ class PolicyAgent:
         self.seq2seq_model = SeqToSeqModel(
             model_name=self.seq2seq_model_name)
 
-        # Create model variables
-        cost, train_op, beam_output, encoder_output = self._create_model_graph()
-        self.cost = cost
-        self.train_op = train_op
-        self.beam_output = beam_output
-        self.encoder_output = encoder_output
+        # Create the inference graph, the agent does not train
+        self.model_graph = SeqToSeqGraph(self.seq2seq_model, self.data_manager, graph=self.graph)
+        self.beam_output = self.model_graph.beam()
+        self.encoder_output = self.model_graph.encoder()[0]
+        self.model_graph.restore(self.session, self._get_model_save_path())
+
+        logging.info('SeqtoSeq Model initialized for agent {0}'.format(self.agent_name))
 
         logging.info('Agent {0} initialized.'.format(self.agent_name))
 
     def play(self, state):
         """Play each turn."""
-        last_response, request = state
+        return self.play_batch([state])[0]
 
-        responses = []
-        probs = []
-        rewards = []
+    def play_batch(self, states):
+        """Play a turn for several states, decoding their requests in batched beam searches.
 
-        with self.graph.as_default():
-
-            # Predict beam responses
-            scores, predicted_ids, parent_ids = self.seq2seq_model.predict_beam_responses(
-                self.session, self.beam_output, request, self.data_manager)
-
-            # Prepare Probabilities (Softmax)
-            exp_scores = []
-            for j in range(len(scores)):
-                row_scores = np.exp(np.asarray(scores)[j:][0])
-                exp_scores.append(row_scores / sum(row_scores))
-
-            # Prepare responses and probabilities
-            for i in range(self.seq2seq_model.beam_width):
-                a_tokens = []
-                p_scores = []
-                r_scores = []
-                for j in range(self.seq2seq_model.max_sequence_length):
-                    token = predicted_ids[j][i]
-                    a_tokens.append(token)
-                    p_scores.append(exp_scores[j][i])
-                    r_scores.append(self._reward(last_response, request, a_tokens, exp_scores[j][i]))
-                    if token == self.data_manager.answers_vocab_to_int['<EOS>']:
-                        break
-
-                responses.append(a_tokens)
-                probs.append(p_scores)
-                rewards.append(r_scores)
-
-        return responses, probs, rewards
-
-    def close(self):
-        """Closes session object"""
-        self.session.close()
-
-    def _create_model_graph(self):
+        :param states:
+            List of (last_response, request) tuples.
+        :return:
+            A list with a (responses, probs, rewards) tuple for each state.
+        """
+        batch_size = self.seq2seq_model.batch_size
 
-        """Creates seq2seq model graph"""
+        results = []
         with self.graph.as_default():
+            for start_i in range(0, len(states), batch_size):
+                batch_states = states[start_i:start_i + batch_size]
+                requests = [request for _, request in batch_states]
 
-            # Load the model inputs
-            input_data, targets, lr, input_sequence_length, output_sequence_length = self.seq2seq_model.model_inputs()
+                # Predict beam responses
+                scores, predicted_ids, parent_ids = self.seq2seq_model.predict_beam_responses_batch(
+                    self.session, self.beam_output, requests, self.data_manager)
 
-            # Model Graph Variables
-            self.seq2seq_model.model_graph_vars(self.data_manager)
+                # Backtrack beams, [request, time, beam]
+                tokens, probabilities, lengths = beam_responses(
+                    scores, predicted_ids, parent_ids, self.data_manager.answers_vocab_to_int['<EOS>'])
 
-            # Create Encoder
-            encoder_output, encoder_state = self.seq2seq_model._get_encoder(input_data, input_sequence_length)
+                for i, (last_response, request) in enumerate(batch_states):
+                    results.append(self._play_responses(
+                        last_response, request, tokens[i].T, probabilities[i].T, lengths[i]))
 
-            # Create Decoder for Training
-            train_logits = self.seq2seq_model._get_decoder_train(
-                targets, encoder_output, encoder_state, input_sequence_length, self.data_manager)
+        return results
 
-            with tf.name_scope("optimization"):
-                # Compute weight mask
-                mask = tf.sequence_mask(output_sequence_length,
-                                        self.seq2seq_model.max_sequence_length, dtype=tf.float32)
+    def _play_responses(self, last_response, request, tokens, probabilities, lengths):
+        """Prepares responses, probabilities and rewards from the [beam, time] backtracked beams of one request."""
 
-                # Loss function
-                cost = tf.contrib.seq2seq.sequence_loss(
-                    train_logits,
-                    targets,
-                    mask)
+        # Responses and probabilities up to and including the end token
+        responses = [tokens[i, :length].tolist() for i, length in enumerate(lengths)]
+        probs = [probabilities[i, :length].tolist() for i, length in enumerate(lengths)]
 
-                # Optimizer
-                optimizer = tf.train.AdamOptimizer(self.seq2seq_model.learning_rate)
+        # Rewards for every prefix of every response
+        rewards = self._rewards(last_response, request, tokens, probabilities, lengths)
 
-                # Gradient Clipping
-                gradients = optimizer.compute_gradients(cost)
-                capped_gradients = [
-                    (tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
-                train_op = optimizer.apply_gradients(capped_gradients)
+        return responses, probs, rewards
+
+    def get_weights(self):
+        """Returns the current seq2seq weights of this agent keyed by variable name."""
+        return self.seq2seq_model.get_weights(self.session)
 
-            # Create beam decoder for generating responses
-            beam_output = self.seq2seq_model._get_decoder_infer_beam(
-                encoder_output, encoder_state, input_sequence_length, self.data_manager)
+    def set_weights(self, weights):
+        """Replaces the seq2seq weights of this agent in memory."""
+        self.seq2seq_model.set_weights(self.session, weights)
 
-            # Initialize the model variables
-            self.session.run(tf.global_variables_initializer())
+        # Cached representations belong to the previous weights
+        logging.info('Encoder cache for agent {0}: {1} hits, {2} misses.'.format(
+            self.agent_name, self.encoder_cache.hits, self.encoder_cache.misses))
+        self.encoder_cache.clear()
 
-            # Restore session
-            saver = tf.train.Saver()
-            save_path = self._get_model_save_path()
-            saver.restore(self.session, save_path)
-            logging.info('Saved model {0} loaded from disk.'.format(save_path))
+        logging.info('Weights updated for agent {0}.'.format(self.agent_name))
 
-            logging.info('SeqtoSeq Model initialized for agent {0}'.format(self.agent_name))
+    def close(self):
+        """Closes session object"""
+        self.session.close()
 
-            return cost, train_op, beam_output, encoder_output
+    def _rewards(self, last_response, request, tokens, probabilities, lengths):
+        """Total reward for every token prefix of every response.
 
-    def _reward(self, last_response, request, response, prob):
-        """Total reward for this response."""
+        :param tokens:
+            [beam, time] response tokens.
+        :param probabilities:
+            [beam, time] response probabilities.
+        :param lengths:
+            Length of each response.
+        :return:
+            A list with the rewards of each response, one reward per token prefix.
+        """
         weights = [0.25, 0.25, 0.5]
 
-        rew_1 = self._ease_of_answering(response, prob)
-        rew_2 = self._information_flow(last_response, response)
-        rew_3 = self._semantic_coherence(request, response, prob)
+        max_length = lengths.max()
+        tokens = tokens[:, :max_length]
+        mask = np.arange(max_length) < lengths[:, np.newaxis]
+        prob = np.where(mask, probabilities[:, :max_length], 1.)
+        responses = [tokens[i, :length] for i, length in enumerate(lengths)]
+
+        rew_1 = self._ease_of_answering(tokens, prob, mask)
+        rew_2 = self._information_flow(last_response, responses, mask)
+        rew_3 = self._semantic_coherence(request, prob)
 
-        rew_total = np.sum(np.multiply(weights, [rew_1, rew_2, rew_3]))
+        rew_total = weights[0] * rew_1 + weights[1] * rew_2 + weights[2] * rew_3
 
-        # logging.info('Total reward for {0}: {1}'.format(response, rew_total))
+        return [rew_total[i, :length].tolist() for i, length in enumerate(lengths)]
 
-        return rew_total
+    def _ease_of_answering(self, tokens, prob, mask):
+        """Measure for similarity to known dull responses, for [batch, time] response prefixes."""
+        max_length = tokens.shape[1]
 
-    def _ease_of_answering(self, response, prob):
-        """Measure for similarity to known dull responses."""
-        t = 0.
-        n_a = len(response)
+        # Only the first occurrence of a token counts towards the set overlap of a prefix.
+        # A stable sort puts the first occurrence of each token first within its group.
+        order = np.argsort(tokens, axis=1, kind='mergesort')
+        sorted_tokens = np.take_along_axis(tokens, order, axis=1)
+        first_in_group = np.ones(tokens.shape, dtype=bool)
+        first_in_group[:, 1:] = sorted_tokens[:, 1:] != sorted_tokens[:, :-1]
+        new_tokens = np.zeros(tokens.shape, dtype=bool)
+        np.put_along_axis(new_tokens, order, first_in_group, axis=1)
+        new_tokens &= mask
 
-        # Get dull responses
-        for dull_resp in self.dull_responses:
-            n_s = len(set(dull_resp) & set(response))
-            if n_s > 0:
-                t += prob / n_s
+        # Running size of the overlap of each prefix with each dull response, [dull, batch, time]
+        n_s = np.cumsum(self.dull_response_mask[:, tokens] & new_tokens, axis=-1)
 
-        t /= n_a
-        if t == 0.:
-            return 0.
-        rew = -np.log(t)
+        # Sum of prob / n_s over the dull responses with an overlap
+        inv_n_s = np.sum(np.where(n_s > 0, 1. / np.maximum(n_s, 1), 0.), axis=0)
+        n_a = np.arange(1, max_length + 1)
+        t = prob * inv_n_s / n_a
 
-        # logging.info('Ease of answering for {0}: {1}'.format(response, rew))
+        with np.errstate(divide='ignore'):
+            rew = np.where(t == 0., 0., -np.log(t))
 
         return rew
 
-    def _information_flow(self, last_response, response):
-        """Measure for repeating responses."""
+    def _information_flow(self, last_response, responses, mask):
+        """Measure for repeating responses, for [batch, time] response prefixes."""
 
+        rew = np.zeros(mask.shape)
         if last_response is None:
-            return 0.
+            return rew
 
-        # Get Encoder Output for last response
-        encoder_output_prev = self.seq2seq_model.get_encoded_representation(
-            self.session, self.encoder_output, last_response, self.data_manager)
-        prev_fw = encoder_output_prev[0][0]
-        prev_bw = encoder_output_prev[1][0]
-        prev = np.asarray([prev_fw, prev_bw]).reshape(-1)
+        # Encode the last response and every response prefix. The backward encoder outputs of a prefix differ
+        # from those of the complete response, so each prefix is encoded on its own. Prefixes rarely repeat
+        # across states and are not cached.
+        prefixes = [response[:j + 1] for response in responses for j in range(len(response))]
+        encoded_last = self._encode([last_response])[0]
+        encoded = self._encode(prefixes, use_cache=False)
 
-        # Get Encoder Output for current response
-        encoder_output_curr = self.seq2seq_model.get_encoded_representation(
-            self.session, self.encoder_output, response, self.data_manager)
-        curr_fw = encoder_output_curr[0][0]
-        curr_bw = encoder_output_curr[1][0]
-        curr = np.asarray([curr_fw, curr_bw]).reshape(-1)
+        # Get Dot Products with the last response
+        t = encoded.dot(encoded_last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_prod = np.where(t == 0., 0., -np.log(t))
 
-        # Get Dot Product
-        t = np.sum(np.multiply(prev, curr))
-        if t == 0.:
-            return 0.
-        log_prod = -np.log(t)
+        # Prefixes are ordered by response, then by length
+        rew[mask] = log_prod
 
-        # logging.info('Information flow for {0}: {1}'.format(response, log_prod))
-
-        return log_prod
+        return rew
 
     @staticmethod
-    def _semantic_coherence(request, response, fw_prob):
-        """Measure for conversation flow."""
+    def _semantic_coherence(request, prob):
+        """Measure for conversation flow, for [batch, time] response prefixes."""
         n_req = len(request)
-        n_resp = len(response)
+        n_resp = np.arange(1, prob.shape[1] + 1)
 
         # Compute backward probability
         # Currently assume this to be the same as fw_prob
         # Need to train a separate NN in backward direction
-        rew = np.log(fw_prob) / n_resp + np.log(fw_prob) / n_req
-
-        # logging.info('Semantic Coherence for {0}: {1}'.format(response, rew))
+        rew = np.log(prob) / n_resp + np.log(prob) / n_req
 
         return rew
 
+    def _encode(self, token_lists, use_cache=True):
+        """Flattened encoder representations of token lists.
+
+        Representations missing from the encoder cache are computed in a single encoder run, each distinct
+        token list once.
+
+        :param use_cache:
+            Looks up and stores the representations in the encoder cache.
+        """
+        encoded = [self.encoder_cache.get(tokens) if use_cache else None for tokens in token_lists]
+
+        # Distinct token lists missing from the cache
+        missing = OrderedDict()
+        for tokens, value in zip(token_lists, encoded):
+            if value is None:
+                missing.setdefault(EncoderCache.key(tokens), tokens)
+
+        if len(missing) > 0:
+            encoder_output_fw, encoder_output_bw = self.seq2seq_model.get_encoded_representations(
+                self.session, self.encoder_output, list(missing.values()), self.data_manager)
+            values = np.concatenate([encoder_output_fw, encoder_output_bw], axis=1).reshape(len(missing), -1)
+
+            computed = dict(zip(missing.keys(), values))
+            if use_cache:
+                for key, value in computed.items():
+                    self.encoder_cache.put(key, value)
+
+            encoded = [computed[EncoderCache.key(tokens)] if value is None else value
+                       for tokens, value in zip(token_lists, encoded)]
+
+        return np.stack(encoded)
+
+    def _get_dull_response_mask(self):
+        """Boolean [dull responses, vocabulary] mask of the tokens in each dull response."""
+        vocab_size = max(len(self.data_manager.questions_vocab_to_int), len(self.data_manager.answers_vocab_to_int))
+        dull_response_mask = np.zeros((len(self.dull_responses), vocab_size), dtype=bool)
+        for i, dull_resp in enumerate(self.dull_responses):
+            dull_response_mask[i, dull_resp] = True
+        return dull_response_mask
+
     def _get_save_dir(self):
         """ Checks for save directory and builds it if necessary.
 
@@ -0,0 +1,54 @@
+
+import numpy as np
+
+#
+# Beam Search Outputs
+# Array operations on the [time, beam] outputs of the beam search decoder
+#
+
+
+def beam_softmax(scores):
+    """Softmax of beam scores over the beam axis (last axis)."""
+    exp_scores = np.exp(scores - np.max(scores, axis=-1, keepdims=True))
+    return exp_scores / np.sum(exp_scores, axis=-1, keepdims=True)
+
+
+def beam_paths(parent_ids):
+    """Beam slot occupied at every step by each final beam, following parent_ids back from the last step.
+
+    :param parent_ids:
+        Array of shape [..., time, beam].
+    :return:
+        Array of the same shape to index the step outputs of each final beam along the beam axis.
+    """
+    num_steps = parent_ids.shape[-2]
+    paths = np.empty_like(parent_ids)
+
+    beam_index = np.broadcast_to(np.arange(parent_ids.shape[-1]), paths[..., 0, :].shape).copy()
+    for step in reversed(range(num_steps)):
+        paths[..., step, :] = beam_index
+        beam_index = np.take_along_axis(parent_ids[..., step, :], beam_index, axis=-1)
+
+    return paths
+
+
+def beam_lengths(tokens, end_token):
+    """Length of each beam up to and including its first end token, over the time axis (second to last axis)."""
+    is_end = tokens == end_token
+    first_end = np.argmax(is_end, axis=-2)
+    return np.where(np.any(is_end, axis=-2), first_end + 1, tokens.shape[-2])
+
+
+def beam_responses(scores, predicted_ids, parent_ids, end_token):
+    """Backtracks the beams of a decoder output.
+
+    :return:
+        A tuple (tokens, probabilities, lengths). Tokens and probabilities have the shape [..., time, beam] of
+        the decoder outputs and follow each final beam back through its parents. Probabilities are the softmax
+        of the scores over the beam axis. Lengths include the end token.
+    """
+    paths = beam_paths(parent_ids)
+    tokens = np.take_along_axis(predicted_ids, paths, axis=-1)
+    probabilities = np.take_along_axis(beam_softmax(scores), paths, axis=-1)
+    lengths = beam_lengths(tokens, end_token)
+    return tokens, probabilities, lengths
@@ -0,0 +1,164 @@
+
+import click
+import json
+import logging
+import tensorflow as tf
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from src.models.beam_search import beam_responses
+from src.models.data_manager import DataManager
+from src.models.export_model import load_inference_graph
+from src.models.seqtoseq_model import SeqToSeqModel
+
+#
+# Chatbot service
+# Keeps the beam search graph and the checkpoint resident between requests
+#
+
+
+class Chatbot:
+    """Seq2seq chatbot that builds its graph and restores its checkpoint once.
+
+    With an export_path, the frozen graph written by export_inference_graph is loaded instead of building the
+    graph and restoring the training checkpoint.
+    """
+
+    def __init__(self, model_name=None, export_path=None):
+
+        self.model_name = model_name
+        self.export_path = export_path
+
+        # Initialize Data Manager
+        self.data_manager = DataManager()
+
+        # Create seq2seq model instance
+        self.model = SeqToSeqModel(model_name=self.model_name)
+
+        if self.export_path is not None:
+            # Load the frozen beam search graph
+            self.graph, self.beam_output = load_inference_graph(self.export_path)
+            self.session = tf.Session(graph=self.graph)
+        else:
+            # Build the beam search graph and restore the checkpoint
+            self.graph = tf.Graph()
+            self.session = tf.Session(graph=self.graph)
+            with self.graph.as_default():
+                self.beam_output = self.model.predict_beam_load_model(self.session, self.data_manager)
+
+        logging.info('Chatbot {0} initialized.'.format(self.model_name))
+
+    def reply(self, question):
+        """Returns the best answer for a single question."""
+        return self.reply_batch([question])[0]
+
+    def reply_batch(self, questions):
+        """Returns the best answer for each question, decoding all questions in one beam search run."""
+
+        # Convert Questions to vocab tokens, empty questions are treated as unknown words
+        # and questions longer than the encoder input are truncated
+        unk_token = self.data_manager.questions_vocab_to_int['<UNK>']
+        q_tokens = [(self.data_manager.question_to_tokens(question) or [unk_token])[:self.model.max_sequence_length]
+                    for question in questions]
+
+        with self.graph.as_default():
+            scores, predicted_ids, parent_ids = self.model.predict_beam_responses_batch(
+                self.session, self.beam_output, q_tokens, self.data_manager)
+
+        # Best beam of each question, without the end token
+        tokens, probabilities, lengths = beam_responses(
+            scores, predicted_ids, parent_ids, self.data_manager.answers_vocab_to_int['<EOS>'])
+        answers = []
+        for i in range(len(questions)):
+            a_tokens = tokens[i, :lengths[i, 0], 0]
+            if a_tokens[-1] == self.data_manager.answers_vocab_to_int['<EOS>']:
+                a_tokens = a_tokens[:-1]
+            answers.append(self.data_manager.answer_from_tokens(a_tokens.tolist()))
+
+        return answers
+
+    def close(self):
+        """Closes session object"""
+        self.session.close()
+
+
+def serve_stdin(chatbot, num_turns=None):
+    """Chats with the user on stdin until 'exit' or num_turns questions."""
+
+    print('Hello!')
+    turn = 0
+    while num_turns is None or turn < num_turns:
+        question = input('> ')
+        if question == 'exit':
+            print('Goodbye!')
+            break
+        print(chatbot.reply(question))
+        turn += 1
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(chatbot, host='127.0.0.1', port=8080):
+    """Serves the chatbot over HTTP.
+
+    POST /reply with a JSON body {"question": "..."} returns {"answer": "..."}, a body
+    {"questions": ["...", ...]} returns {"answers": ["...", ...]}.
+    """
+
+    class ChatbotRequestHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != '/reply':
+                self.send_error(404)
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                if 'questions' in body:
+                    response = {'answers': chatbot.reply_batch(body['questions'])}
+                else:
+                    response = {'answer': chatbot.reply(body['question'])}
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+
+            content = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logging.info('Chatbot HTTP: ' + format % args)
+
+    server = _ThreadingHTTPServer((host, port), ChatbotRequestHandler)
+    logging.info('Chatbot serving on http://{0}:{1}/reply'.format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+@click.command()
+@click.option('--model-name', default='test-policy', help='Name of the saved seq2seq model.')
+@click.option('--export-path', default=None, help='Frozen inference graph to load instead of the checkpoint.')
+@click.option('--http', 'use_http', is_flag=True, help='Serve over HTTP instead of stdin.')
+@click.option('--host', default='127.0.0.1', help='HTTP host.')
+@click.option('--port', default=8080, help='HTTP port.')
+def main(model_name, export_path, use_http, host, port):
+    """Starts a resident chatbot on stdin or over HTTP."""
+    chatbot = Chatbot(model_name=model_name, export_path=export_path)
+    try:
+        if use_http:
+            serve_http(chatbot, host=host, port=port)
+        else:
+            serve_stdin(chatbot)
+    finally:
+        chatbot.close()
+
+
+if __name__ == '__main__':
+    main()
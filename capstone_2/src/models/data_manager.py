@@ -3,6 +3,7 @@ import os
 import re
 import joblib
 import logging
+import numpy as np
 
 
 class DataManager:
@@ -399,10 +400,8 @@ class DataManager:
         # Clean question
         question = self.expand_contractions(question)
 
-        # Load dict for word -> int
-        file_path = '{0}/questions_int_to_vocab.pkl'.format(self._def_processed_path)
-        questions_int_to_vocab = joblib.load(file_path)
-        questions_vocab_to_int = {v_i: v for v, v_i in questions_int_to_vocab.items()}
+        # Dict for word -> int, kept in memory since __init__
+        questions_vocab_to_int = self.questions_vocab_to_int
 
         # Convert text to ints
         tokens = []
@@ -428,6 +427,14 @@ class DataManager:
 
         return sentence
 
+    def get_answers_vocab_counts(self):
+        """Occurrences of each answer token in the sorted answers, indexed by token.
+
+        Every count is incremented by one so that tokens that never occur in an answer keep a nonzero frequency.
+        """
+        tokens = [token for answer in self.sorted_answers for token in answer]
+        return np.bincount(tokens, minlength=len(self.answers_vocab_to_int)) + 1
+
     def get_cornell_starting_prompts(self):
 
         questions = [
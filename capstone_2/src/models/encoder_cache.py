@@ -0,0 +1,62 @@
+
+from collections import OrderedDict
+
+#
+# Encoder Cache
+# Least recently used cache of encoder representations
+#
+
+
+class EncoderCache:
+    """Bounded cache of encoder representations keyed by token tuple.
+
+    Entries are evicted in least recently used order once max_size is reached. A cached representation
+    is only valid for the weights it was computed with, so owners clear the cache when weights change.
+    """
+
+    def __init__(self, max_size=1024):
+
+        # Maximum number of cached representations
+        self.max_size = max_size
+
+        # Cached representations, ordered from least to most recently used
+        self._entries = OrderedDict()
+
+        # Lookup counters
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tokens):
+        """Returns the cached representation of tokens, or None."""
+        key = self.key(tokens)
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, tokens, value):
+        """Caches the representation of tokens."""
+        if self.max_size <= 0:
+            return
+
+        key = self.key(tokens)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops all cached representations."""
+        self._entries.clear()
+
+    @staticmethod
+    def key(tokens):
+        """Cache key of a token list."""
+        return tuple(int(token) for token in tokens)
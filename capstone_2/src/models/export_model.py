@@ -0,0 +1,137 @@
+
+import click
+import logging
+import numpy as np
+import tensorflow as tf
+from src.models.data_manager import DataManager
+from src.models.seqtoseq_graph import SeqToSeqGraph
+from src.models.seqtoseq_model import SeqToSeqModel
+
+#
+# Inference export
+# Frozen graph with the encoder and beam decoder only, for the chatbot service
+#
+
+# Names of the beam search outputs in the exported graph
+_OUTPUT_NAMES = ['Outputs/scores', 'Outputs/predicted_ids', 'Outputs/parent_ids']
+
+
+def export_inference_graph(model_name, export_path=None, float16=False):
+    """Writes a frozen beam search graph of a trained seq2seq model.
+
+    The graph is pruned to the ops between the Inputs/input_data and Inputs/input_sequence_length placeholders and
+    the beam search outputs, with the variables folded into constants. Optimizer slots and training ops are not
+    part of it.
+
+    :param model_name:
+        Name of the saved seq2seq model.
+    :param export_path:
+        Path of the frozen graph, get_export_path(model_name) if None.
+    :param float16:
+        Stores weights as float16 constants, cast back to float32 when the graph runs. Halves the artifact size
+        at a small loss of precision.
+    :return:
+        The export path.
+    """
+    data_manager = DataManager()
+    model = SeqToSeqModel(model_name=model_name)
+    export_path = get_export_path(model_name) if export_path is None else export_path
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as session:
+
+        # Build the beam decoder and restore its variables
+        model_graph = SeqToSeqGraph(model, data_manager, graph=graph)
+        beam_output = model_graph.beam()
+        with tf.name_scope('Outputs'):
+            tf.identity(beam_output.scores, name='scores')
+            tf.identity(beam_output.predicted_ids, name='predicted_ids')
+            tf.identity(beam_output.parent_ids, name='parent_ids')
+        model_graph.restore(session)
+
+        graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(), _OUTPUT_NAMES)
+
+    if float16:
+        graph_def = _to_float16(graph_def)
+
+    with tf.gfile.GFile(export_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    logging.info('Inference graph of model {0} exported to {1} ({2} nodes).'.format(
+        model_name, export_path, len(graph_def.node)))
+
+    return export_path
+
+
+def load_inference_graph(export_path):
+    """Loads a graph written by export_inference_graph.
+
+    :return:
+        A tuple (graph, beam_output), beam_output holds the scores, predicted_ids and parent_ids tensors like the
+        output of SeqToSeqModel.predict_beam_load_model.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(export_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+
+    scores, predicted_ids, parent_ids = [graph.get_tensor_by_name(name + ':0') for name in _OUTPUT_NAMES]
+    beam_output = tf.contrib.seq2seq.BeamSearchDecoderOutput(
+        scores=scores, predicted_ids=predicted_ids, parent_ids=parent_ids)
+
+    logging.info('Inference graph loaded from {0}.'.format(export_path))
+
+    return graph, beam_output
+
+
+def get_export_path(model_name):
+    """Default path of the frozen graph, next to the model checkpoint."""
+    return '{0}/{1}-inference.pb'.format(SeqToSeqModel(model_name=model_name)._get_save_dir(), model_name)
+
+
+def _to_float16(graph_def, min_elements=1024):
+    """Replaces float32 constants of at least min_elements values with float16 constants and a cast."""
+    converted = tf.GraphDef()
+    converted.versions.CopyFrom(graph_def.versions)
+    converted.library.CopyFrom(graph_def.library)
+
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr['value'].tensor)
+            if value.size >= min_elements:
+                half = converted.node.add()
+                half.op = 'Const'
+                half.name = node.name + '/float16'
+                half.device = node.device
+                half.input.extend(node.input)
+                half.attr['dtype'].type = tf.float16.as_datatype_enum
+                half.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float16)))
+
+                # The cast keeps the name of the constant, so its consumers are unchanged
+                cast = converted.node.add()
+                cast.op = 'Cast'
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(half.name)
+                cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+                cast.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+
+        converted.node.add().CopyFrom(node)
+
+    return converted
+
+
+@click.command()
+@click.option('--model-name', default='test-policy', help='Name of the saved seq2seq model.')
+@click.option('--export-path', default=None, help='Path of the frozen graph.')
+@click.option('--float16', is_flag=True, help='Store weights as float16.')
+def main(model_name, export_path, float16):
+    """Exports the inference graph of a trained seq2seq model."""
+    print(export_inference_graph(model_name, export_path=export_path, float16=float16))
+
+
+if __name__ == '__main__':
+    main()
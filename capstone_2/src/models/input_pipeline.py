@@ -0,0 +1,159 @@
+
+import logging
+import queue
+import threading
+import time
+
+#
+# Input pipeline for training
+# Background producer that prefetches batches into a bounded queue
+#
+
+
+class BatchPrefetcher:
+    """Produces batches on a background thread so that batch preparation overlaps the training step."""
+
+    _end_of_data = object()
+
+    def __init__(self, batch_generator, capacity=4, name=None):
+        """
+        :param batch_generator:
+            Callable returning an iterator over batches. It is called on the producer thread, so any shuffling
+            or padding it does runs concurrently with the consumer.
+        :param capacity:
+            Maximum number of batches waiting in the queue. A capacity of 0 disables the background thread and
+            batches are produced synchronously by the consumer.
+        :param name:
+            Name used in log messages.
+        """
+
+        self.batch_generator = batch_generator
+        self.capacity = capacity
+        self.name = name
+
+        self._queue = queue.Queue(maxsize=max(capacity, 1))
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._error = None
+
+        # Starvation counters
+        # Number of batches handed to the consumer
+        self.batches = 0
+
+        # Number of batches the consumer had to wait for
+        self.starved_batches = 0
+
+        # Total time the consumer spent waiting for batches
+        self.wait_time = 0.
+
+        # Total time the producer spent building batches
+        self.produce_time = 0.
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        if self.capacity <= 0:
+            yield from self._iter_sync()
+            return
+
+        self.start()
+        while True:
+            start_time = time.time()
+            try:
+                batch = self._queue.get_nowait()
+            except queue.Empty:
+                self.starved_batches += 1
+                batch = self._queue.get()
+            self.wait_time += time.time() - start_time
+
+            if batch is self._end_of_data:
+                break
+
+            self.batches += 1
+            yield batch
+
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def start(self):
+        """Starts the producer thread."""
+        if self.capacity <= 0 or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._produce, name=self.name, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the producer thread and discards any prefetched batches."""
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def stats(self):
+        """Returns the starvation counters as a dictionary."""
+        return {
+            'batches': self.batches,
+            'starved_batches': self.starved_batches,
+            'wait_time': self.wait_time,
+            'produce_time': self.produce_time
+        }
+
+    def _iter_sync(self):
+        """Produces batches on the consumer thread."""
+        batches = iter(self.batch_generator())
+        while True:
+            start_time = time.time()
+            batch = next(batches, self._end_of_data)
+            elapsed = time.time() - start_time
+            self.wait_time += elapsed
+            self.produce_time += elapsed
+
+            if batch is self._end_of_data:
+                break
+
+            self.starved_batches += 1
+            self.batches += 1
+            yield batch
+
+    def _produce(self):
+        """Producer thread body."""
+        try:
+            batches = iter(self.batch_generator())
+            while not self._stop_event.is_set():
+                start_time = time.time()
+                batch = next(batches, self._end_of_data)
+                self.produce_time += time.time() - start_time
+
+                if batch is self._end_of_data:
+                    break
+
+                self._put(batch)
+
+        except Exception as e:
+            logging.error('Batch producer {0} failed: {1}'.format(self.name, e))
+            self._error = e
+
+        finally:
+            self._put(self._end_of_data)
+
+    def _put(self, item):
+        """Puts an item on the queue unless the prefetcher is being closed."""
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
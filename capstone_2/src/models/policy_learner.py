@@ -0,0 +1,175 @@
+
+import logging
+import threading
+import tensorflow as tf
+from src.models.input_pipeline import BatchPrefetcher
+from src.models.seqtoseq_graph import SeqToSeqGraph
+from src.models.seqtoseq_model import SeqToSeqModel
+
+#
+# Policy Learner
+# Persistent training graph for policy gradient updates
+#
+
+
+class PolicyLearner:
+    """Seq2seq training graph kept alive across policy gradient updates.
+
+    The graph is built and the seq2seq checkpoint restored once, so optimizer state carries over from one
+    update to the next. Checkpoints are written from a snapshot of the variables on a background thread,
+    so training continues while the checkpoint is written.
+    """
+
+    def __init__(self, data_manager, seq2seq_model_name='test-policy', epochs=1):
+
+        self.data_manager = data_manager
+        self.seq2seq_model_name = seq2seq_model_name
+
+        # Passes over the trajectories in each update
+        self.epochs = epochs
+
+        # Initialize a graph and session that live as long as the learner
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph)
+
+        # Create seq2seq model instance
+        self.model = SeqToSeqModel(model_name=self.seq2seq_model_name)
+
+        # Background checkpoint
+        self._save_thread = None
+        self._save_error = None
+
+        self._create_model_graph()
+
+        logging.info('Policy learner initialized.')
+
+    def train_steps(self, padded_data):
+        """Runs optimizer steps over the padded trajectories.
+
+        :param padded_data:
+            A tuple (pad_questions, pad_answers, q_sequence_length, a_sequence_length, pad_rewards) as returned
+            by SeqToSeqModel.pad_data.
+        :return:
+            The mean loss of the steps.
+        """
+        num_samples = len(padded_data[0])
+        batch_size = min(self.model.batch_size, num_samples)
+        if batch_size == 0:
+            raise ValueError('No trajectories to train on.')
+
+        def epoch_batches():
+            shuffled_index = self.model._shuffle_training_data(num_samples)
+            return self.model.batch_padded_data(padded_data, batch_size, shuffled_index)
+
+        total_loss = 0.
+        num_steps = 0
+        for epoch_i in range(1, self.epochs + 1):
+            with BatchPrefetcher(epoch_batches, capacity=self.model.prefetch_batches,
+                                 name='Policy epoch {0} batches'.format(epoch_i)) as batches:
+                for questions_batch, answers_batch, q_sequence_length_batch, a_sequence_length_batch, \
+                        rewards_batch in batches:
+
+                    feed_dict = {
+                        self.input_data: questions_batch,
+                        self.targets: answers_batch,
+                        self.lr: self.model.learning_rate,
+                        self.input_sequence_length: q_sequence_length_batch,
+                        self.output_sequence_length: a_sequence_length_batch,
+                        self.rewards: rewards_batch
+                    }
+                    _, loss = self.session.run([self.train_op, self.cost], feed_dict=feed_dict)
+
+                    total_loss += loss
+                    num_steps += 1
+
+            logging.info('Policy epoch {0} input pipeline: {1}'.format(epoch_i, batches.stats()))
+
+        mean_loss = total_loss / num_steps
+        logging.info('Policy learner ran {0} steps, loss: {1}'.format(num_steps, mean_loss))
+
+        return mean_loss
+
+    def get_weights(self):
+        """Returns the current seq2seq weights keyed by variable name."""
+        return self.model.get_weights(self.session)
+
+    def save_async(self):
+        """Checkpoints the learner on a background thread.
+
+        The variables are copied before returning, so later steps do not leak into the checkpoint. A save
+        requested while the previous one is still being written is skipped.
+
+        :return:
+            True if a save was started.
+        """
+        self._raise_save_error()
+        if self._save_thread is not None and self._save_thread.is_alive():
+            logging.info('Checkpoint still being written, skipping save.')
+            return False
+
+        self.session.run(self._snapshot_op)
+        self._save_thread = threading.Thread(target=self._save, name='PolicyLearnerCheckpoint', daemon=True)
+        self._save_thread.start()
+        return True
+
+    def wait(self):
+        """Waits for the checkpoint being written, if any."""
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+        self._raise_save_error()
+
+    def close(self):
+        """Waits for the checkpoint being written and closes the session."""
+        try:
+            self.wait()
+        finally:
+            self.session.close()
+
+    def _save(self):
+        """Checkpoint thread body."""
+        save_path = self.model._get_model_save_path()
+        try:
+            self._snapshot_saver.save(self.session, save_path)
+            logging.info('Saved model {0} to disk.'.format(save_path))
+        except Exception as e:
+            logging.error('Checkpoint {0} failed: {1}'.format(save_path, e))
+            self._save_error = e
+
+    def _raise_save_error(self):
+        """Re-raises the error of the last background save."""
+        if self._save_error is not None:
+            error, self._save_error = self._save_error, None
+            raise error
+
+    def _create_model_graph(self):
+        """Creates the seq2seq training graph and restores the seq2seq checkpoint."""
+        with self.graph.as_default():
+
+            # Build the training graph with the reward term in the loss
+            model_graph = SeqToSeqGraph(self.model, self.data_manager, graph=self.graph)
+            self.input_data, self.targets, self.lr, self.input_sequence_length, self.output_sequence_length = \
+                model_graph.inputs()
+            self.rewards = model_graph.rewards
+            self.cost, self.train_op = model_graph.train(reward_loss=True)
+
+            # Copies of all variables, written to the checkpoint under the names of the originals
+            variables = tf.global_variables()
+            with tf.name_scope('Checkpoint'):
+                snapshots = [
+                    tf.Variable(tf.zeros(variable.get_shape(), variable.dtype.base_dtype), trainable=False,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES], name=variable.op.name)
+                    for variable in variables]
+                self._snapshot_op = tf.group(
+                    *[tf.assign(snapshot, variable) for snapshot, variable in zip(snapshots, variables)])
+            self._snapshot_saver = tf.train.Saver(
+                {variable.op.name: snapshot for variable, snapshot in zip(variables, snapshots)})
+
+            # Initialize the model variables
+            self.session.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+
+            # Restore session
+            saver = tf.train.Saver(variables)
+            save_path = self.model._get_model_save_path()
+            saver.restore(self.session, save_path)
+            logging.info('Saved model {0} loaded from disk.'.format(save_path))
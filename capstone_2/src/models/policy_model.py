@@ -1,12 +1,13 @@
 
 import logging
 import os
-import numpy as np
-from collections import deque
 import tensorflow as tf
 from src.models.data_manager import DataManager
 from src.models.agent import PolicyAgent
+from src.models.policy_learner import PolicyLearner
 from src.models.seqtoseq_model import SeqToSeqModel
+from src.models.self_play import SelfPlayPool, play_games
+from src.models.trajectory_buffer import TrajectoryBuffer
 
 
 class PolicyGradientModel:
@@ -17,6 +18,9 @@ class PolicyGradientModel:
                  actions=5,
                  epochs=1,
                  seq2seq_model_name='test-policy',
+                 num_workers=0,
+                 buffer_size=100000,
+                 discount=1.,
                  model_name=None):
         """Model Parameters Init."""
 
@@ -24,6 +28,9 @@ class PolicyGradientModel:
         self.actions = actions
         self.epochs = epochs
         self.seq2seq_model_name = seq2seq_model_name
+        self.num_workers = num_workers
+        self.buffer_size = buffer_size
+        self.discount = discount
         self.model_name = model_name
 
         # Initialize Data Manager
@@ -35,6 +42,27 @@ class PolicyGradientModel:
         # Early stop criteria
         self.early_stop = 1
 
+        # Agent pool, built once and updated in memory after each training step
+        self.agents = {}
+
+        # Training graph, built on the first training step and kept for the whole curriculum
+        self.learner = None
+
+        # Latest weights of the learner, None until the first training step
+        self.policy_weights = None
+
+        # Self-play worker processes, used instead of the agent pool when num_workers > 0
+        self.self_play_pool = None
+        self._pending_turns = None
+
+        # Moves of the current epoch, bounded to buffer_size moves
+        self.trajectory_buffer = TrajectoryBuffer(
+            buffer_size,
+            SeqToSeqModel(model_name=seq2seq_model_name).max_sequence_length,
+            self.data_manager.questions_vocab_to_int['<PAD>'],
+            self.data_manager.answers_vocab_to_int['<PAD>'],
+            discount=discount)
+
         logging.info('Policy Gradient Model Initialized.')
 
     def fit(self):
@@ -79,164 +107,116 @@ class PolicyGradientModel:
             logging.info('End training for turn: {0} out of {0}'.format(turn, self.turns))
             logging.info('------------------------------------------------------------------------')
 
+        # Close agents and the learner, waiting for its last checkpoint
+        self._close_agents()
+        if self.learner is not None:
+            self.learner.close()
+            self.learner = None
+        if self.self_play_pool is not None:
+            self.self_play_pool.close()
+            self.self_play_pool = None
+            self._pending_turns = None
+
         return
 
     def play(self, num_turns, min_game_loss, num_agents=2):
         """Plays a game using curriculum learning strategy for the number of turns."""
 
-        # Dictionary to store model inputs for training after a game.
-        model_inputs = {
-            'request': [],
-            'response': [],
-            'probability': [],
-            'reward': []
-        }
-
-        # Create Agents
-        agents = {}
-        for agent_id in range(num_agents):
-            agent_name = 'Agent_{0}'.format(agent_id + 1)
-            agents[agent_id] = PolicyAgent(seq2seq_model_name=self.seq2seq_model_name, agent_name=agent_name)
-
-        # Add each starting prompt to initial states
-        for prompt in self.starting_prompts:
-
-            logging.info('Starting game...')
-
-            # Queue for tracking moves for each agent
-            # Also stores trajectory (state, action, response) tuples
-            # Stores (agent_id, last_response, request, turn, trajectory)
-            state_queue = deque()
-
-            # Pick a random agent
-            agent_id = np.random.randint(0, num_agents)
-
-            # Add starting state
-            state_queue.append((agent_id, None, prompt, 0, []))
-
-            # Play
-            while len(state_queue) > 0:
-
-                # Pop the first state
-                agent_id, last_response, request, turn, trajectory = state_queue.popleft()
-
-                logging.info('Game: Agent: {0}, Turn: {1} : {2}, {3}'.format(agent_id,
-                                                                             turn,
-                                                                             self._answer_from_tokens(last_response),
-                                                                             self._answer_from_tokens(request)))
-
-                # Check if the agent needs to play further
-                if turn < num_turns*num_agents:
-                    # Get responses from the agent
-                    responses, probs, rewards = agents[agent_id].play((last_response, request))
-
-                    # logging.info(
-                    #     'Agent returned:\nResponses: {0}\nProbabilities: {1}\nRewards: {2}'.format(
-                    #         responses, probs, rewards))
-
-                    # Add states for the next agent
-                    next_agent_id = (agent_id + 1) % num_agents
-                    for i in range(len(responses)):
-                        response = responses[i]
-                        trajectory_tuple = (request, response, probs[i], rewards[i])
-                        trajectory.append(trajectory_tuple)
-                        state_queue.append((next_agent_id, request, response, turn+1, trajectory))
-                else:
-                    for track in trajectory:
-                        request, response, probability, reward = track
-                        model_inputs['request'].append(request)
-                        model_inputs['response'].append(response)
-                        model_inputs['probability'].append(probability)
-                        model_inputs['reward'].append(self._reward_to_go(reward))
-
-        # Close agents
-        for agent_id in range(num_agents):
-            agents[agent_id].close()
+        # Play all games, streaming their moves into the trajectory buffer
+        self.trajectory_buffer.clear()
+        if self.num_workers > 0:
+            self.trajectory_buffer.extend(self._play_games_parallel(num_turns, num_agents))
+        else:
+            agents = self._get_agents(num_agents)
+            play_games(agents, self.starting_prompts, num_turns, trajectories=self.trajectory_buffer)
 
         # Train for the next iteration
-        game_loss = self.train(model_inputs, min_game_loss)
+        game_loss = self.train(self.trajectory_buffer, min_game_loss)
 
         return game_loss
 
-    def train(self, model_inputs, min_game_loss):
-
-        # Start the session
-        with tf.Graph().as_default() as graph, tf.Session() as session:
+    def _play_games_parallel(self, num_turns, num_agents):
+        """Collects the games of this epoch from the self-play workers.
 
-            # Create a seq to seq model
-            model = SeqToSeqModel(model_name=self.seq2seq_model_name)
-
-            # Load the model inputs
-            input_data, targets, lr, input_sequence_length, output_sequence_length = model.model_inputs()
-            rewards = graph.get_tensor_by_name('Inputs/rewards:0')
+        The games of the next epoch are queued before returning, so that the workers keep playing while the
+        learner trains. Those games are played with the weights available when each game starts.
+        """
 
-            # Model Graph Variables
-            model.model_graph_vars(self.data_manager)
+        if self.self_play_pool is None:
+            self.self_play_pool = SelfPlayPool(self.num_workers, self.seq2seq_model_name, num_agents=num_agents)
 
-            # Create Encoder
-            encoder_output, encoder_state = model._get_encoder(input_data, input_sequence_length)
+        num_games = len(self.starting_prompts)
 
-            # Create Decoder for Training
-            train_logits = model._get_decoder_train(
-                targets, encoder_output, encoder_state, input_sequence_length, self.data_manager)
+        # Cancel prefetched games of a different curriculum turn, waiting only for the games already started
+        if self._pending_turns is not None and self._pending_turns != num_turns:
+            num_cancelled = self.self_play_pool.cancel()
+            logging.info('Cancelled {0} prefetched games for {1} turns.'.format(num_cancelled, self._pending_turns))
+            self._pending_turns = None
 
-            with tf.name_scope("optimization"):
-                # Compute weight mask
-                mask = tf.sequence_mask(output_sequence_length, model.max_sequence_length, dtype=tf.float32)
+        if self._pending_turns is None:
+            self.self_play_pool.submit(self.starting_prompts, num_turns)
 
-                # Loss function
-                cost = tf.contrib.seq2seq.sequence_loss(
-                    train_logits,
-                    targets,
-                    mask)
+        trajectories = self.self_play_pool.collect(num_games)
 
-                total_cost = tf.add(cost, tf.reduce_mean(rewards))
+        # Queue the games of the next epoch
+        self.self_play_pool.submit(self.starting_prompts, num_turns)
+        self._pending_turns = num_turns
 
-                # Optimizer
-                optimizer = tf.train.AdamOptimizer(model.learning_rate)
+        return trajectories
 
-                # Gradient Clipping
-                gradients = optimizer.compute_gradients(total_cost)
-                capped_gradients = [
-                    (tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
-                train_op = optimizer.apply_gradients(capped_gradients)
+    def train(self, trajectory_buffer, min_game_loss):
+        """Runs policy gradient steps on the moves of the trajectory buffer.
 
-            session.run(tf.global_variables_initializer())
+        The learner is checkpointed in the background whenever the game loss improves on min_game_loss.
 
-            # Train
-            questions = model_inputs['request']
-            answers = model_inputs['response']
-            rewards = -1*np.multiply(model_inputs['reward'], model_inputs['probability'])
-            l_rewards = rewards.tolist()
-            for i in range(len(l_rewards)):
-                l_rewards[i] = l_rewards[i].tolist()
-            summary_train_loss, summary_valid_loss = model.train(
-                session, questions, answers, train_op, total_cost, self.data_manager, rewards=l_rewards,
-                min_valid_loss=min_game_loss)
+        :return:
+            The mean loss of the steps.
+        """
 
-            logging.info('Summary Train Loss: \n{0}'.format(summary_train_loss))
-            logging.info('Summary Valid Loss: \n{0}'.format(summary_valid_loss))
+        learner = self._get_learner()
 
-        return min(summary_valid_loss)
+        # Train
+        requests, responses, request_lengths, response_lengths, probabilities, rewards_to_go = \
+            trajectory_buffer.padded_data()
+        padded_data = (requests, responses, request_lengths, response_lengths, -1*rewards_to_go*probabilities)
+        game_loss = learner.train_steps(padded_data)
 
-    # Rewards to go
-    @staticmethod
-    def _reward_to_go(rewards):
-        n = len(rewards)
-        rtgs = np.zeros_like(rewards)
-        for i in reversed(range(n)):
-            rtgs[i] = rewards[i] + (rtgs[i + 1] if i + 1 < n else 0)
+        if min_game_loss is None or min_game_loss > game_loss:
+            logging.info('New Record!')
+            learner.save_async()
 
-        rtgs /= len(rewards)
-        return rtgs
+        # Push the updated policy to the agents and the self-play workers
+        self.policy_weights = learner.get_weights()
+        for agent in self.agents.values():
+            agent.set_weights(self.policy_weights)
+        if self.self_play_pool is not None:
+            self.self_play_pool.set_weights(self.policy_weights)
 
-    def _answer_from_tokens(self, tokens):
-        """Converts integers tokens to text."""
-        if tokens is None:
-            return None
+        return game_loss
 
-        answer = self.data_manager.answer_from_tokens(tokens)
-        return answer
+    def _get_learner(self):
+        """Returns the learner, restoring the seq2seq checkpoint on first use."""
+        if self.learner is None:
+            self.learner = PolicyLearner(self.data_manager, seq2seq_model_name=self.seq2seq_model_name)
+        return self.learner
+
+    def _get_agents(self, num_agents):
+        """Returns the agent pool, creating the agents graphs on first use."""
+
+        if len(self.agents) != num_agents:
+            self._close_agents()
+            for agent_id in range(num_agents):
+                agent_name = 'Agent_{0}'.format(agent_id + 1)
+                self.agents[agent_id] = PolicyAgent(seq2seq_model_name=self.seq2seq_model_name,
+                                                    agent_name=agent_name)
+
+        return self.agents
+
+    def _close_agents(self):
+        """Closes the agent pool."""
+        for agent in self.agents.values():
+            agent.close()
+        self.agents = {}
 
     def _save_model(self, session):
         """ Saves model to the disk. Should be called only by fit.
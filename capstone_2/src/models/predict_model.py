@@ -3,8 +3,10 @@ import logging
 import os
 import numpy as np
 from datetime import datetime
+from src.models.beam_search import beam_responses
 from src.models.data_manager import DataManager
 from src.models.seqtoseq_model import SeqToSeqModel
+from src.models.chatbot import Chatbot, serve_stdin
 
 # Function to predict SeqToSeq models
 
@@ -82,14 +84,11 @@ def predict_seqtoseq_beam(question, model_name=None):
     # Make Prediction
     scores, predicted_ids, parent_ids = model.predict_beam(q_tokens, d)
     beam_width = model.beam_width
+    end_of_sequence_id = d.answers_vocab_to_int['<EOS>']
+    tokens, probabilities, lengths = beam_responses(scores, predicted_ids, parent_ids, end_of_sequence_id)
     answers = []
     for i in range(beam_width):
-        a_tokens = []
-        for j in range(model.max_sequence_length):
-            token = predicted_ids[j][i]
-            if token == d.answers_vocab_to_int['<EOS>']:
-                break
-            a_tokens.append(token)
+        a_tokens = [token for token in tokens[:lengths[i], i] if token != end_of_sequence_id]
 
         # Convert answer to text
         answer = d.answer_from_tokens(a_tokens)
@@ -103,17 +102,29 @@ def predict_seqtoseq_beam(question, model_name=None):
     return answers[0]
 
 
-def predict_loop(model_name=None, num_turns=8):
+def predict_loop(model_name=None, num_turns=8, export_path=None):
     """Creates a chatbot loop."""
 
-    print('Hello!')
-    for i in range(num_turns):
-        question = input('> ')
-        if question == 'exit':
-            print('Goodbye!')
-            break
-        answer = predict_seqtoseq_beam(question, model_name=model_name)
-        print(answer)
+    #
+    # Configure logging
+    #
+    abs_path = os.path.abspath(os.path.dirname(__file__))
+    logs_dir = os.path.join(abs_path, '../../logs')
+    if not os.path.exists(logs_dir):
+        os.mkdir(logs_dir)
+        os.chmod(logs_dir, 0o777)
+    log_path = os.path.join(abs_path, '../../logs/run-{0}.log')
+    logging.basicConfig(filename=log_path.format(datetime.now().strftime('%Y%m%d-%H%M%S')),
+                        level=logging.INFO,
+                        format='%(asctime)s-%(process)d-%(name)s-%(levelname)s-%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    # Load the model once for the whole conversation
+    chatbot = Chatbot(model_name=model_name, export_path=export_path)
+    try:
+        serve_stdin(chatbot, num_turns=num_turns)
+    finally:
+        chatbot.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,46 @@
+
+import numpy as np
+
+#
+# Reinforcement learning utilities
+# Array operations on padded [N, T] reward matrices
+#
+
+
+def sequence_mask(lengths, max_length):
+    """Boolean [N, max_length] mask, True for the first lengths[i] steps of row i."""
+    return np.arange(max_length) < np.asarray(lengths)[:, np.newaxis]
+
+
+def reward_to_go(rewards, lengths, discount=1., normalize=True):
+    """Rewards to go of all rows of a padded reward matrix.
+
+    :param rewards:
+        Array of shape [N, T], steps past the length of a row are ignored.
+    :param lengths:
+        Length of each row.
+    :param discount:
+        Discount factor applied to future rewards.
+    :param normalize:
+        Divides the rewards to go of each row by its length.
+    :return:
+        Float array of shape [N, T] with rtg[i, t] = sum_k discount^(k-t) * rewards[i, k] over t <= k < lengths[i],
+        and zeros past the length of each row.
+    """
+    lengths = np.asarray(lengths)
+    mask = sequence_mask(lengths, rewards.shape[1])
+    rewards = np.where(mask, rewards, 0.)
+
+    if discount == 1.:
+        rtgs = np.cumsum(rewards[:, ::-1], axis=1)[:, ::-1]
+    else:
+        rtgs = np.zeros_like(rewards)
+        future = np.zeros(len(rewards), dtype=rewards.dtype)
+        for t in reversed(range(rewards.shape[1])):
+            future = rewards[:, t] + discount * future
+            rtgs[:, t] = future
+
+    if normalize:
+        rtgs /= np.maximum(lengths, 1)[:, np.newaxis]
+
+    return rtgs
@@ -0,0 +1,233 @@
+
+import logging
+import multiprocessing
+import queue
+import traceback
+import numpy as np
+from src.models.agent import PolicyAgent
+
+#
+# Self-play rollouts
+# Game engine shared by the learner process and the actor processes
+#
+
+
+def play_games(agents, prompts, num_turns, trajectories=None):
+    """Plays a game for each prompt.
+
+    :param agents:
+        Dictionary of PolicyAgent keyed by agent id.
+    :param prompts:
+        List of starting prompts as question tokens.
+    :param num_turns:
+        Number of turns each agent plays.
+    :param trajectories:
+        Object with an append method, such as a list or a TrajectoryBuffer, that receives every move as soon as
+        it is played. A new list is used if None.
+    :return:
+        The (request, response, probability, reward) trajectory tuples, each move is recorded once.
+    """
+
+    num_agents = len(agents)
+    data_manager = agents[0].data_manager
+
+    # Moves of all games
+    if trajectories is None:
+        trajectories = []
+
+    # Add each starting prompt to initial states
+    # Stores (agent_id, last_response, request, turn)
+    states = []
+    for prompt in prompts:
+
+        logging.info('Starting game...')
+
+        # Pick a random agent
+        agent_id = np.random.randint(0, num_agents)
+
+        # Add starting state
+        states.append((agent_id, None, prompt, 0))
+
+    # Play all games one turn at a time, so that each agent decodes
+    # the pending states of a turn in batched beam searches
+    while len(states) > 0:
+
+        next_states = []
+        for agent_id in range(num_agents):
+
+            # States this agent has to play in this turn
+            agent_states = []
+            for state in states:
+                _agent_id, last_response, request, turn = state
+                if _agent_id != agent_id:
+                    continue
+
+                logging.info('Game: Agent: {0}, Turn: {1} : {2}, {3}'.format(
+                    agent_id,
+                    turn,
+                    None if last_response is None else data_manager.answer_from_tokens(last_response),
+                    data_manager.answer_from_tokens(request)))
+
+                # Check if the agent needs to play further
+                if turn < num_turns*num_agents:
+                    agent_states.append(state)
+
+            if len(agent_states) == 0:
+                continue
+
+            # Get responses from the agent for all of its states
+            agent_results = agents[agent_id].play_batch(
+                [(last_response, request) for _, last_response, request, _ in agent_states])
+
+            # Add states for the next agent
+            next_agent_id = (agent_id + 1) % num_agents
+            for (_, _, request, turn), (responses, probs, rewards) in zip(agent_states, agent_results):
+                for i in range(len(responses)):
+                    response = responses[i]
+                    trajectories.append((request, response, probs[i], rewards[i]))
+                    next_states.append((next_agent_id, request, response, turn+1))
+
+        states = next_states
+
+    return trajectories
+
+
+def _self_play_worker(worker_id, seq2seq_model_name, num_agents, prompt_queue, weights_queue, trajectory_queue):
+    """Actor process body, plays games from the prompt queue with the latest weights of the learner."""
+
+    # Allow the worker to exit with trajectories the learner will not collect
+    trajectory_queue.cancel_join_thread()
+
+    # Create Agents
+    agents = {}
+    for agent_id in range(num_agents):
+        agent_name = 'Worker_{0}_Agent_{1}'.format(worker_id, agent_id + 1)
+        agents[agent_id] = PolicyAgent(seq2seq_model_name=seq2seq_model_name, agent_name=agent_name)
+
+    while True:
+        task = prompt_queue.get()
+        if task is None:
+            break
+
+        # Use the most recent weights pushed by the learner
+        weights = None
+        while True:
+            try:
+                weights = weights_queue.get_nowait()
+            except queue.Empty:
+                break
+        if weights is not None:
+            for agent in agents.values():
+                agent.set_weights(weights)
+
+        game_id, prompt, num_turns = task
+        try:
+            trajectories = play_games(agents, [prompt], num_turns)
+        except Exception:
+            trajectory_queue.put((game_id, None, traceback.format_exc()))
+            continue
+
+        trajectory_queue.put((game_id, trajectories, None))
+
+    # Close agents
+    for agent in agents.values():
+        agent.close()
+
+
+class SelfPlayPool:
+    """Actor processes that play self-play games from a shared prompt queue.
+
+    Each worker holds its own agents, takes (prompt, num_turns) games from the prompt queue and streams the
+    trajectories of every finished game back to the learner. Weights pushed with set_weights are picked up by
+    each worker before its next game.
+    """
+
+    def __init__(self, num_workers, seq2seq_model_name, num_agents=2):
+
+        self.num_workers = num_workers
+        self.seq2seq_model_name = seq2seq_model_name
+        self.num_agents = num_agents
+
+        # TensorFlow is not fork safe, workers start in fresh interpreters
+        context = multiprocessing.get_context('spawn')
+        self.prompt_queue = context.Queue()
+        self.trajectory_queue = context.Queue()
+        self.weights_queues = [context.Queue() for _ in range(num_workers)]
+
+        self.workers = []
+        for worker_id in range(num_workers):
+            worker = context.Process(
+                target=_self_play_worker,
+                args=(worker_id, seq2seq_model_name, num_agents,
+                      self.prompt_queue, self.weights_queues[worker_id], self.trajectory_queue),
+                name='SelfPlayWorker-{0}'.format(worker_id),
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        # Id of the next game and number of submitted games not collected yet
+        self._next_game_id = 0
+        self.pending_games = 0
+
+        logging.info('Self-play pool started with {0} workers.'.format(num_workers))
+
+    def submit(self, prompts, num_turns):
+        """Queues a game for each prompt."""
+        for prompt in prompts:
+            self.prompt_queue.put((self._next_game_id, prompt, num_turns))
+            self._next_game_id += 1
+            self.pending_games += 1
+
+    def collect(self, num_games):
+        """Waits for num_games finished games and returns their trajectories in submission order."""
+        results = []
+        for _ in range(num_games):
+            game_id, trajectories, error = self.trajectory_queue.get()
+            self.pending_games -= 1
+            if error is not None:
+                raise RuntimeError('Self-play game {0} failed:\n{1}'.format(game_id, error))
+            results.append((game_id, trajectories))
+
+        results.sort(key=lambda result: result[0])
+        return [track for _, trajectories in results for track in trajectories]
+
+    def cancel(self):
+        """Discards the submitted games that were not collected.
+
+        Games still in the prompt queue are removed, only the games a worker already started are waited for.
+
+        :return:
+            The number of games removed from the prompt queue.
+        """
+        num_cancelled = self._drain_prompts()
+        self.pending_games -= num_cancelled
+        self.collect(self.pending_games)
+        return num_cancelled
+
+    def set_weights(self, weights):
+        """Pushes learner weights to all workers."""
+        for weights_queue in self.weights_queues:
+            weights_queue.put(weights)
+
+    def close(self):
+        """Stops the workers, discarding games that were not collected."""
+        self._drain_prompts()
+
+        for _ in self.workers:
+            self.prompt_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+        logging.info('Self-play pool stopped.')
+
+    def _drain_prompts(self):
+        """Removes the games no worker has started from the prompt queue and returns their number."""
+        num_games = 0
+        while True:
+            try:
+                self.prompt_queue.get_nowait()
+            except queue.Empty:
+                break
+            num_games += 1
+        return num_games
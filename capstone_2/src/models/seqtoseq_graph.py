@@ -0,0 +1,138 @@
+
+import logging
+import tensorflow as tf
+from src.models.data_manager import DataManager
+
+#
+# Seq2seq graph factory
+# Builds the parts of a SeqToSeqModel graph on demand, sharing one set of variables
+#
+
+
+class SeqToSeqGraph:
+    """Builds the inputs, encoder, greedy decoder, beam decoder and training ops of a SeqToSeqModel.
+
+    Each part is built at most once in the graph and reuses the parts it depends on, so that an inference
+    graph only holds the inference ops and model variables, without training decoder or optimizer slots.
+    """
+
+    def __init__(self, model, data_manager: DataManager, graph=None):
+        """
+        :param model:
+            SeqToSeqModel whose parameters shape the graph.
+        :param graph:
+            Graph to build into, the default graph if None.
+        """
+
+        self.model = model
+        self.data_manager = data_manager
+        self.graph = tf.get_default_graph() if graph is None else graph
+
+        # Built parts
+        self._inputs = None
+        self._encoder = None
+        self._greedy_output = None
+        self._beam_output = None
+        self._train_ops = {}
+
+    def inputs(self):
+        """Placeholders (input_data, targets, lr, input_sequence_length, output_sequence_length) and embeddings."""
+        if self._inputs is None:
+            with self.graph.as_default():
+                self._inputs = self.model.model_inputs()
+                self.model.model_graph_vars(self.data_manager)
+        return self._inputs
+
+    @property
+    def rewards(self):
+        """Rewards placeholder."""
+        self.inputs()
+        return self.graph.get_tensor_by_name('Inputs/rewards:0')
+
+    def encoder(self):
+        """Encoder (encoder_output, encoder_state)."""
+        if self._encoder is None:
+            input_data, _, _, input_sequence_length, _ = self.inputs()
+            with self.graph.as_default():
+                self._encoder = self.model._get_encoder(input_data, input_sequence_length)
+        return self._encoder
+
+    def greedy(self):
+        """Greedy decoder logits."""
+        if self._greedy_output is None:
+            input_sequence_length = self.inputs()[3]
+            encoder_output, encoder_state = self.encoder()
+            with self.graph.as_default():
+                self._greedy_output = self.model._get_decoder_infer(
+                    encoder_output, encoder_state, input_sequence_length, self.data_manager)
+        return self._greedy_output
+
+    def beam(self):
+        """Beam search decoder output."""
+        if self._beam_output is None:
+            input_sequence_length = self.inputs()[3]
+            encoder_output, encoder_state = self.encoder()
+            with self.graph.as_default():
+                self._beam_output = self.model._get_decoder_infer_beam(
+                    encoder_output, encoder_state, input_sequence_length, self.data_manager)
+        return self._beam_output
+
+    def train(self, reward_loss=False):
+        """Training decoder, loss and Adam optimizer.
+
+        :param reward_loss:
+            Adds the mean of the rewards placeholder to the loss, as in policy gradient training.
+        :return:
+            A tuple (cost, train_op).
+        """
+        if reward_loss not in self._train_ops:
+            if len(self._train_ops) > 0:
+                raise ValueError('The training ops of this graph are already built with another loss.')
+
+            input_data, targets, lr, input_sequence_length, output_sequence_length = self.inputs()
+            encoder_output, encoder_state = self.encoder()
+            with self.graph.as_default():
+
+                # Create Decoder for Training
+                train_logits, projection_layer = self.model._get_decoder_train(
+                    targets, encoder_output, encoder_state, input_sequence_length, self.data_manager)
+
+                with tf.name_scope("optimization"):
+                    # Compute weight mask
+                    mask = tf.sequence_mask(output_sequence_length, tf.shape(targets)[1], dtype=tf.float32)
+
+                    # Loss function
+                    cost = self.model.sequence_cost(train_logits, projection_layer, targets, mask,
+                                                    self.data_manager)
+                    if reward_loss:
+                        cost = tf.add(cost, tf.reduce_mean(self.rewards))
+
+                    # Optimizer
+                    optimizer = tf.train.AdamOptimizer(self.model.learning_rate)
+
+                    # Gradient Clipping
+                    gradients = optimizer.compute_gradients(cost)
+                    capped_gradients = [
+                        (tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
+                    train_op = optimizer.apply_gradients(capped_gradients)
+
+            self._train_ops[reward_loss] = (cost, train_op)
+
+        return self._train_ops[reward_loss]
+
+    def restore(self, session, save_path=None):
+        """Initializes the variables built so far and restores them from a checkpoint.
+
+        Checkpoint variables that are not part of this graph, such as optimizer slots in an inference graph,
+        are not loaded.
+
+        :param save_path:
+            Checkpoint path, the model checkpoint if None.
+        """
+        with self.graph.as_default():
+            session.run(tf.global_variables_initializer())
+
+            saver = tf.train.Saver(tf.global_variables())
+            save_path = self.model._get_model_save_path() if save_path is None else save_path
+            saver.restore(session, save_path)
+            logging.info('Saved model {0} loaded from disk.'.format(save_path))
@@ -5,7 +5,11 @@ import os
 import numpy as np
 import tensorflow as tf
 import time
+from datetime import datetime
 from src.models.data_manager import DataManager
+from src.models.input_pipeline import BatchPrefetcher
+from src.models.seqtoseq_graph import SeqToSeqGraph
+from src.models.training_metrics import TrainingMetrics
 
 #
 # Sequence to Sequence Model
@@ -29,6 +33,10 @@ class SeqToSeqModel:
                  keep_probability=0.75,
                  max_sequence_length=21,
                  beam_width=5,
+                 prefetch_batches=4,
+                 softmax='full',
+                 num_sampled=512,
+                 cell_type='basic',
                  model_name=None
                  ):
 
@@ -69,9 +77,29 @@ class SeqToSeqModel:
         # Beam width
         self.beam_width = beam_width
 
+        # Number of training batches prepared ahead on a background thread, 0 disables prefetching
+        self.prefetch_batches = prefetch_batches
+
+        # Training loss over the answer vocabulary, 'full' or 'sampled'.
+        # The sampled softmax draws num_sampled classes from the answer token frequencies at each step,
+        # inference always uses the full projection.
+        if softmax not in ('full', 'sampled'):
+            raise ValueError('Unknown softmax {0}, expected full or sampled.'.format(softmax))
+        self.softmax = softmax
+        self.num_sampled = num_sampled
+
+        # LSTM implementation, 'basic' for BasicLSTMCell or 'block' for the fused LSTMBlockCell kernel.
+        # Both create the same variables, so checkpoints load with either.
+        if cell_type not in ('basic', 'block'):
+            raise ValueError('Unknown cell type {0}, expected basic or block.'.format(cell_type))
+        self.cell_type = cell_type
+
         # Model Name
         self.model_name = model_name
 
+        # Placeholders and assign ops used by set_weights, built on first use
+        self._assign_ops = {}
+
         logging.info('Model SeqtoSeq Initialization completed.')
 
     def fit(self, data_manager: DataManager):
@@ -83,37 +111,8 @@ class SeqToSeqModel:
         # Start the session
         with tf.Graph().as_default(), tf.Session() as session:
 
-            # Load the model inputs
-            input_data, targets, lr, input_sequence_length, output_sequence_length = self.model_inputs()
-
-            # Model Graph Variables
-            self.model_graph_vars(data_manager)
-
-            # Create Encoder
-            encoder_output, encoder_state = self._get_encoder(input_data, input_sequence_length)
-
-            # Create Decoder for Training
-            train_logits = self._get_decoder_train(
-                targets, encoder_output, encoder_state, input_sequence_length, data_manager)
-
-            with tf.name_scope("optimization"):
-                # Compute weight mask
-                mask = tf.sequence_mask(output_sequence_length, self.max_sequence_length, dtype=tf.float32)
-
-                # Loss function
-                cost = tf.contrib.seq2seq.sequence_loss(
-                    train_logits,
-                    targets,
-                    mask)
-
-                # Optimizer
-                optimizer = tf.train.AdamOptimizer(self.learning_rate)
-
-                # Gradient Clipping
-                gradients = optimizer.compute_gradients(cost)
-                capped_gradients = [
-                    (tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
-                train_op = optimizer.apply_gradients(capped_gradients)
+            # Build the training graph
+            cost, train_op = SeqToSeqGraph(self, data_manager).train()
 
             session.run(tf.global_variables_initializer())
 
@@ -129,27 +128,29 @@ class SeqToSeqModel:
     def train(self, session, questions, answers, train_op, cost, data_manager: DataManager, save=True, rewards=None,
               min_valid_loss=None):
 
-        questions_vocab_to_int = data_manager.questions_vocab_to_int
-        answers_vocab_to_int = data_manager.answers_vocab_to_int
+        # Pad the data once, batches are then sliced out of the padded arrays
+        padded_data = self.pad_data(
+            questions, answers, data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int, rewards)
+
+        return self.train_padded(session, padded_data, train_op, cost, save=save, min_valid_loss=min_valid_loss)
 
-        # Validate the training with 10% of the data
-        train_valid_split = int(len(questions) * 0.15)
+    def train_padded(self, session, padded_data, train_op, cost, save=True, min_valid_loss=None):
+        """Trains on arrays in the format returned by pad_data.
 
-        # Split the questions and answers into training and validating data
-        train_questions = questions[train_valid_split:]
-        train_answers = answers[train_valid_split:]
+        :param padded_data:
+            A tuple (pad_questions, pad_answers, q_sequence_length, a_sequence_length, pad_rewards).
+        :return:
+            A tuple (summary_train_loss, summary_valid_loss).
+        """
 
-        valid_questions = questions[:train_valid_split]
-        valid_answers = answers[:train_valid_split]
+        # Validate the training with 15% of the data
+        train_valid_split = int(len(padded_data[0]) * 0.15)
 
-        if rewards is None:
-            train_rewards = None
-            valid_rewards = []
-            for v_a in valid_answers:
-                valid_rewards.append([0.]*len(v_a))
-        else:
-            train_rewards = rewards[train_valid_split:]
-            valid_rewards = rewards[:train_valid_split]
+        # Split the padded data into training and validating data
+        train_data = tuple(data[train_valid_split:] for data in padded_data)
+        valid_data = tuple(data[:train_valid_split] for data in padded_data)
+        num_train = len(train_data[0])
+        num_valid = len(valid_data[0])
 
         # Check training loss after every 100 batches
         display_step = 100
@@ -161,7 +162,7 @@ class SeqToSeqModel:
         stop = 5
 
         # Modulus for checking validation loss
-        validation_check = ((len(train_questions)) // self.batch_size // 2) - 1
+        validation_check = (num_train // self.batch_size // 2) - 1
 
         # Record the training loss for each display step
         total_train_loss = 0.
@@ -181,106 +182,130 @@ class SeqToSeqModel:
         output_sequence_length = graph.get_tensor_by_name('Inputs/output_sequence_length:0')
         rewards = graph.get_tensor_by_name('Inputs/rewards:0')
 
+        # Shuffle and batch the training data on the producer thread
+        def epoch_batches():
+            shuffled_index = self._shuffle_training_data(num_train)
+            return self.batch_padded_data(train_data, self.batch_size, shuffled_index)
+
+        # Step timings and throughput, reported every display step
+        metrics = TrainingMetrics(self._get_metrics_dir(), window=display_step)
+
         for epoch_i in range(1, self.epochs + 1):
-            shuffled_questions, shuffled_answers, shuffled_rewards = \
-                self._shuffle_training_data(train_questions, train_answers, train_rewards)
-
-            for batch_i, \
-                (questions_batch, answers_batch, q_sequence_length_batch,
-                 a_sequence_length_batch, rewards_batch) in enumerate(
-                 self.batch_data(shuffled_questions,
-                                 shuffled_answers,
-                                 self.batch_size,
-                                 questions_vocab_to_int,
-                                 answers_vocab_to_int,
-                                 shuffled_rewards)):
-
-                feed_dict = {
-                    input_data: questions_batch,
-                    targets: answers_batch,
-                    lr: learning_rate,
-                    input_sequence_length: q_sequence_length_batch,
-                    output_sequence_length: a_sequence_length_batch,
-                    rewards: rewards_batch
-                }
-
-                start_time = time.time()
-                _, loss = session.run([train_op, cost], feed_dict=feed_dict)
-
-                total_train_loss += loss
-                total_summary_train_loss += loss
-                end_time = time.time()
-                batch_time = end_time - start_time
-
-                if batch_i % display_step == 0:
-                    logging.info('Types: total_train_loss: {0}'.format(total_train_loss))
-                    print('Epoch {:>3}/{} Batch {:>4}/{} - Loss: {:>6.3f}, Seconds: {:>4.2f}'
-                          .format(epoch_i,
-                                  self.epochs,
-                                  batch_i,
-                                  len(train_questions) // self.batch_size,
-                                  total_train_loss / display_step,
-                                  batch_time * display_step))
-                    logging.info('Epoch {:>3}/{} Batch {:>4}/{} - Loss: {:>6.3f}, Seconds: {:>4.2f}'
-                                 .format(epoch_i,
-                                         self.epochs,
-                                         batch_i,
-                                         len(train_questions) // self.batch_size,
-                                         total_train_loss / display_step,
-                                         batch_time * display_step))
-                    total_train_loss = 0
-
-                if batch_i % validation_check == 0 and batch_i > 0:
-                    total_valid_loss = 0
-                    start_time = time.time()
-                    for batch_ii, \
-                        (questions_batch_ii, answers_batch_ii,
-                         q_sequence_length_batch_ii, a_sequence_length_batch_ii, rewards_batch_ii) in \
-                            enumerate(self.batch_data(valid_questions, valid_answers, self.batch_size,
-                                                      questions_vocab_to_int, answers_vocab_to_int, valid_rewards)):
-                        valid_loss = session.run(
-                            cost, {input_data: questions_batch_ii,
-                                   targets: answers_batch_ii,
-                                   lr: learning_rate,
-                                   input_sequence_length: q_sequence_length_batch_ii,
-                                   output_sequence_length: a_sequence_length_batch_ii,
-                                   rewards: rewards_batch_ii})
-                        total_valid_loss += valid_loss
-                    end_time = time.time()
-                    batch_time = end_time - start_time
-                    avg_valid_loss = total_valid_loss / (len(valid_questions) / self.batch_size)
-                    print('Valid Loss: {:>6.3f}, Seconds: {:>5.2f}'.format(avg_valid_loss, batch_time))
-                    logging.info('Valid Loss: {:>6.3f}, Seconds: {:>5.2f}'.format(avg_valid_loss, batch_time))
-
-                    avg_train_loss = total_summary_train_loss / (validation_check * self.batch_size)
-                    summary_train_loss.append(avg_train_loss)
-
-                    # Reduce learning rate, but not below its minimum value
-                    learning_rate *= self.learning_rate_decay
-                    if learning_rate < self.min_learning_rate:
-                        learning_rate = self.min_learning_rate
-
-                    summary_valid_loss.append(avg_valid_loss)
-                    if min_valid_loss is None or min_valid_loss > avg_valid_loss:
-                        print('New Record!')
-                        logging.info('New Record!')
-                        min_valid_loss = avg_valid_loss
-                        stop_early = 0
-                        if save:
-                            self._save_model(session)
-
-                    else:
-                        print("No Improvement.")
-                        logging.info("No Improvement.")
-                        stop_early += 1
-                        if stop_early == stop:
-                            break
+            # Closing the prefetcher on exit also stops its producer when a training step fails
+            with BatchPrefetcher(epoch_batches, capacity=self.prefetch_batches,
+                                 name='Epoch {0} batches'.format(epoch_i)) as batches:
+                wait_time = 0.
+
+                for batch_i, \
+                    (questions_batch, answers_batch, q_sequence_length_batch,
+                     a_sequence_length_batch, rewards_batch) in enumerate(batches):
+
+                    # Time spent waiting for this batch
+                    step_wait_time = batches.wait_time - wait_time
+                    wait_time = batches.wait_time
+
+                    feed_dict = {
+                        input_data: questions_batch,
+                        targets: answers_batch,
+                        lr: learning_rate,
+                        input_sequence_length: q_sequence_length_batch,
+                        output_sequence_length: a_sequence_length_batch,
+                        rewards: rewards_batch
+                    }
+
+                    start_time = time.perf_counter()
+                    _, loss = session.run([train_op, cost], feed_dict=feed_dict)
+                    metrics.add_step(step_wait_time, time.perf_counter() - start_time,
+                                     int(q_sequence_length_batch.sum() + a_sequence_length_batch.sum()))
+
+                    total_train_loss += loss
+                    total_summary_train_loss += loss
+
+                    if batch_i % display_step == 0:
+                        logging.info('Types: total_train_loss: {0}'.format(total_train_loss))
+                        train_stats = metrics.train_stats()
+                        metrics.write('train', epoch_i, dict(train_stats, batch=batch_i,
+                                                             loss=total_train_loss / display_step))
+                        message = ('Epoch {:>3}/{} Batch {:>4}/{} - Loss: {:>6.3f}, Step: {:>7.1f} ms '
+                                   '(p90 {:>7.1f} ms), Tokens/sec: {:>8.0f}, Input wait: {:>5.1%}'
+                                   .format(epoch_i,
+                                           self.epochs,
+                                           batch_i,
+                                           num_train // self.batch_size,
+                                           total_train_loss / display_step,
+                                           train_stats['step_mean_ms'],
+                                           train_stats['step_p90_ms'],
+                                           train_stats['tokens_per_sec'],
+                                           train_stats['input_wait_fraction']))
+                        print(message)
+                        logging.info(message)
+                        total_train_loss = 0
+
+                    if batch_i % validation_check == 0 and batch_i > 0:
+                        total_valid_loss = 0
+                        num_valid_batches = 0
+                        valid_tokens = 0
+                        start_time = time.perf_counter()
+                        for batch_ii, \
+                            (questions_batch_ii, answers_batch_ii,
+                             q_sequence_length_batch_ii, a_sequence_length_batch_ii, rewards_batch_ii) in \
+                                enumerate(self.batch_padded_data(valid_data, self.batch_size)):
+                            valid_loss = session.run(
+                                cost, {input_data: questions_batch_ii,
+                                       targets: answers_batch_ii,
+                                       lr: learning_rate,
+                                       input_sequence_length: q_sequence_length_batch_ii,
+                                       output_sequence_length: a_sequence_length_batch_ii,
+                                       rewards: rewards_batch_ii})
+                            total_valid_loss += valid_loss
+                            num_valid_batches += 1
+                            valid_tokens += int(q_sequence_length_batch_ii.sum() + a_sequence_length_batch_ii.sum())
+                        valid_stats = metrics.add_validation(time.perf_counter() - start_time, num_valid_batches,
+                                                             num_valid_batches * self.batch_size, valid_tokens)
+                        avg_valid_loss = total_valid_loss / (num_valid / self.batch_size)
+                        metrics.write('valid', epoch_i, dict(valid_stats, batch=batch_i, loss=avg_valid_loss))
+                        message = 'Valid Loss: {:>6.3f}, Seconds: {:>5.2f}, Tokens/sec: {:>8.0f}'.format(
+                            avg_valid_loss, valid_stats['valid_sec'], valid_stats['tokens_per_sec'])
+                        print(message)
+                        logging.info(message)
+
+                        avg_train_loss = total_summary_train_loss / (validation_check * self.batch_size)
+                        summary_train_loss.append(avg_train_loss)
+
+                        # Reduce learning rate, but not below its minimum value
+                        learning_rate *= self.learning_rate_decay
+                        if learning_rate < self.min_learning_rate:
+                            learning_rate = self.min_learning_rate
+
+                        summary_valid_loss.append(avg_valid_loss)
+                        if min_valid_loss is None or min_valid_loss > avg_valid_loss:
+                            print('New Record!')
+                            logging.info('New Record!')
+                            min_valid_loss = avg_valid_loss
+                            stop_early = 0
+                            if save:
+                                self._save_model(session)
+
+                        else:
+                            print("No Improvement.")
+                            logging.info("No Improvement.")
+                            stop_early += 1
+                            if stop_early == stop:
+                                break
+
+            logging.info('Epoch {0} input pipeline: {1}'.format(epoch_i, batches.stats()))
+
+            epoch_stats = metrics.end_epoch(batches.stats())
+            metrics.write('epoch', epoch_i, epoch_stats)
+            logging.info('Epoch {0} metrics: {1}'.format(epoch_i, epoch_stats))
 
             if stop_early == stop:
                 print("Stopping Training.")
                 logging.info("Stopping Training.")
                 break
 
+        metrics.close()
+
         return summary_train_loss, summary_valid_loss
 
     def predict(self, input_question, data_manager: DataManager):
@@ -292,127 +317,43 @@ class SeqToSeqModel:
         # Start the session
         with tf.Session() as session:
 
-            # Load the model inputs
-            input_data, targets, lr, input_sequence_length, output_sequence_length = self.model_inputs()
-
-            # Model Graph Variables
-            self.model_graph_vars(data_manager)
-
-            # Create Encoder
-            encoder_output, encoder_state = self._get_encoder(input_data, input_sequence_length)
+            # Build the greedy decoder and restore its variables
+            model_graph = SeqToSeqGraph(self, data_manager)
+            infer_logits = model_graph.greedy()
+            model_graph.restore(session)
 
-            # Create Decoder for Training
-            infer_logits = self._get_decoder_infer(
-                encoder_output, encoder_state, input_sequence_length, data_manager)
+            # Get prediction for a batch of one question
+            feed_dict = self.inference_feed_dict([input_question], data_manager)
+            answers = session.run(infer_logits, feed_dict=feed_dict)
+            answer = np.argmax(answers[0], axis=-1)
 
-            session.run(tf.global_variables_initializer())
-
-            # Restore session
-            saver = tf.train.Saver()
-            save_path = self._get_model_save_path()
-            saver.restore(session, save_path)
-            logging.info('Saved model {0} loaded from disk.'.format(save_path))
-
-            # Add empty questions so the the input_data is the correct shape
-            questions = [input_question] * self.batch_size
-
-            # Add empty answers so the the input_data is the correct shape
-            single_input_answer = [data_manager.answers_vocab_to_int['<GO>'],
-                                   data_manager.answers_vocab_to_int['<PAD>']]
-            answers = [single_input_answer] * self.batch_size
-
-            # Get Placeholders
-            graph = tf.get_default_graph()
-            input_data = graph.get_tensor_by_name('Inputs/input_data:0')
-            targets = graph.get_tensor_by_name('Inputs/targets:0')
-            lr = graph.get_tensor_by_name('Inputs/learning_rate:0')
-            input_sequence_length = graph.get_tensor_by_name('Inputs/input_sequence_length:0')
-            output_sequence_length = graph.get_tensor_by_name('Inputs/output_sequence_length:0')
-
-            for batch_i, \
-                (pad_questions_batch, pad_answers_batch, q_sequence_length_batch, a_sequence_length_batch) in enumerate(
-                    self.batch_data(questions, answers, self.batch_size,
-                                    data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int)):
-
-                # Build feed_dict
-                feed_dict = {
-                    input_data: pad_questions_batch,
-                    targets: pad_answers_batch,
-                    lr: self.learning_rate,
-                    input_sequence_length: q_sequence_length_batch,
-                    output_sequence_length: a_sequence_length_batch
-                }
-
-                # Get prediction
-                answers = session.run([infer_logits], feed_dict=feed_dict)
-                answer = np.argmax(answers[0][0], axis=-1)
-
-                return answer
-
-        raise AssertionError('Prediction batch processing failed.')
+            return answer
 
     def predict_beam_load_model(self, session, data_manager: DataManager):
         """Loads model for Predict beam method."""
 
-        # Load the model inputs
-        input_data, targets, lr, input_sequence_length, output_sequence_length = self.model_inputs()
-
-        # Model Graph Variables
-        self.model_graph_vars(data_manager)
-
-        # Create Encoder
-        encoder_output, encoder_state = self._get_encoder(input_data, input_sequence_length)
-
-        # Create Decoder for Training
-        beam_output = self._get_decoder_infer_beam(
-            encoder_output, encoder_state, input_sequence_length, data_manager)
-
-        session.run(tf.global_variables_initializer())
-
-        # Restore session
-        saver = tf.train.Saver()
-        save_path = self._get_model_save_path()
-        saver.restore(session, save_path)
-        logging.info('Saved model {0} loaded from disk.'.format(save_path))
+        # Build the beam decoder and restore its variables
+        model_graph = SeqToSeqGraph(self, data_manager)
+        beam_output = model_graph.beam()
+        model_graph.restore(session)
 
         return beam_output
 
     def predict_beam_responses(self, session, beam_output, input_question, data_manager: DataManager):
         """Gets beam responses for given question."""
-        # Add empty questions so the the input_data is the correct shape
-        questions = [input_question] * self.batch_size
+        scores, predicted_ids, parent_ids = self.predict_beam_responses_batch(
+            session, beam_output, [input_question], data_manager)
+        return scores[0], predicted_ids[0], parent_ids[0]
 
-        # Add empty answers so the the input_data is the correct shape
-        single_input_answer = [data_manager.answers_vocab_to_int['<GO>'],
-                               data_manager.answers_vocab_to_int['<PAD>']]
-        answers = [single_input_answer] * self.batch_size
-
-        # Get Placeholders
-        graph = tf.get_default_graph()
-        input_data = graph.get_tensor_by_name('Inputs/input_data:0')
-        targets = graph.get_tensor_by_name('Inputs/targets:0')
-        lr = graph.get_tensor_by_name('Inputs/learning_rate:0')
-        input_sequence_length = graph.get_tensor_by_name('Inputs/input_sequence_length:0')
-        output_sequence_length = graph.get_tensor_by_name('Inputs/output_sequence_length:0')
+    def predict_beam_responses_batch(self, session, beam_output, input_questions, data_manager: DataManager):
+        """Gets beam responses for a batch of distinct questions in a single decoder run.
 
-        for batch_i, \
-            (pad_questions_batch, pad_answers_batch, q_sequence_length_batch, a_sequence_length_batch) in enumerate(
-             self.batch_data(questions, answers, self.batch_size,
-                             data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int)):
-            # Build feed_dict
-            feed_dict = {
-                input_data: pad_questions_batch,
-                targets: pad_answers_batch,
-                lr: self.learning_rate,
-                input_sequence_length: q_sequence_length_batch,
-                output_sequence_length: a_sequence_length_batch
-            }
-
-            # Get prediction
-            output = session.run([beam_output], feed_dict=feed_dict)
-            return output[0].scores[0], output[0].predicted_ids[0], output[0].parent_ids[0]
-
-        raise AssertionError('Prediction batch processing failed.')
+        :return:
+            Arrays (scores, predicted_ids, parent_ids) of shape [len(input_questions), time, beam_width].
+        """
+        feed_dict = self.inference_feed_dict(input_questions, data_manager)
+        output = session.run(beam_output, feed_dict=feed_dict)
+        return output.scores, output.predicted_ids, output.parent_ids
 
     def predict_beam(self, input_question, data_manager: DataManager):
         """Predict a response for the given question"""
@@ -434,23 +375,23 @@ class SeqToSeqModel:
 
         with tf.name_scope('Inputs'):
 
-            # Question
-            input_data = tf.placeholder(tf.int32, shape=[self.batch_size, self.max_sequence_length], name='input_data')
+            # Question, padded to the longest question in the batch
+            input_data = tf.placeholder(tf.int32, shape=[None, None], name='input_data')
 
-            # Response
-            targets = tf.placeholder(tf.int32, shape=[self.batch_size, self.max_sequence_length], name='targets')
+            # Response, padded to the longest response in the batch
+            targets = tf.placeholder(tf.int32, shape=[None, None], name='targets')
 
             # Learning Rate
             lr = tf.placeholder(tf.float32, name='learning_rate')
 
             # Input Sequence length
-            input_sequence_length = tf.placeholder(tf.int32, shape=[self.batch_size], name="input_sequence_length")
+            input_sequence_length = tf.placeholder(tf.int32, shape=[None], name="input_sequence_length")
 
             # Output Sequence length
-            output_sequence_length = tf.placeholder(tf.int32, shape=[self.batch_size], name="output_sequence_length")
+            output_sequence_length = tf.placeholder(tf.int32, shape=[None], name="output_sequence_length")
 
             # Rewards
-            _ = tf.placeholder(tf.float32, shape=[self.batch_size, self.max_sequence_length], name="rewards")
+            _ = tf.placeholder(tf.float32, shape=[None, None], name="rewards")
 
         return input_data, targets, lr, input_sequence_length, output_sequence_length
 
@@ -479,12 +420,19 @@ class SeqToSeqModel:
 
         return dec_input
 
-    def decode(self, vocab_size, input_sequence_length, encoder_output, encoder_state, helper, scope, reuse=None):
+    def decode(self, vocab_size, input_sequence_length, encoder_output, encoder_state, helper, scope, reuse=None,
+               project=True):
+        """Decodes with attention over the encoder output.
+
+        :param project:
+            Projects the decoder outputs onto the vocabulary. If False, the [batch, time, rnn_size] decoder outputs
+            are returned and the projection is left to sequence_cost.
+        :return:
+            A tuple (logits, projection_layer), the projection layer holds the output projection variables.
+        """
 
         with tf.variable_scope(scope, reuse=reuse):
-            lstm = tf.contrib.rnn.BasicLSTMCell(self.rnn_size)
-            drop = tf.contrib.rnn.DropoutWrapper(lstm, input_keep_prob=self.keep_probability)
-            dec_cell = tf.contrib.rnn.MultiRNNCell([drop] * self.num_layers)
+            dec_cell = self._get_rnn_cell()
 
             # alternatively concat forward and backward states
             bi_encoder_state = []
@@ -512,16 +460,21 @@ class SeqToSeqModel:
                 output_attention=False)
 
             attention_zero = attn_cell.zero_state(
-                batch_size=self.batch_size,
+                batch_size=tf.shape(input_sequence_length)[0],
                 dtype=tf.float32).clone(cell_state=bi_encoder_state)
 
             projection_layer = tf.layers.Dense(vocab_size, use_bias=True, bias_initializer=tf.zeros_initializer())
 
+            if not project:
+                # Create the projection variables in the scope the decoder creates them, to share checkpoints
+                with tf.variable_scope('decoder'):
+                    projection_layer(tf.zeros([1, attn_cell.output_size]))
+
             decoder = tf.contrib.seq2seq.BasicDecoder(
                 cell=attn_cell,
                 helper=helper,
                 initial_state=attention_zero,
-                output_layer=projection_layer
+                output_layer=projection_layer if project else None
             )
 
             final_outputs, _final_state, _final_sequence_lengths = tf.contrib.seq2seq.dynamic_decode(
@@ -532,7 +485,17 @@ class SeqToSeqModel:
 
             logits = final_outputs.rnn_output
 
-            return logits
+            return logits, projection_layer
+
+    def _get_rnn_cell(self):
+        """Multi layer LSTM cell with input dropout, built with the configured cell type."""
+        if self.cell_type == 'block':
+            # Same variable names and gate order (i, j, f, o) as BasicLSTMCell, one op per step instead of one per gate
+            lstm = tf.contrib.rnn.LSTMBlockCell(self.rnn_size, name='basic_lstm_cell')
+        else:
+            lstm = tf.contrib.rnn.BasicLSTMCell(self.rnn_size)
+        drop = tf.contrib.rnn.DropoutWrapper(lstm, input_keep_prob=self.keep_probability)
+        return tf.contrib.rnn.MultiRNNCell([drop] * self.num_layers)
 
     def _get_encoder(self, input_data, input_sequence_length):
         """Creates an encoder instance"""
@@ -541,9 +504,7 @@ class SeqToSeqModel:
         enc_embeddings = graph.get_tensor_by_name('Embeddings/Input_Embeddings:0')
         enc_embed_input = tf.nn.embedding_lookup(enc_embeddings, input_data)
 
-        lstm = tf.contrib.rnn.BasicLSTMCell(self.rnn_size)
-        drop = tf.contrib.rnn.DropoutWrapper(lstm, input_keep_prob=self.keep_probability)
-        enc_cell = tf.contrib.rnn.MultiRNNCell([drop] * self.num_layers)
+        enc_cell = self._get_rnn_cell()
 
         enc_output, enc_state = tf.nn.bidirectional_dynamic_rnn(
             cell_fw=enc_cell,
@@ -556,27 +517,71 @@ class SeqToSeqModel:
 
     def _get_decoder_train(self, target_data, encoder_output, encoder_state, input_sequence_length,
                            data_manager: DataManager):
-        """Builds a decoder for training"""
+        """Builds a decoder for training
+
+        :return:
+            A tuple (train_logits, projection_layer) of the decoder outputs and their output projection.
+        """
 
         vocab_to_int = data_manager.questions_vocab_to_int
         start_of_sequence_id = vocab_to_int['<GO>']
         answers_vocab_size = len(data_manager.answers_vocab_to_int)
 
-        dec_input = self.process_encoding_input(target_data, start_of_sequence_id, self.batch_size)
+        batch_size = tf.shape(target_data)[0]
+        dec_input = self.process_encoding_input(target_data, start_of_sequence_id, batch_size)
         graph = tf.get_default_graph()
         dec_embeddings = graph.get_tensor_by_name('Embeddings/Output_Embeddings:0')
         dec_embed_input = tf.nn.embedding_lookup(dec_embeddings, dec_input)
 
-        sequence_lengths = tf.fill([self.batch_size], self.max_sequence_length)
+        sequence_lengths = tf.fill([batch_size], tf.shape(target_data)[1])
 
         train_helper = tf.contrib.seq2seq.TrainingHelper(dec_embed_input, sequence_lengths)
 
         with tf.variable_scope("decoding"):
 
-            train_logits = self.decode(
-                answers_vocab_size, input_sequence_length, encoder_output, encoder_state, train_helper, 'decoding')
+            train_logits, projection_layer = self.decode(
+                answers_vocab_size, input_sequence_length, encoder_output, encoder_state, train_helper, 'decoding',
+                project=self.softmax == 'full')
+
+        return train_logits, projection_layer
 
-        return train_logits
+    def sequence_cost(self, train_logits, projection_layer, targets, mask, data_manager: DataManager):
+        """Masked mean cross entropy of the training decoder outputs.
+
+        :param train_logits:
+            Output of _get_decoder_train, logits with the full softmax and decoder outputs with the sampled one.
+        :param projection_layer:
+            Output projection of _get_decoder_train, whose variables the sampled softmax uses.
+        :return:
+            A scalar loss tensor.
+        """
+        if self.softmax == 'full':
+            return tf.contrib.seq2seq.sequence_loss(train_logits, targets, mask)
+
+        answers_vocab_size = len(data_manager.answers_vocab_to_int)
+        labels = tf.reshape(tf.to_int64(targets), [-1, 1])
+        inputs = tf.reshape(train_logits, [-1, self.rnn_size])
+
+        # Sample negative classes by answer token frequency
+        sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+            true_classes=labels,
+            num_true=1,
+            num_sampled=self.num_sampled,
+            unique=True,
+            range_max=answers_vocab_size,
+            unigrams=data_manager.get_answers_vocab_counts().tolist())
+
+        losses = tf.nn.sampled_softmax_loss(
+            weights=tf.transpose(projection_layer.kernel),
+            biases=projection_layer.bias,
+            labels=labels,
+            inputs=inputs,
+            num_sampled=self.num_sampled,
+            num_classes=answers_vocab_size,
+            sampled_values=sampled_values)
+
+        mask = tf.reshape(mask, [-1])
+        return tf.reduce_sum(losses * mask) / tf.reduce_sum(mask)
 
     def _get_decoder_infer(self, encoder_output, encoder_state, input_sequence_length, data_manager: DataManager):
         """Gets a decoder for inferring a single result."""
@@ -585,7 +590,7 @@ class SeqToSeqModel:
         start_of_sequence_id = vocab_to_int['<GO>']
         answers_vocab_size = len(data_manager.answers_vocab_to_int)
 
-        start_tokens = tf.fill([self.batch_size], start_of_sequence_id)
+        start_tokens = tf.fill([tf.shape(input_sequence_length)[0]], start_of_sequence_id)
         end_of_sequence_id = vocab_to_int['<EOS>']
 
         graph = tf.get_default_graph()
@@ -597,7 +602,7 @@ class SeqToSeqModel:
 
         with tf.variable_scope("decoding", reuse=tf.AUTO_REUSE):
 
-            infer_logits = self.decode(
+            infer_logits, _ = self.decode(
                 answers_vocab_size, input_sequence_length, encoder_output, encoder_state, infer_helper, 'decoding',
                 reuse=tf.AUTO_REUSE)
 
@@ -607,11 +612,10 @@ class SeqToSeqModel:
                     dec_embeddings, start_token, end_token, scope, reuse=None):
 
         beam_width = self.beam_width
+        batch_size = tf.shape(input_sequence_length)[0]
 
         with tf.variable_scope(scope, reuse=reuse):
-            lstm = tf.contrib.rnn.BasicLSTMCell(self.rnn_size)
-            drop = tf.contrib.rnn.DropoutWrapper(lstm, input_keep_prob=self.keep_probability)
-            dec_cell = tf.contrib.rnn.MultiRNNCell([drop] * self.num_layers)
+            dec_cell = self._get_rnn_cell()
 
             # alternatively concat forward and backward states
             bi_encoder_state = []
@@ -643,7 +647,7 @@ class SeqToSeqModel:
                 output_attention=False)
 
             attention_zero = attn_cell.zero_state(
-                batch_size=self.batch_size * beam_width,
+                batch_size=batch_size * beam_width,
                 dtype=tf.float32).clone(cell_state=tiled_encoder_state)
 
             projection_layer = tf.layers.Dense(vocab_size, use_bias=True, bias_initializer=tf.zeros_initializer())
@@ -652,7 +656,7 @@ class SeqToSeqModel:
             beam_decoder = tf.contrib.seq2seq.BeamSearchDecoder(
                 cell=attn_cell,
                 embedding=dec_embeddings,
-                start_tokens=tf.fill([self.batch_size], start_token),
+                start_tokens=tf.fill([batch_size], start_token),
                 end_token=end_token,
                 initial_state=attention_zero,
                 beam_width=self.beam_width,
@@ -685,69 +689,128 @@ class SeqToSeqModel:
                 dec_embeddings, start_of_sequence_id, end_of_sequence_id, 'decoding', reuse=tf.AUTO_REUSE)
 
     def get_encoded_representation(self, session, encoder_output, input_question, data_manager: DataManager):
-        """Gets beam responses for given question."""
+        """Gets encoder output for given question."""
 
         if input_question is None:
             return None
 
-        # Add empty questions so the the input_data is the correct shape
-        questions = [input_question] * self.batch_size
+        return self.get_encoded_representations(session, encoder_output, [input_question], data_manager)
+
+    def get_encoded_representations(self, session, encoder_output, input_questions, data_manager: DataManager):
+        """Gets encoder outputs for a batch of questions in a single encoder run.
+
+        :return:
+            A tuple (forward, backward) of arrays of shape [len(input_questions), max_sequence_length, rnn_size].
+        """
+        feed_dict = self.inference_feed_dict(input_questions, data_manager)
+
+        # Get prediction, padded back to max_sequence_length so that representations of
+        # questions of different lengths can be compared
+        output = session.run(encoder_output, feed_dict=feed_dict)
+        return tuple(self._pad_time_axis(direction_output) for direction_output in output)
 
-        # Add empty answers so the the input_data is the correct shape
-        single_input_answer = [data_manager.answers_vocab_to_int['<GO>'],
-                               data_manager.answers_vocab_to_int['<PAD>']]
-        answers = [single_input_answer] * self.batch_size
+    def inference_feed_dict(self, input_questions, data_manager: DataManager):
+        """Builds a feed_dict for the encoder and the inference decoders of the default graph."""
+        pad_questions = self.pad_sentence_batch(input_questions, data_manager.questions_vocab_to_int['<PAD>'])
+        q_sequence_length = np.asarray([len(question) for question in input_questions], dtype=np.int32)
 
         # Get Placeholders
         graph = tf.get_default_graph()
         input_data = graph.get_tensor_by_name('Inputs/input_data:0')
-        targets = graph.get_tensor_by_name('Inputs/targets:0')
-        lr = graph.get_tensor_by_name('Inputs/learning_rate:0')
         input_sequence_length = graph.get_tensor_by_name('Inputs/input_sequence_length:0')
-        output_sequence_length = graph.get_tensor_by_name('Inputs/output_sequence_length:0')
 
-        for batch_i, \
-            (pad_questions_batch, pad_answers_batch, q_sequence_length_batch, a_sequence_length_batch) in enumerate(
-             self.batch_data(questions, answers, self.batch_size,
-                             data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int)):
-            # Build feed_dict
-            feed_dict = {
-                input_data: pad_questions_batch,
-                targets: pad_answers_batch,
-                lr: self.learning_rate,
-                input_sequence_length: q_sequence_length_batch,
-                output_sequence_length: a_sequence_length_batch
-            }
-
-            # Get prediction
-            output = session.run([encoder_output], feed_dict=feed_dict)
-            return output[0]
-
-        raise AssertionError('Get Encoder Representation failed.')
-
-    def pad_sentence_batch(self, sentence_batch, pad_token):
+        return {
+            input_data: pad_questions[:, :q_sequence_length.max()],
+            input_sequence_length: q_sequence_length
+        }
+
+    def pad_sentence_batch(self, sentence_batch, pad_token, dtype=np.int32):
         """Pad sentences with <PAD> so that each sentence of a batch has the same length"""
         max_sentence = self.max_sequence_length
-        return [sentence + [pad_token] * (max_sentence - len(sentence)) for sentence in sentence_batch]
+        pad_batch = np.full((len(sentence_batch), max_sentence), pad_token, dtype=dtype)
+        for i, sentence in enumerate(sentence_batch):
+            pad_batch[i, :len(sentence)] = sentence
+        return pad_batch
 
-    def batch_data(self, questions, answers, batch_size, questions_vocab_to_int, answers_vocab_to_int, rewards=None):
-        """Batch questions and answers together"""
-        for batch_i in range(0, len(questions) // batch_size):
+    def pad_data(self, questions, answers, questions_vocab_to_int, answers_vocab_to_int, rewards=None):
+        """Pads questions, answers and rewards once into arrays that can be sliced into batches.
+
+        :return:
+            A tuple (pad_questions, pad_answers, q_sequence_length, a_sequence_length, pad_rewards) of
+            int32 and float32 arrays. Missing rewards are filled with zeros.
+        """
+        pad_questions = self.pad_sentence_batch(questions, questions_vocab_to_int['<PAD>'])
+        pad_answers = self.pad_sentence_batch(answers, answers_vocab_to_int['<PAD>'])
+        q_sequence_length = np.fromiter((len(question) for question in questions), dtype=np.int32,
+                                        count=len(questions))
+        a_sequence_length = np.fromiter((len(answer) for answer in answers), dtype=np.int32, count=len(answers))
+
+        if rewards is None:
+            pad_rewards = np.zeros(pad_answers.shape, dtype=np.float32)
+        else:
+            pad_rewards = self.pad_sentence_batch(rewards, 0., dtype=np.float32)
+
+        return pad_questions, pad_answers, q_sequence_length, a_sequence_length, pad_rewards
+
+    @staticmethod
+    def batch_padded_data(padded_data, batch_size, index=None):
+        """Batch arrays returned by pad_data, optionally in the order given by a permutation index.
+
+        Questions are trimmed to the longest question of the batch, answers and rewards to the longest answer,
+        so that batches of short sentences run fewer encoder and decoder steps.
+        """
+        pad_questions, pad_answers, q_sequence_length, a_sequence_length = padded_data[:4]
+        for batch_i in range(0, len(pad_questions) // batch_size):
             start_i = batch_i * batch_size
-            questions_batch = questions[start_i:start_i + batch_size]
-            answers_batch = answers[start_i:start_i + batch_size]
-            q_sequence_length_batch = [len(question) for question in questions_batch]
-            a_sequence_length_batch = [len(answer) for answer in answers_batch]
-            pad_questions_batch = self.pad_sentence_batch(questions_batch, questions_vocab_to_int['<PAD>'])
-            pad_answers_batch = self.pad_sentence_batch(answers_batch, answers_vocab_to_int['<PAD>'])
-
-            if rewards is not None:
-                rewards_batch = rewards[start_i:start_i + batch_size]
-                pad_rewards_batch = self.pad_sentence_batch(rewards_batch, 0.)
-                yield pad_questions_batch, pad_answers_batch, q_sequence_length_batch, a_sequence_length_batch, \
-                    pad_rewards_batch
+            if index is None:
+                batch_index = slice(start_i, start_i + batch_size)
             else:
-                yield pad_questions_batch, pad_answers_batch, q_sequence_length_batch, a_sequence_length_batch
+                batch_index = index[start_i:start_i + batch_size]
+
+            q_sequence_length_batch = q_sequence_length[batch_index]
+            a_sequence_length_batch = a_sequence_length[batch_index]
+            q_width = q_sequence_length_batch.max()
+            a_width = a_sequence_length_batch.max()
+
+            batch = (pad_questions[batch_index, :q_width], pad_answers[batch_index, :a_width],
+                     q_sequence_length_batch, a_sequence_length_batch)
+            if len(padded_data) > 4:
+                batch += (padded_data[4][batch_index, :a_width],)
+            yield batch
+
+    def batch_data(self, questions, answers, batch_size, questions_vocab_to_int, answers_vocab_to_int, rewards=None):
+        """Batch questions and answers together"""
+        padded_data = self.pad_data(questions, answers, questions_vocab_to_int, answers_vocab_to_int, rewards)
+        if rewards is None:
+            padded_data = padded_data[:4]
+        return self.batch_padded_data(padded_data, batch_size)
+
+    def get_weights(self, session):
+        """Returns the values of the trainable variables of the session graph keyed by variable name."""
+        variables = session.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+        values = session.run(variables)
+        return {variable.op.name: value for variable, value in zip(variables, values)}
+
+    def set_weights(self, session, weights):
+        """Assigns in-memory weights, as returned by get_weights, to the variables of the session graph."""
+        if len(self._assign_ops) == 0:
+            with session.graph.as_default(), tf.name_scope('Assign_Weights'):
+                for variable in tf.trainable_variables():
+                    value = tf.placeholder(variable.dtype.base_dtype, shape=variable.get_shape())
+                    self._assign_ops[variable.op.name] = (value, tf.assign(variable, value))
+
+        assign_ops = []
+        feed_dict = {}
+        for name, (value, assign_op) in self._assign_ops.items():
+            assign_ops.append(assign_op)
+            feed_dict[value] = weights[name]
+
+        session.run(assign_ops, feed_dict=feed_dict)
+
+    def _pad_time_axis(self, outputs):
+        """Zero pads [batch, time, units] outputs along the time axis to max_sequence_length"""
+        pad_width = self.max_sequence_length - outputs.shape[1]
+        return np.pad(outputs, ((0, 0), (0, pad_width), (0, 0)), 'constant')
 
     def _save_model(self, session):
         """ Saves model to the disk. Should be called only by fit.
@@ -786,22 +849,17 @@ class SeqToSeqModel:
         assert self.model_name is not None
         return '{0}/{1}.ckpt'.format(self._get_save_dir(), self.model_name)
 
-    @staticmethod
-    def _shuffle_training_data(questions, answers, rewards=None):
-        """Randomly shuffles questions and answers training data."""
-
-        index = np.arange(len(questions))
-        np.random.shuffle(index)
-
-        q = []
-        a = []
-        r = []
-        for i in index:
-            q.append(questions[i])
-            a.append(answers[i])
-            if rewards is not None:
-                r.append(rewards[i])
-            else:
-                r.append([0.]*len(answers[i]))
+    def _get_metrics_dir(self):
+        """ Builds the directory of the training metrics of a run, logs/metrics/<model_name>/<timestamp>.
+
+        :return:
+            A string containing the metrics directory path, to be used as a TensorBoard log dir.
+        """
+        abs_path = os.path.abspath(os.path.dirname(__file__))
+        def_metrics_path = os.path.join(abs_path, '../../logs/metrics/')
+        return '{0}{1}/{2}'.format(def_metrics_path, self.model_name, datetime.now().strftime('%Y%m%d-%H%M%S'))
 
-        return q, a, r
+    @staticmethod
+    def _shuffle_training_data(num_samples):
+        """Returns a random permutation index over the training data."""
+        return np.random.permutation(num_samples)
@@ -2,16 +2,32 @@
 # Tests for training and evaluation of all models.
 #
 
+import contextlib
+import json
 import logging
 import os
 import pytest
+import queue
 import numpy as np
+import tensorflow as tf
 from datetime import datetime
+from src.benchmarks.synthetic import synthetic_cornell_corpus
 from src.models.data_manager import DataManager
 from src.models import train_model
 from src.models.predict_model import predict_seqtoseq, predict_seqtoseq_beam
 from src.models.agent import PolicyAgent
+from src.models.beam_search import beam_lengths, beam_paths, beam_responses, beam_softmax
+from src.models.chatbot import Chatbot
+from src.models.encoder_cache import EncoderCache
+from src.models import export_model
+from src.models.input_pipeline import BatchPrefetcher
 from src.models.policy_model import PolicyGradientModel
+from src.models.rl_utils import reward_to_go
+from src.models.seqtoseq_model import SeqToSeqModel
+from src.models.self_play import SelfPlayPool
+from src.models.seqtoseq_graph import SeqToSeqGraph
+from src.models.trajectory_buffer import TrajectoryBuffer
+from src.models.training_metrics import TrainingMetrics
 
 #
 # Configure logging
@@ -30,6 +46,129 @@ logging.basicConfig(filename=log_path.format(datetime.now().strftime('%Y%m%d-%H%
 logging.info('Test Logger Created.')
 
 
+#
+# Reward fixtures
+#
+
+class StubEncoderModel(object):
+    """Bidirectional tanh RNN over random embeddings, in place of the seq2seq encoder of an agent."""
+
+    max_sequence_length = 8
+
+    def __init__(self, vocab_size=20, units=4, seed=0):
+        rng = np.random.RandomState(seed)
+        self.units = units
+        self.embeddings = rng.randn(vocab_size, units)
+        self.w_fw = rng.randn(units, units)
+        self.w_bw = rng.randn(units, units)
+
+    def set_weights(self, session, weights):
+        self.embeddings, self.w_fw, self.w_bw = weights
+
+    def get_encoded_representations(self, session, encoder_output, input_questions, data_manager):
+        shape = (len(input_questions), self.max_sequence_length, self.units)
+        fw = np.zeros(shape)
+        bw = np.zeros(shape)
+        for i, question in enumerate(input_questions):
+            h = np.zeros(self.units)
+            for p in range(len(question)):
+                h = np.tanh(self.embeddings[question[p]] + h.dot(self.w_fw))
+                fw[i, p] = h
+            h = np.zeros(self.units)
+            for p in reversed(range(len(question))):
+                h = np.tanh(self.embeddings[question[p]] + h.dot(self.w_bw))
+                bw[i, p] = h
+        return fw, bw
+
+
+def reward_agent():
+    """PolicyAgent with the stub encoder and three dull responses, without a seq2seq graph."""
+    agent = PolicyAgent.__new__(PolicyAgent)
+    agent.seq2seq_model = StubEncoderModel()
+    agent.session = None
+    agent.encoder_output = None
+    agent.data_manager = None
+    agent.encoder_cache = EncoderCache()
+    agent.dull_responses = [[1, 2, 3], [2, 4], [5]]
+    agent.dull_response_mask = np.zeros((len(agent.dull_responses), 20), dtype=bool)
+    for i, dull_resp in enumerate(agent.dull_responses):
+        agent.dull_response_mask[i, dull_resp] = True
+    return agent
+
+
+def ease_of_answering_baseline(dull_responses, response, prob):
+    """Scalar ease of answering of a single response prefix, as computed before vectorization."""
+    t = 0.
+    for dull_resp in dull_responses:
+        n_s = len(set(dull_resp) & set(response))
+        if n_s > 0:
+            t += prob / n_s
+
+    t /= len(response)
+    if t == 0.:
+        return 0.
+    return -np.log(t)
+
+
+def reward_to_go_baseline(rewards):
+    """Rewards to go of one move averaged over its length, as computed by PolicyGradientModel._reward_to_go."""
+    n = len(rewards)
+    rtgs = np.zeros_like(rewards)
+    for i in reversed(range(n)):
+        rtgs[i] = rewards[i] + (rtgs[i + 1] if i + 1 < n else 0)
+
+    rtgs /= len(rewards)
+    return rtgs
+
+
+#
+# Seq2seq fixtures
+#
+
+# Parameters of a small seq2seq model, without dropout so that inference is deterministic
+TINY_MODEL_PARAMS = {
+    'batch_size': 8,
+    'rnn_size': 16,
+    'num_layers': 1,
+    'encoding_embedding_size': 16,
+    'decoding_embedding_size': 16,
+    'keep_probability': 1.,
+    'beam_width': 3
+}
+
+
+@pytest.fixture
+def tiny_data_manager(tmpdir, monkeypatch):
+    """DataManager of a small synthetic Cornell corpus."""
+    cornell_path = str(tmpdir.mkdir('interim'))
+    processed_path = str(tmpdir.mkdir('processed'))
+    synthetic_cornell_corpus(cornell_path, num_conversations=300, vocabulary_size=100)
+
+    monkeypatch.setattr(DataManager, '_def_cornell_path', cornell_path)
+    monkeypatch.setattr(DataManager, '_def_processed_path', processed_path)
+    return DataManager()
+
+
+def tiny_model(model_name, **params):
+    """Small SeqToSeqModel, params override TINY_MODEL_PARAMS."""
+    return SeqToSeqModel(model_name=model_name, **dict(TINY_MODEL_PARAMS, **params))
+
+
+def save_tiny_checkpoint(model, data_manager):
+    """Saves the randomly initialized training graph of model, with a fixed seed."""
+    with tf.Graph().as_default(), tf.Session() as session:
+        tf.set_random_seed(0)
+        SeqToSeqGraph(model, data_manager).train()
+        session.run(tf.global_variables_initializer())
+        model._save_model(session)
+
+
+def tiny_questions(data_manager):
+    """Token lists of a few questions of different lengths."""
+    return [data_manager.question_to_tokens(question)
+            for question in ['what do you know', 'I am not sure', 'how about dinner on Saturday night']]
+
+
 class TestModel(object):
 
     def test_get_cornell_data(self):
@@ -75,15 +214,442 @@ class TestModel(object):
         logging.info(rewards)
         assert len(responses) > 0
 
+    def test_ease_of_answering(self):
+        agent = reward_agent()
+        rng = np.random.RandomState(0)
+
+        # Small vocabulary, so that responses repeat tokens and overlap the dull responses
+        tokens = rng.randint(0, 7, (6, 8))
+        lengths = rng.randint(1, 9, 6)
+        mask = np.arange(8) < lengths[:, np.newaxis]
+        prob = np.where(mask, rng.uniform(0.1, 1., (6, 8)), 1.)
+
+        rew = agent._ease_of_answering(tokens, prob, mask)
+        for i, length in enumerate(lengths):
+            for j in range(length):
+                expected = ease_of_answering_baseline(agent.dull_responses, tokens[i, :j + 1].tolist(), prob[i, j])
+                assert rew[i, j] == pytest.approx(expected)
+
+    def test_information_flow(self):
+        rng = np.random.RandomState(1)
+        last_response = [3, 7, 1, 9, 2]
+        lengths = np.array([5, 3, 8, 1])
+        responses = [rng.randint(0, 20, length).tolist() for length in lengths]
+        mask = np.arange(lengths.max()) < lengths[:, np.newaxis]
+
+        agent = reward_agent()
+        assert np.all(agent._information_flow(None, responses, mask) == 0.)
+
+        # Each prefix is scored against the last response with its own encoder run
+        def encode(tokens):
+            fw, bw = agent.seq2seq_model.get_encoded_representations(None, None, [tokens], None)
+            return np.concatenate([fw, bw], axis=1).ravel()
+
+        rew = agent._information_flow(last_response, responses, mask)
+
+        # Only the last response is cached
+        assert list(agent.encoder_cache._entries) == [EncoderCache.key(last_response)]
+        for i, length in enumerate(lengths):
+            for j in range(length):
+                t = encode(responses[i][:j + 1]).dot(encode(last_response))
+                with np.errstate(invalid='ignore'):
+                    expected = 0. if t == 0. else -np.log(t)
+                assert rew[i, j] == pytest.approx(expected, nan_ok=True)
+            assert np.all(rew[i, length:] == 0.)
+
+    def test_beam_paths(self):
+        # [time, beam] outputs, the final beam 0 extends beam 1 of the previous step which extends beam 0
+        predicted_ids = np.array([[10, 11], [20, 21], [30, 31]])
+        parent_ids = np.array([[0, 0], [1, 0], [1, 0]])
+
+        assert beam_paths(parent_ids).tolist() == [[0, 1], [1, 0], [0, 1]]
+
+        tokens, probabilities, lengths = beam_responses(np.zeros((3, 2)), predicted_ids, parent_ids, end_token=99)
+        assert tokens.T.tolist() == [[10, 21, 30], [11, 20, 31]]
+
+        # Leading batch axis
+        batch_tokens, _, _ = beam_responses(
+            np.zeros((2, 3, 2)), np.stack([predicted_ids, predicted_ids]), np.stack([parent_ids, parent_ids]), 99)
+        assert np.array_equal(batch_tokens[1], tokens)
+
+    def test_beam_lengths(self):
+        # [time, beam] tokens, beam 0 ends at step 1, beam 1 at step 0, beam 2 never emits the end token
+        tokens = np.array([[5, 1, 5], [1, 1, 6], [7, 8, 7], [1, 8, 7]])
+        assert beam_lengths(tokens, end_token=1).tolist() == [2, 1, 4]
+
+        # No end token at all
+        assert beam_lengths(tokens, end_token=99).tolist() == [4, 4, 4]
+
+    def test_beam_softmax(self):
+        scores = np.array([[-1., -2., -3.], [1000., 999., -1000.]])
+        probabilities = beam_softmax(scores)
+        assert np.allclose(probabilities.sum(axis=-1), 1.)
+        assert np.all(np.isfinite(probabilities))
+        assert np.allclose(probabilities[0], beam_softmax(scores[0] + 5.))
+        assert np.all(np.diff(probabilities[0]) < 0)
+
+    def test_reward_to_go(self):
+        rng = np.random.RandomState(0)
+        lengths = np.array([1, 4, 2, 6])
+        rewards = rng.randn(4, 6)
+
+        rtgs = reward_to_go(rewards, lengths)
+        for i, length in enumerate(lengths):
+            assert np.allclose(rtgs[i, :length], reward_to_go_baseline(rewards[i, :length]))
+
+            # Padded positions stay 0, whatever the padded rewards are
+            assert np.all(rtgs[i, length:] == 0.)
+
+    def test_reward_to_go_discount(self):
+        rewards = np.array([[1., 2., 4., 8.], [1., 1., 5., 5.]])
+        lengths = np.array([3, 2])
+
+        rtgs = reward_to_go(rewards, lengths, discount=0.5, normalize=False)
+        assert np.allclose(rtgs, [[1. + 0.5 * 2. + 0.25 * 4., 2. + 0.5 * 4., 4., 0.], [1.5, 1., 0., 0.]])
+
+        # Normalized rewards to go are divided by the length of each row
+        assert np.allclose(reward_to_go(rewards, lengths, discount=0.5), rtgs / lengths[:, np.newaxis])
+
+        # Without discount and normalization, rewards to go are reversed cumulative sums
+        assert np.allclose(reward_to_go(rewards, lengths, normalize=False), [[7., 6., 4., 0.], [2., 1., 0., 0.]])
+
+    def test_self_play_pool_cancel(self):
+        # Pool without workers, over in-process queues
+        pool = SelfPlayPool.__new__(SelfPlayPool)
+        pool.prompt_queue = queue.Queue()
+        pool.trajectory_queue = queue.Queue()
+        pool._next_game_id = 0
+        pool.pending_games = 0
+
+        pool.submit([[1], [2], [3], [4]], num_turns=2)
+
+        # A worker started the first game, its trajectories arrive after the cancel
+        game_id, prompt, num_turns = pool.prompt_queue.get()
+        pool.trajectory_queue.put((game_id, [(prompt, [5], 0.5, 1.)], None))
+
+        assert pool.cancel() == 3
+        assert pool.pending_games == 0
+        assert pool.prompt_queue.empty() and pool.trajectory_queue.empty()
+
+    def test_encoder_cache(self):
+        cache = EncoderCache(max_size=2)
+        assert cache.get([1, 2]) is None
+
+        cache.put([1, 2], 'a')
+        cache.put(np.array([3]), 'b')
+        assert cache.get([1, 2]) == 'a'
+
+        # [3] is now the least recently used entry and is evicted first
+        cache.put([4], 'c')
+        assert len(cache) == 2
+        assert cache.get([3]) is None
+        assert cache.get([1, 2]) == 'a' and cache.get([4]) == 'c'
+        assert (cache.hits, cache.misses) == (3, 2)
+
+        # Replacing an entry does not grow the cache
+        cache.put([4], 'd')
+        assert len(cache) == 2 and cache.get([4]) == 'd'
+
+        cache.clear()
+        assert len(cache) == 0 and cache.get([1, 2]) is None
+
+        # A cache of size 0 stores nothing
+        cache = EncoderCache(max_size=0)
+        cache.put([1], 'a')
+        assert len(cache) == 0 and cache.get([1]) is None
+
+    def test_set_weights_clears_encoder_cache(self):
+        agent = reward_agent()
+        agent.agent_name = 'Agent_1'
+        responses = [[6, 7], [8]]
+
+        encoded = agent._encode(responses)
+        assert np.allclose(agent._encode(responses), encoded)
+        assert len(agent.encoder_cache) == 2 and agent.encoder_cache.hits == 2
+
+        stub = StubEncoderModel(seed=1)
+        agent.set_weights((stub.embeddings, stub.w_fw, stub.w_bw))
+        assert len(agent.encoder_cache) == 0
+
+        # Representations are recomputed with the new weights
+        fw, bw = stub.get_encoded_representations(None, None, responses, None)
+        assert np.allclose(agent._encode(responses), np.concatenate([fw, bw], axis=1).reshape(len(responses), -1))
+        assert not np.allclose(agent._encode(responses), encoded)
+
+    def test_batch_prefetcher(self):
+        def batches():
+            return iter(range(10))
+
+        assert list(BatchPrefetcher(batches, capacity=0)) == list(range(10))
+        assert list(BatchPrefetcher(batches, capacity=3)) == list(range(10))
+
+        prefetcher = BatchPrefetcher(batches, capacity=3)
+        list(prefetcher)
+        assert prefetcher.stats()['batches'] == 10
+
+    def test_batch_prefetcher_error(self):
+        def batches():
+            yield 1
+            raise ValueError('Bad batch')
+
+        for capacity in [0, 3]:
+            consumed = []
+            with pytest.raises(ValueError, match='Bad batch'):
+                for batch in BatchPrefetcher(batches, capacity=capacity):
+                    consumed.append(batch)
+            assert consumed == [1]
+
+    def test_batch_prefetcher_close(self):
+        def batches():
+            i = 0
+            while True:
+                yield i
+                i += 1
+
+        # The producer is blocked on a full queue when the consumer stops
+        with BatchPrefetcher(batches, capacity=2) as prefetcher:
+            for batch in prefetcher:
+                if batch == 3:
+                    break
+
+        prefetcher._thread.join(timeout=5)
+        assert not prefetcher._thread.is_alive()
+
+    def test_chatbot_long_question(self):
+        class StubDataManager(object):
+            questions_vocab_to_int = {'<UNK>': 1, '<PAD>': 0}
+            answers_vocab_to_int = {'<EOS>': 1, '<PAD>': 0}
+
+            def question_to_tokens(self, question):
+                return [2 + len(word) for word in question.split()]
+
+            def answer_from_tokens(self, tokens):
+                return ' '.join(str(token) for token in tokens)
+
+        class StubBeamModel(SeqToSeqModel):
+            max_sequence_length = 4
+
+            def __init__(self):
+                pass
+
+            def predict_beam_responses_batch(self, session, beam_output, input_questions, data_manager):
+                # Questions are padded as for the beam search graph
+                self.pad_sentence_batch(input_questions, data_manager.questions_vocab_to_int['<PAD>'])
+                predicted_ids = np.full((len(input_questions), 2, 1), 5)
+                predicted_ids[:, 1] = 1
+                return np.zeros(predicted_ids.shape), predicted_ids, np.zeros(predicted_ids.shape, dtype=int)
+
+        chatbot = Chatbot.__new__(Chatbot)
+        chatbot.data_manager = StubDataManager()
+        chatbot.model = StubBeamModel()
+        chatbot.graph = type('StubGraph', (object,), {'as_default': lambda self: contextlib.nullcontext()})()
+        chatbot.session = None
+        chatbot.beam_output = None
+
+        assert chatbot.reply_batch(['a b c d e f g', '', 'a b']) == ['5', '5', '5']
+
+    def test_batch_padded_data(self):
+        model = SeqToSeqModel(max_sequence_length=6)
+        vocab_to_int = {'<PAD>': 0}
+        rng = np.random.RandomState(0)
+
+        # Ragged questions and answers of ids 1..9, with a reward per answer token
+        questions = [rng.randint(1, 10, rng.randint(1, 7)).tolist() for _ in range(10)]
+        answers = [rng.randint(1, 10, rng.randint(1, 7)).tolist() for _ in range(10)]
+        rewards = [rng.uniform(0.1, 1., len(answer)).tolist() for answer in answers]
+
+        padded_data = model.pad_data(questions, answers, vocab_to_int, vocab_to_int, rewards)
+        pad_questions, pad_answers, q_sequence_length, a_sequence_length, pad_rewards = padded_data
+        assert pad_questions.shape == pad_answers.shape == pad_rewards.shape == (10, 6)
+        assert q_sequence_length.tolist() == [len(question) for question in questions]
+        assert a_sequence_length.tolist() == [len(answer) for answer in answers]
+
+        # The last incomplete batch is dropped
+        index = rng.permutation(10)
+        batches = list(model.batch_padded_data(padded_data, 3, index))
+        assert len(batches) == 3
+
+        for batch_i, (q_batch, a_batch, q_length_batch, a_length_batch, rewards_batch) in enumerate(batches):
+            batch_index = index[3 * batch_i:3 * batch_i + 3]
+            assert q_length_batch.tolist() == [len(questions[i]) for i in batch_index]
+            assert a_length_batch.tolist() == [len(answers[i]) for i in batch_index]
+
+            # Trimmed to the longest question and answer of the batch
+            assert q_batch.shape == (3, q_length_batch.max())
+            assert a_batch.shape == rewards_batch.shape == (3, a_length_batch.max())
+
+            for row, i in enumerate(batch_index):
+                assert q_batch[row].tolist() == questions[i] + [0] * (q_batch.shape[1] - len(questions[i]))
+                assert a_batch[row].tolist() == answers[i] + [0] * (a_batch.shape[1] - len(answers[i]))
+                assert np.allclose(rewards_batch[row, :len(answers[i])], rewards[i])
+                assert np.all(rewards_batch[row, len(answers[i]):] == 0.)
+
+        # Without an index, batches follow the data order and carry no rewards if not given
+        batches = list(model.batch_padded_data(padded_data[:4], 5))
+        assert len(batches) == 2 and len(batches[1]) == 4
+        assert np.array_equal(batches[1][0], pad_questions[5:, :q_sequence_length[5:].max()])
+
+    def test_export_inference_graph(self, tiny_data_manager, tmpdir, monkeypatch):
+        model = tiny_model('test-export')
+        save_tiny_checkpoint(model, tiny_data_manager)
+        questions = tiny_questions(tiny_data_manager)
+
+        # Beam outputs of the checkpoint
+        with tf.Graph().as_default(), tf.Session() as session:
+            beam_output = model.predict_beam_load_model(session, tiny_data_manager)
+            expected = model.predict_beam_responses_batch(session, beam_output, questions, tiny_data_manager)
+
+        # Export the small model rather than one with the default parameters
+        monkeypatch.setattr(export_model, 'SeqToSeqModel', lambda model_name=None: model)
+
+        for float16 in [False, True]:
+            export_path = export_model.export_inference_graph(
+                'test-export', export_path=str(tmpdir.join('inference-{0}.pb'.format(float16))), float16=float16)
+            graph, beam_output = export_model.load_inference_graph(export_path)
+
+            # Only the inference ops are exported, weights are constants
+            node_names = [node.name for node in graph.as_graph_def().node]
+            assert not any('Adam' in name or 'optimization' in name for name in node_names)
+            assert not any(node.op.startswith('Variable') for node in graph.as_graph_def().node)
+            assert any(name.endswith('/float16') for name in node_names) == float16
+
+            with graph.as_default(), tf.Session(graph=graph) as session:
+                scores, predicted_ids, parent_ids = model.predict_beam_responses_batch(
+                    session, beam_output, questions, tiny_data_manager)
+
+            assert scores.dtype == np.float32
+            np.testing.assert_array_equal(predicted_ids, expected[1])
+            np.testing.assert_array_equal(parent_ids, expected[2])
+            np.testing.assert_allclose(scores, expected[0], rtol=1e-2 if float16 else 1e-5, atol=1e-3 if float16 else 0)
+
+    def test_cell_type_checkpoints(self, tiny_data_manager):
+        questions = tiny_questions(tiny_data_manager)
+
+        # Checkpoints saved with either cell type restore with the other one
+        for saved_cell_type in ['basic', 'block']:
+            model_name = 'test-cell-{0}'.format(saved_cell_type)
+            save_tiny_checkpoint(tiny_model(model_name, cell_type=saved_cell_type), tiny_data_manager)
+
+            outputs = {}
+            for cell_type in ['basic', 'block']:
+                model = tiny_model(model_name, cell_type=cell_type)
+                with tf.Graph().as_default(), tf.Session() as session:
+                    model_graph = SeqToSeqGraph(model, tiny_data_manager)
+                    encoder_output = model_graph.encoder()[0]
+                    model_graph.restore(session)
+                    outputs[cell_type] = model.get_encoded_representations(
+                        session, encoder_output, questions, tiny_data_manager)
+
+            # Same forward and backward encoder outputs
+            for basic_output, block_output in zip(outputs['basic'], outputs['block']):
+                assert np.abs(basic_output).max() > 0.
+                np.testing.assert_allclose(block_output, basic_output, atol=1e-5)
+
+    def test_sampled_softmax(self, tiny_data_manager):
+        data_manager = tiny_data_manager
+        model = tiny_model('test-sampled-softmax', softmax='sampled', num_sampled=8)
+        questions_batch, answers_batch, q_sequence_length_batch, a_sequence_length_batch = next(model.batch_data(
+            data_manager.sorted_questions, data_manager.sorted_answers, model.batch_size,
+            data_manager.questions_vocab_to_int, data_manager.answers_vocab_to_int))
+
+        # Same batch with other tokens at the padded answer positions
+        padded = np.arange(answers_batch.shape[1]) >= a_sequence_length_batch[:, np.newaxis]
+        assert padded.any()
+        other_answers_batch = np.where(padded, data_manager.answers_vocab_to_int['<UNK>'], answers_batch)
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.set_random_seed(0)
+            model_graph = SeqToSeqGraph(model, data_manager)
+            input_data, targets, lr, input_sequence_length, output_sequence_length = model_graph.inputs()
+            cost, train_op = model_graph.train()
+
+        def feed_dict(answers):
+            return {input_data: questions_batch, targets: answers, lr: model.learning_rate,
+                    input_sequence_length: q_sequence_length_batch, output_sequence_length: a_sequence_length_batch}
+
+        # Each session starts from the same weights and draws the same sampled classes
+        losses = []
+        for answers in [answers_batch, other_answers_batch]:
+            with tf.Session(graph=graph) as session:
+                session.run(tf.global_variables_initializer())
+                losses.append(session.run(cost, feed_dict(answers)))
+        assert np.isfinite(losses[0])
+        assert losses[1] == pytest.approx(losses[0], rel=1e-5)
+
+        # Train a step and save the checkpoint
+        with graph.as_default(), tf.Session(graph=graph) as session:
+            session.run(tf.global_variables_initializer())
+            _, loss = session.run([train_op, cost], feed_dict(answers_batch))
+            assert np.isfinite(loss)
+            trained_weights = model.get_weights(session)
+            model._save_model(session)
+
+        # The checkpoint restores into the full softmax beam search graph, with the trained output projection
+        full_model = tiny_model('test-sampled-softmax')
+        with tf.Graph().as_default(), tf.Session() as session:
+            beam_output = full_model.predict_beam_load_model(session, data_manager)
+            restored_weights = full_model.get_weights(session)
+            scores, _, _ = full_model.predict_beam_responses_batch(
+                session, beam_output, tiny_questions(data_manager), data_manager)
+
+        projection_names = [name for name in restored_weights if '/dense/' in name]
+        assert len(projection_names) == 2
+        for name in projection_names:
+            np.testing.assert_array_equal(restored_weights[name], trained_weights[name])
+        assert np.all(np.isfinite(scores))
+
+    def test_trajectory_buffer(self):
+        buffer = TrajectoryBuffer(3, 5, 0, 0)
+        for i in range(1, 5):
+            buffer.append(([i] * i, [i], [0.5], [1.]))
+        requests, responses, request_lengths, response_lengths, probabilities, rewards_to_go = \
+            buffer.padded_data()
+        assert len(buffer) == 3
+        assert buffer.dropped == 1
+        assert responses[:, 0].tolist() == [2, 3, 4]
+        assert request_lengths.tolist() == [2, 3, 4]
+        assert requests[0].tolist() == [2, 2, 0, 0, 0]
+
+    def test_training_metrics(self, tmpdir):
+        metrics = TrainingMetrics(str(tmpdir), window=2)
+        metrics.add_step(0.1, 0.3, 100)
+        metrics.add_step(0., 0.2, 50)
+        metrics.add_step(0.1, 0.1, 50)
+
+        # Moving statistics of the last 2 steps
+        train_stats = metrics.train_stats()
+        assert train_stats['step_mean_ms'] == pytest.approx(200.)
+        assert train_stats['input_wait_fraction'] == pytest.approx(0.25)
+        assert train_stats['tokens_per_sec'] == pytest.approx(250.)
+        metrics.write('train', 1, train_stats)
+
+        valid_stats = metrics.add_validation(0.5, 2, 256, 1000)
+        assert valid_stats['tokens_per_sec'] == pytest.approx(2000.)
+
+        # Totals of all 3 steps
+        epoch_stats = metrics.end_epoch()
+        assert epoch_stats['steps'] == 3
+        assert epoch_stats['steps_per_sec'] == pytest.approx(3.75)
+        assert epoch_stats['valid_sec'] == pytest.approx(0.5)
+        assert metrics.end_epoch()['steps'] == 0
+        metrics.write('epoch', 1, epoch_stats)
+        metrics.close()
+
+        records = [json.loads(line) for line in tmpdir.join('metrics.jsonl').read().splitlines()]
+        assert [record['kind'] for record in records] == ['train', 'epoch']
+        assert records[1]['global_step'] == 3
+
     @pytest.mark.run_this
     def test_rl_train(self):
         batch_size = 1100
         model = PolicyGradientModel(seq2seq_model_name='test-policy', model_name='rl-policy')
-        model_inputs = {
-            'request': [[np.random.randint(0, 5000) for _ in range(10)]] * batch_size,
-            'response': [[np.random.randint(0, 5000) for _ in range(15)]] * batch_size,
-            'probability': [[np.random.random() for _ in range(15)]] * batch_size,
-            'reward': [[np.random.random() for _ in range(15)]] * batch_size
-        }
-
-        model.train(model_inputs, None)
+        for _ in range(batch_size):
+            model.trajectory_buffer.append((
+                [np.random.randint(0, 5000) for _ in range(10)],
+                [np.random.randint(0, 5000) for _ in range(15)],
+                [np.random.random() for _ in range(15)],
+                [np.random.random() for _ in range(15)]))
+
+        model.train(model.trajectory_buffer, None)
+        model.learner.close()
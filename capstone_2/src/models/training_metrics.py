@@ -0,0 +1,187 @@
+
+import json
+import os
+import time
+from collections import deque
+import numpy as np
+import tensorflow as tf
+
+#
+# Training metrics
+# Step time, token throughput and input wait of a training run, written as TensorBoard summaries and json lines
+#
+
+
+class TrainingMetrics:
+    """Collects the timings of training steps and validation passes.
+
+    Each step is split into the time the trainer waited for its batch and the time of the session run.
+    Moving averages and percentiles are computed over the last window steps, epoch totals over all steps of the
+    epoch. A large input wait fraction marks an input bound epoch, a small one a compute bound epoch.
+    """
+
+    def __init__(self, log_dir=None, window=100):
+        """
+        :param log_dir:
+            Directory of the TensorBoard summaries and of the metrics.jsonl file. Nothing is written if None.
+        :param window:
+            Number of recent steps of the moving statistics.
+        """
+
+        self.log_dir = log_dir
+        self.window = window
+
+        # Recent steps
+        self._wait_times = deque(maxlen=window)
+        self._compute_times = deque(maxlen=window)
+        self._tokens = deque(maxlen=window)
+
+        # Total number of steps, used as the global step of the summaries
+        self.steps = 0
+
+        # Totals of the current epoch
+        self._epoch = self._new_totals()
+
+        self._writer = None
+        self._file = None
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            self._writer = tf.summary.FileWriter(log_dir)
+            self._file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+
+    def add_step(self, wait_time, compute_time, num_tokens):
+        """Records a training step.
+
+        :param wait_time:
+            Seconds waited for the batch of the step.
+        :param compute_time:
+            Seconds of the session run.
+        :param num_tokens:
+            Number of non-pad question and answer tokens of the batch.
+        """
+        self._wait_times.append(wait_time)
+        self._compute_times.append(compute_time)
+        self._tokens.append(num_tokens)
+        self.steps += 1
+
+        self._epoch['steps'] += 1
+        self._epoch['wait_time'] += wait_time
+        self._epoch['compute_time'] += compute_time
+        self._epoch['tokens'] += num_tokens
+
+    def train_stats(self):
+        """Moving statistics of the recent steps.
+
+        :return:
+            A dict with the mean and percentiles of the step time, the mean wait and compute time, the input
+            wait fraction and the steps/sec and non-pad tokens/sec of the recent steps.
+        """
+        if len(self._compute_times) == 0:
+            return {}
+
+        wait_times = np.asarray(self._wait_times)
+        step_times = wait_times + np.asarray(self._compute_times)
+        total_time = step_times.sum()
+
+        return {
+            'step_mean_ms': 1000. * float(np.mean(step_times)),
+            'step_p50_ms': 1000. * float(np.percentile(step_times, 50)),
+            'step_p90_ms': 1000. * float(np.percentile(step_times, 90)),
+            'step_p99_ms': 1000. * float(np.percentile(step_times, 99)),
+            'wait_mean_ms': 1000. * float(np.mean(wait_times)),
+            'compute_mean_ms': 1000. * float(np.mean(self._compute_times)),
+            'input_wait_fraction': _ratio(wait_times.sum(), total_time),
+            'steps_per_sec': _ratio(len(step_times), total_time),
+            'tokens_per_sec': _ratio(sum(self._tokens), total_time)
+        }
+
+    def add_validation(self, duration, num_batches, num_pairs, num_tokens):
+        """Records a validation pass.
+
+        :param duration:
+            Seconds of the pass.
+        :param num_batches:
+            Number of validation batches.
+        :param num_pairs:
+            Number of question/answer pairs.
+        :param num_tokens:
+            Number of non-pad question and answer tokens.
+        :return:
+            A dict with the duration and the batches/sec, pairs/sec and tokens/sec of the pass.
+        """
+        self._epoch['valid_time'] += duration
+
+        return {
+            'valid_sec': duration,
+            'batches_per_sec': _ratio(num_batches, duration),
+            'pairs_per_sec': _ratio(num_pairs, duration),
+            'tokens_per_sec': _ratio(num_tokens, duration)
+        }
+
+    def end_epoch(self, pipeline_stats=None):
+        """Totals of the epoch, the epoch totals are reset.
+
+        :param pipeline_stats:
+            BatchPrefetcher.stats() of the epoch, added to the totals if given.
+        :return:
+            A dict with the number of steps, the training and validation time, the input wait fraction and the
+            steps/sec and non-pad tokens/sec of the epoch.
+        """
+        epoch, self._epoch = self._epoch, self._new_totals()
+        train_time = epoch['wait_time'] + epoch['compute_time']
+
+        stats = {
+            'steps': epoch['steps'],
+            'train_sec': train_time,
+            'wait_sec': epoch['wait_time'],
+            'compute_sec': epoch['compute_time'],
+            'valid_sec': epoch['valid_time'],
+            'input_wait_fraction': _ratio(epoch['wait_time'], train_time),
+            'steps_per_sec': _ratio(epoch['steps'], train_time),
+            'tokens_per_sec': _ratio(epoch['tokens'], train_time)
+        }
+        if pipeline_stats is not None:
+            stats['starved_batches'] = pipeline_stats['starved_batches']
+            stats['produce_sec'] = pipeline_stats['produce_time']
+
+        return stats
+
+    def write(self, kind, epoch, stats):
+        """Appends a record to metrics.jsonl and writes its values as TensorBoard scalars <kind>/<name>.
+
+        :param kind:
+            Record kind, such as train, valid or epoch.
+        :param epoch:
+            Epoch number.
+        :param stats:
+            Dict of numeric values.
+        """
+        if self.log_dir is None:
+            return
+
+        record = {'kind': kind, 'epoch': epoch, 'global_step': self.steps, 'time': time.time()}
+        record.update(stats)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+        summary = tf.Summary(value=[tf.Summary.Value(tag='{0}/{1}'.format(kind, name), simple_value=value)
+                                    for name, value in stats.items()])
+        self._writer.add_summary(summary, self.steps)
+
+    def close(self):
+        """Flushes and closes the summary writer and the json lines file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+            self._file = None
+
+    @staticmethod
+    def _new_totals():
+        """Empty totals of an epoch."""
+        return {'steps': 0, 'wait_time': 0., 'compute_time': 0., 'tokens': 0, 'valid_time': 0.}
+
+
+def _ratio(value, duration):
+    """value / duration, 0 for an empty duration."""
+    return float(value / duration) if duration > 0 else 0.
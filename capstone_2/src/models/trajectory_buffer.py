@@ -0,0 +1,103 @@
+
+import logging
+import numpy as np
+from src.models.rl_utils import reward_to_go
+
+#
+# Trajectory Buffer
+# Preallocated ring buffer of self-play moves for policy gradient training
+#
+
+
+class TrajectoryBuffer:
+    """Fixed size buffer of (request, response, probability, reward) moves.
+
+    Moves are stored in fixed width int32 and float32 arrays together with their lengths, so that the buffer
+    can be handed to SeqToSeqModel.train_padded without converting ragged lists. Rewards are turned into rewards
+    to go for all stored moves at once when the buffer is read. Once capacity moves are stored, new moves
+    overwrite the oldest ones.
+    """
+
+    def __init__(self, capacity, max_sequence_length, request_pad_token, response_pad_token, discount=1.):
+
+        self.capacity = capacity
+        self.max_sequence_length = max_sequence_length
+        self.request_pad_token = request_pad_token
+        self.response_pad_token = response_pad_token
+        self.discount = discount
+
+        # Padded moves
+        self.requests = np.full((capacity, max_sequence_length), request_pad_token, dtype=np.int32)
+        self.responses = np.full((capacity, max_sequence_length), response_pad_token, dtype=np.int32)
+        self.probabilities = np.zeros((capacity, max_sequence_length), dtype=np.float32)
+        self.rewards = np.zeros((capacity, max_sequence_length), dtype=np.float32)
+        self.request_lengths = np.zeros(capacity, dtype=np.int32)
+        self.response_lengths = np.zeros(capacity, dtype=np.int32)
+
+        # Slot of the next move and number of stored moves
+        self._next = 0
+        self._size = 0
+
+        # Number of moves overwritten before being read
+        self.dropped = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, trajectory):
+        """Stores a (request, response, probability, reward) move."""
+        request, response, probability, reward = trajectory
+        i = self._next
+
+        self.requests[i] = self.request_pad_token
+        self.requests[i, :len(request)] = request
+        self.request_lengths[i] = len(request)
+
+        self.responses[i] = self.response_pad_token
+        self.responses[i, :len(response)] = response
+        self.response_lengths[i] = len(response)
+
+        self.probabilities[i] = 0.
+        self.probabilities[i, :len(probability)] = probability
+
+        self.rewards[i] = 0.
+        self.rewards[i, :len(reward)] = reward
+
+        if self._size == self.capacity:
+            self.dropped += 1
+        else:
+            self._size += 1
+        self._next = (i + 1) % self.capacity
+
+    def extend(self, trajectories):
+        """Stores several moves."""
+        for trajectory in trajectories:
+            self.append(trajectory)
+
+    def clear(self):
+        """Drops all stored moves."""
+        if self.dropped > 0:
+            logging.info('Trajectory buffer dropped {0} moves over its capacity of {1}.'.format(
+                self.dropped, self.capacity))
+
+        self._next = 0
+        self._size = 0
+        self.dropped = 0
+
+    def padded_data(self):
+        """Returns the stored moves from oldest to newest.
+
+        :return:
+            A tuple (requests, responses, request_lengths, response_lengths, probabilities, rewards_to_go).
+        """
+        if self._size < self.capacity:
+            index = slice(0, self._size)
+        else:
+            index = np.roll(np.arange(self.capacity), -self._next)
+
+        response_lengths = self.response_lengths[index]
+        rewards_to_go = reward_to_go(self.rewards[index], response_lengths, self.discount).astype(np.float32)
+
+        return (self.requests[index], self.responses[index], self.request_lengths[index],
+                response_lengths, self.probabilities[index], rewards_to_go)
+